@@ -0,0 +1,81 @@
+"""
+Run the benchmark suite and compare it against the stored baselines
+
+    python -m benchmarks                    # compare, exits with 1 on a regression
+    python -m benchmarks --save             # store the current numbers as the baselines
+    python -m benchmarks -k hydrate -t 0.5  # only benchmarks containing hydrate, 50% tolerance
+
+Timings are the best of several repeats in microseconds per operation, baselines are only meaningful on the
+machine they were saved on, so save them again before comparing on another one
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+from typing import Dict
+
+from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
+from .suite import BENCHMARKS
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+
+def measure(name: str, repeat: int, min_time: float) -> float:
+    benchmark = BENCHMARKS[name]
+    previous = ElasticsearchIntegration.client
+    try:
+        timer = timeit.Timer(benchmark.setup())
+        number, _ = timer.autorange()
+        number = max(1, int(number * min_time / 0.2))
+        return min(timer.repeat(repeat, number)) / number / benchmark.ops * 1e6
+    finally:
+        ElasticsearchIntegration.set_client(previous)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help='the allowed slowdown relative to the baseline, 0.25 being 25%%')
+    parser.add_argument('-r', '--repeat', type=int, default=7, help='the amount of repeats to take the best of')
+    parser.add_argument('--min-time', type=float, default=0.2, help='the minimal seconds per repeat')
+    parser.add_argument('--baselines', default=BASELINES, help='the baselines file')
+    parser.add_argument('--save', action='store_true', help='store the results as the baselines')
+    args = parser.parse_args()
+
+    baselines: Dict[str, float] = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+
+    results, regressions = {}, []
+    for name, benchmark in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+
+        results[name] = measure(name, args.repeat, args.min_time)
+        baseline = baselines.get(name)
+        change = '' if baseline is None else f'{results[name] / baseline - 1:+8.1%}'
+        print(f'{name:<22}{results[name]:>12.2f} us/op {change:>9}   {benchmark.description}')
+        if baseline is not None and results[name] > baseline * (1 + args.threshold):
+            regressions.append(name)
+
+    if args.save:
+        baselines.update({name: round(value, 3) for name, value in results.items()})
+        with open(args.baselines, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f'saved {len(results)} baselines to {args.baselines}')
+        return 0
+
+    if regressions:
+        print(f'regressed by more than {args.threshold:.0%}: {", ".join(regressions)}', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict
+
+from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
+
+_START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_WORDS = ['hello', 'account', 'balance', 'transfer', 'thank', 'you', 'please', 'wait', 'agent', 'number']
+
+
+def transcript(i: int, lines: int):
+    return [{
+        'phrases':   [j % 7, j % 11],
+        'sentiment': (j % 5 - 2) / 2,
+        'tags':      [j % 3] if j % 4 == 0 else [],
+        'text':      ' '.join(_WORDS[(i + j + k) % len(_WORDS)] for k in range(12)),
+        'time':      j * 4000,
+        'topics':    [j % 13]
+    } for j in range(lines)]
+
+
+def cdr_document(i: int, lines: int = 40) -> Dict[str, any]:
+    """
+    A document shaped like a production Cdr, with two transcripts of the supplied amount of lines each
+
+    :param i: Varies the values of the document
+    :param lines: The amount of lines of each transcript
+    :return: The document, marked with a meta id as if it was fetched
+    """
+
+    start = _START + timedelta(minutes=i)
+    return {
+        'account_manager_id':           i % 17,
+        'call_score':                   i % 100,
+        'callee_phone_number':          f'0{500000000 + i}',
+        'callee_phrases':               [f'phrase {j}' for j in range(5)],
+        'callee_score':                 i % 90,
+        'callee_transcription':         transcript(i, lines),
+        'caller_phone_number':          f'0{540000000 + i}',
+        'caller_phrases':               [f'phrase {j}' for j in range(3)],
+        'caller_score':                 i % 80,
+        'caller_transcription':         transcript(i + 1, lines),
+        'cdr_id':                       i,
+        'compliance_comments':          [{'text': 'checked', 'created_at': 1704067200 + i, 'created_by': 3, 'id': i,
+                                          'is_compliance': True}],
+        'duration':                     float(60 + i % 600),
+        'end':                          (start + timedelta(seconds=60 + i % 600)).isoformat(),
+        'is_loading':                   False,
+        'language':                     ['english', 'hebrew', 'arabic'][i % 3],
+        'metadata':                     {'agent': f'agent {i % 20}', 'queue': i % 4, 'tags': ['a', 'b']},
+        'online':                       i % 10 == 0,
+        'outgoing':                     i % 2 == 0,
+        'premium_transcription_status': 1,
+        'review_comments':              [],
+        'session_id':                   f'session-{i}',
+        'start':                        start.isoformat(),
+        'states':                       {'assigned_to': i % 5, 'has_marked_transcript': False, 'clean': True,
+                                         'status': i % 4, 'call_classification': i % 6, 'triggered': False},
+        'successful_call':              i % 3 != 0,
+        'transcript_callee_id':         i * 2,
+        'transcript_caller_id':         i * 2 + 1,
+        ElasticsearchIntegration.META_ID_FIELD: f'meta-{i}'
+    }
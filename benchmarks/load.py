@@ -0,0 +1,276 @@
+"""
+Drive a mix of model operations from many concurrent clients against a fake backend and report latencies
+
+    python -m benchmarks.load                                   # 50 threads for 10 seconds over HTTP
+    python -m benchmarks.load -c 500 --latency 0.005 --maxsize 10
+    python -m benchmarks.load --mode asyncio --mix fetch=70,update=30
+
+Operations:
+  fetch    Cdr.fetch by primary key
+  search   Cdr.search with a CallsFilterRequest
+  count    Cdr.count with a CallsFilterRequest
+  update   a transaction setting two fields of a fetched Cdr (the fetch isn't timed)
+  setattr  setting a single field of a fetched Cdr outside a transaction (the fetch isn't timed)
+  add      committing a new Cdr, including the lookup of its meta id
+
+With --transport http, requests go through a real elasticsearch client and its connection pool (--maxsize
+connections, as the single class level client would), with --transport fake they call the fake directly.
+The library is synchronous, so in asyncio mode every task awaits its calls on a thread pool
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
+from tests.cdr import Cdr
+from tests.fake import FakeElasticsearch, FakeElasticsearchServer
+from tests.swagger.calls_filter_request import CallsFilterRequest
+from .documents import cdr_document
+
+_LANGUAGES = ['english', 'hebrew', 'arabic']
+_DEFAULT_MIX = 'fetch=40,search=25,count=15,update=10,setattr=5,add=5'
+
+
+def _fetch(rng: random.Random, documents: int) -> Callable[[], any]:
+    session_id = f'session-{rng.randrange(documents)}'
+    return lambda: Cdr.fetch(session_id)
+
+
+def _search(rng: random.Random, _) -> Callable[[], any]:
+    request = CallsFilterRequest(language_filter=[rng.choice(_LANGUAGES)], duration_min=rng.randrange(300),
+                                 max_elements=20)
+    return lambda: Cdr.search(request)
+
+
+def _count(rng: random.Random, _) -> Callable[[], any]:
+    request = CallsFilterRequest(language_filter=[rng.choice(_LANGUAGES)], online=rng.random() < 0.5)
+    return lambda: Cdr.count(request)
+
+
+def _update(rng: random.Random, documents: int) -> Callable[[], any]:
+    cdr = Cdr.fetch(f'session-{rng.randrange(documents)}')
+
+    def update():
+        with cdr.transaction():
+            cdr.is_loading = not cdr.is_loading
+            cdr.states.status = rng.randrange(4)
+    return update
+
+
+def _setattr(rng: random.Random, documents: int) -> Callable[[], any]:
+    cdr = Cdr.fetch(f'session-{rng.randrange(documents)}')
+
+    def update():
+        cdr.is_loading = not cdr.is_loading
+    return update
+
+
+def _add(rng: random.Random, _) -> Callable[[], any]:
+    cdr = Cdr(session_id=f'load-{uuid.uuid4().hex}', language=rng.choice(_LANGUAGES))
+    return cdr.commit
+
+
+OPERATIONS: Dict[str, Callable[[random.Random, int], Callable[[], any]]] = {
+    'fetch':   _fetch,
+    'search':  _search,
+    'count':   _count,
+    'update':  _update,
+    'setattr': _setattr,
+    'add':     _add,
+}
+
+
+class _Recorder:
+    """ Per worker latencies and errors, merged once the run is over """
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {name: [] for name in OPERATIONS}
+        self.errors: Dict[str, List[str]] = {name: [] for name in OPERATIONS}
+
+    def run(self, name: str, rng: random.Random, documents: int):
+        try:
+            action = OPERATIONS[name](rng, documents)
+            start = time.perf_counter()
+            action()
+            self.latencies[name].append(time.perf_counter() - start)
+        except Exception as e:
+            self.errors[name].append(f'{type(e).__name__}: {e}')
+
+
+def _parse_mix(mix: str) -> Tuple[List[str], List[float]]:
+    names, weights = [], []
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise ValueError(f'unknown operation {name}, expected one of {", ".join(OPERATIONS)}')
+        names.append(name)
+        weights.append(float(weight or 1))
+    return names, weights
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    # nearest rank
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, max(0, int(round(percent / 100 * len(values) + 0.5)) - 1))]
+
+
+def _seed(client: FakeElasticsearch, documents: int):
+    lines = []
+    for i in range(documents):
+        document = cdr_document(i, lines=5)
+        meta_id = document.pop(ElasticsearchIntegration.META_ID_FIELD)
+        lines.append({'index': {'_index': 'cdrs', '_id': meta_id}})
+        lines.append(document)
+
+    # seeding shouldn't pay the injected latency
+    latency, client.latency = client.latency, 0
+    client.bulk(lines)
+    client.latency = latency
+    client.reset_calls()
+
+
+def _run_threads(args, names: List[str], weights: List[float]) -> List[_Recorder]:
+    deadline = time.perf_counter() + args.duration
+    recorders = [_Recorder() for _ in range(args.concurrency)]
+    start = threading.Barrier(args.concurrency)
+
+    def work(recorder: _Recorder, seed: int):
+        rng = random.Random(seed)
+        start.wait()
+        while time.perf_counter() < deadline:
+            recorder.run(rng.choices(names, weights)[0], rng, args.documents)
+
+    threads = [threading.Thread(target=work, args=(recorder, args.seed + i), daemon=True)
+               for i, recorder in enumerate(recorders)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorders
+
+
+def _run_asyncio(args, names: List[str], weights: List[float]) -> List[_Recorder]:
+    async def main():
+        loop = asyncio.get_running_loop()
+        deadline = time.perf_counter() + args.duration
+        executor = ThreadPoolExecutor(max_workers=args.concurrency)
+        recorders = [_Recorder() for _ in range(args.concurrency)]
+
+        async def work(recorder: _Recorder, seed: int):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                name = rng.choices(names, weights)[0]
+                try:
+                    action = await loop.run_in_executor(executor, OPERATIONS[name], rng, args.documents)
+                    # the await is timed as a whole, so queueing for a thread counts against the operation
+                    started = time.perf_counter()
+                    await loop.run_in_executor(executor, action)
+                    recorder.latencies[name].append(time.perf_counter() - started)
+                except Exception as e:
+                    recorder.errors[name].append(f'{type(e).__name__}: {e}')
+
+        try:
+            await asyncio.gather(*(work(recorder, args.seed + i) for i, recorder in enumerate(recorders)))
+        finally:
+            executor.shutdown()
+        return recorders
+
+    return asyncio.run(main())
+
+
+def report(recorders: List[_Recorder], duration: float) -> Dict[str, Dict[str, float]]:
+    """
+    Merge the recordings of all workers into per operation statistics, latencies are in milliseconds
+    """
+
+    res = {}
+    for name in OPERATIONS:
+        latencies = sorted(latency for recorder in recorders for latency in recorder.latencies[name])
+        errors = [error for recorder in recorders for error in recorder.errors[name]]
+        if not latencies and not errors:
+            continue
+        res[name] = {
+            'count':      len(latencies),
+            'errors':     len(errors),
+            'throughput': len(latencies) / duration,
+            'p50':        _percentile(latencies, 50) * 1000,
+            'p90':        _percentile(latencies, 90) * 1000,
+            'p99':        _percentile(latencies, 99) * 1000,
+            'max':        (latencies[-1] if latencies else float('nan')) * 1000,
+        }
+        if errors:
+            res[name]['first_error'] = errors[0]
+    return res
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='the amount of concurrent clients')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='the seconds to run for')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--transport', choices=['http', 'fake'], default='http')
+    parser.add_argument('--maxsize', type=int, default=10, help='the connections of the http client')
+    parser.add_argument('--latency', type=float, default=0.002, help='the seconds every backend call takes')
+    parser.add_argument('--jitter', type=float, default=0.0, help='up to this many seconds are added at random')
+    parser.add_argument('--mix', default=_DEFAULT_MIX, help='operations and their weights, e.g. fetch=70,add=30')
+    parser.add_argument('--documents', type=int, default=200, help='the amount of Cdrs to seed the backend with')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as json')
+    args = parser.parse_args()
+
+    names, weights = _parse_mix(args.mix)
+    fake = FakeElasticsearch(latency=args.latency, jitter=args.jitter, seed=args.seed)
+    _seed(fake, args.documents)
+
+    previous = ElasticsearchIntegration.client
+    server = None
+    if args.transport == 'http':
+        from elasticsearch import Elasticsearch
+        server = FakeElasticsearchServer(fake)
+        server.start()
+        ElasticsearchIntegration.set_client(Elasticsearch(hosts=[server.url], maxsize=args.maxsize))
+    else:
+        ElasticsearchIntegration.set_client(fake)
+
+    try:
+        started = time.perf_counter()
+        recorders = (_run_threads if args.mode == 'threads' else _run_asyncio)(args, names, weights)
+        results = report(recorders, time.perf_counter() - started)
+    finally:
+        ElasticsearchIntegration.set_client(previous)
+        if server is not None:
+            server.stop()
+
+    if args.json:
+        print(json.dumps({'config': vars(args), 'operations': results, 'backend_calls': fake.calls}, indent=2))
+        return 0
+
+    print(f'{args.concurrency} {args.mode} over {args.transport} for {args.duration:g}s, '
+          f'{args.latency * 1000:g}ms backend latency')
+    print(f'{"operation":<10}{"count":>8}{"errors":>8}{"ops/s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}'
+          f'{"max ms":>10}')
+    for name, stats in results.items():
+        print(f'{name:<10}{stats["count"]:>8}{stats["errors"]:>8}{stats["throughput"]:>10.1f}{stats["p50"]:>10.2f}'
+              f'{stats["p90"]:>10.2f}{stats["p99"]:>10.2f}{stats["max"]:>10.2f}')
+    total = sum(stats['throughput'] for stats in results.values())
+    print(f'{"total":<10}{sum(stats["count"] for stats in results.values()):>8}'
+          f'{sum(stats["errors"] for stats in results.values()):>8}{total:>10.1f}')
+    print(f'backend calls: {json.dumps(fake.calls)}')
+    for name, stats in results.items():
+        if 'first_error' in stats:
+            print(f'{name} failed with {stats["first_error"]}', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import json
+from typing import Callable, Dict, NamedTuple
+
+from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
+from elastic_pdo.elasticsearch_model import ElasticsearchModel
+from tests.cdr import Cdr
+from tests.fake import FakeElasticsearch
+from tests.swagger.calls_filter_request import CallsFilterRequest
+from .documents import cdr_document
+
+_BATCH = 100
+
+
+class Benchmark(NamedTuple):
+    """
+    A benchmark, setup runs once and returns the function to time, which performs ops operations per call
+    """
+    setup: Callable[[], Callable[[], None]]
+    ops: int
+    description: str
+
+
+def _fetched_models():
+    return [Cdr().from_elastic_document(cdr_document(i)) for i in range(_BATCH)]
+
+
+def attribute_read():
+    models = _fetched_models()
+
+    def run():
+        for model in models:
+            model.language
+            model.duration
+            model.states.status
+            model.metadata['agent']
+            model.compliance_comments
+    return run
+
+
+def hydrate():
+    # hydration consumes the documents, so each run parses its own as a search response would
+    serialized = json.dumps([cdr_document(i) for i in range(_BATCH)])
+
+    def run():
+        Cdr._hydrate_all(json.loads(serialized))
+    return run
+
+
+def hydrate_raw():
+    serialized = json.dumps([cdr_document(i) for i in range(_BATCH)])
+
+    def run():
+        json.loads(serialized)
+    return run
+
+
+def to_elastic_document():
+    models = _fetched_models()
+
+    def run():
+        for model in models:
+            model.to_elastic_document()
+    return run
+
+
+def transaction_body():
+    from elastic_pdo.elasticsearch_model import _AttrKey
+    steps = [([(_AttrKey('states'), dict), _AttrKey(f'field_{i}')], i) for i in range(10)] + \
+        [([(_AttrKey('metadata'), dict), (f'nested_{i}', dict), 'value'], i) for i in range(10)]
+
+    def run():
+        body = {}
+        for path, value in steps:
+            ElasticsearchModel._add_transaction_step(body, list(path), value)
+    return run
+
+
+def bulk_serialization():
+    from elasticsearch import helpers
+    from elasticsearch.serializer import JSONSerializer
+    models = _fetched_models()
+    serializer = JSONSerializer()
+
+    def run():
+        documents = [model.to_elastic_document() for model in models]
+        for _ in helpers.actions._chunk_actions(map(helpers.expand_action, documents), 500, 100 * 1024 * 1024,
+                                                serializer):
+            pass
+    return run
+
+
+def add():
+    from elastic_pdo.elasticsearch_model import _META_ID
+    models = _fetched_models()
+
+    def run():
+        # a fresh backend keeps the cost of the primary key lookups after the bulk request constant
+        ElasticsearchIntegration.set_client(FakeElasticsearch())
+        for model in models:
+            object.__setattr__(model, _META_ID, None)
+        ElasticsearchIntegration.add(*models)
+    return run
+
+
+def search_request():
+    # noinspection PyUnresolvedReferences
+    generate = Cdr._Cdr__generate_search_request
+    request = CallsFilterRequest(text_to_search='balance transfer', assigned=True, successful_calls=True,
+                                 caller_number='0540000001', language_filter=['english', 'hebrew'],
+                                 topics=[1, 2, 3], call_classifications=[4, 5], duration_min=10, duration_max=600,
+                                 statuses=[1, 2], online=True, max_elements=50)
+
+    def run():
+        for _ in range(_BATCH):
+            generate(request)
+    return run
+
+
+def fetch_matching():
+    client = FakeElasticsearch()
+    ElasticsearchIntegration.set_client(client)
+    for i in range(_BATCH):
+        client.index('cdrs', {key: value for key, value in cdr_document(i).items()
+                              if key != ElasticsearchIntegration.META_ID_FIELD}, id=f'meta-{i}')
+
+    def run():
+        ElasticsearchIntegration.set_client(client)
+        Cdr.fetch_matching(max_elements=_BATCH)
+    return run
+
+
+BENCHMARKS: Dict[str, Benchmark] = {
+    'attribute_read':      Benchmark(attribute_read, _BATCH, 'reading five (nested) fields of a fetched Cdr'),
+    'hydrate':             Benchmark(hydrate, _BATCH, 'parsing a document and building a Cdr from it'),
+    'hydrate_raw':         Benchmark(hydrate_raw, _BATCH, 'parsing a document, the floor of hydrate'),
+    'to_elastic_document': Benchmark(to_elastic_document, _BATCH, 'turning a Cdr back into a document'),
+    'transaction_body':    Benchmark(transaction_body, 20, 'adding a nested step to a transaction body'),
+    'bulk_serialization':  Benchmark(bulk_serialization, _BATCH, 'serializing a Cdr into bulk request lines'),
+    'add':                 Benchmark(add, _BATCH, 'adding a Cdr to the fake backend, including the lookup after'),
+    'search_request':      Benchmark(search_request, _BATCH, 'generating a search request from a filter'),
+    'fetch_matching':      Benchmark(fetch_matching, _BATCH, 'fetching a Cdr from the fake backend'),
+}
@@ -0,0 +1,285 @@
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple, Type, TYPE_CHECKING, Union
+
+from .util import _require
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchBatch, ElasticsearchFuture, ElasticsearchModel
+
+
+def _metric_value(aggregation: Dict[str, any]) -> any:
+    # dates come back as epoch millis alongside their formatted value
+    if aggregation.get('value') is not None and 'value_as_string' in aggregation:
+        from dateutil import parser
+        try:
+            return parser.isoparse(aggregation['value_as_string'])
+        except ValueError:
+            pass
+    return aggregation.get('value')
+
+
+_CALENDAR_INTERVALS = {'minute', '1m', 'hour', '1h', 'day', '1d', 'week', '1w', 'month', '1M', 'quarter', '1q',
+                       'year', '1y'}
+
+
+def _time_series(aggregation: Dict[str, any], metrics: List[str], as_numpy: bool) -> Dict[str, any]:
+    # keys are epoch millis of the bucket starts, key_as_string follows whatever format the field is mapped with
+    buckets = aggregation['buckets']
+    res = {
+        'key':       [datetime.fromtimestamp(bucket['key'] / 1000, timezone.utc) for bucket in buckets],
+        'doc_count': [bucket['doc_count'] for bucket in buckets]
+    }
+    for metric in metrics:
+        res[metric] = [bucket[metric]['value'] for bucket in buckets]
+
+    if not as_numpy:
+        return res
+
+    numpy = _require('numpy', 'as_numpy')
+    arrays = {
+        'key':       numpy.array([bucket['key'] for bucket in buckets], dtype='datetime64[ms]'),
+        'doc_count': numpy.array(res['doc_count'], dtype=numpy.int64)
+    }
+    for metric in metrics:
+        arrays[metric] = numpy.array([numpy.nan if value is None else value for value in res[metric]], dtype=float)
+    return arrays
+
+
+def _keyed_values(aggregation: Dict[str, any]) -> Dict[float, Optional[float]]:
+    return {float(key): value for key, value in aggregation['values'].items()}
+
+
+def _terms_buckets(aggregation: Dict[str, any]) -> List[Tuple[any, int]]:
+    return [(bucket['key'], bucket['doc_count']) for bucket in aggregation['buckets']]
+
+
+class ElasticsearchAggregation:
+    """
+    ElasticsearchAggregation builds multiple aggregations of a model to run in a single size=0 request
+
+    Chain the aggregations you need and call execute, results are keyed by name which defaults to kind_field,
+    e.g. Cdr.aggregate(query).sum('duration').terms('language.keyword', size=50).execute()['sum_duration']
+    """
+
+    _SAMPLE = '_sample'
+
+    def __init__(self, model: Type['ElasticsearchModel'], query: Dict[str, any] = None):
+        self.__model = model
+        self.__query = query
+        self.__aggregations: Dict[str, Tuple[Dict[str, any], Callable[[Dict[str, any]], any]]] = {}
+        self.__sampler: Optional[Dict[str, any]] = None
+
+    def avg(self, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the average of a numeric field, <span style="color:#0055aa">None</span> if no model has a value
+        """
+
+        return self.__metric('avg', field, name)
+
+    def body(self) -> Dict[str, any]:
+        """
+        Build the search request of all added aggregations
+
+        :return: The search request body, parse its response with parse
+        """
+
+        if not self.__aggregations:
+            raise RuntimeError('Cannot build an aggregation request without any aggregations')
+
+        aggs = {name: body for name, (body, _) in self.__aggregations.items()}
+        if self.__sampler is not None:
+            aggs = {self._SAMPLE: dict(self.__sampler, aggs=aggs)}
+
+        return {
+            'query':            self.__query or {'match_all': {}},
+            'size':             0,
+            'track_total_hits': False,
+            'aggs':             aggs
+        }
+
+    def cardinality(self, field: str, precision_threshold: int = None, name: str = None) \
+            -> 'ElasticsearchAggregation':
+        """
+        Add the approximate amount of distinct values of a field
+
+        :param field: The field to count distinct values of
+        :param precision_threshold: Counts below this are expected to be close to accurate,
+        higher values cost more memory, elasticsearch caps it at 40000
+        :param name: The name of the result, defaults to cardinality_field
+        """
+
+        cardinality = {'field': field}
+        if precision_threshold is not None:
+            cardinality['precision_threshold'] = precision_threshold
+        return self._add(name or f'cardinality_{field}', {'cardinality': cardinality}, _metric_value)
+
+    def date_histogram(self, field: str, interval: str, time_zone: str = None,
+                       metrics: List[Tuple[str, str]] = None, min_doc_count: int = 0,
+                       extended_bounds: Tuple[any, any] = None, as_numpy: bool = False, name: str = None) \
+            -> 'ElasticsearchAggregation':
+        """
+        Add a time series of a date field bucketed by interval, ready for plotting
+
+        :param field: The date field to bucket models by
+        :param interval: The size of each bucket, calendar units such as 1h, 1d or month are calendar aware,
+        anything else (e.g. 30m) is a fixed interval
+        :param time_zone: The time zone buckets are aligned to, as an offset such as +03:00 or a zone id
+        :param metrics: Metrics to compute per bucket as (kind, field) pairs, e.g. [('sum', 'duration')],
+        they're returned under kind_field
+        :param min_doc_count: The minimal amount of models in a bucket for it to be returned,
+        0 keeps the series continuous
+        :param extended_bounds: The (min, max) the series should span even if there are no models at its edges
+        :param as_numpy: Whether to return numpy arrays (datetime64 keys) instead of lists
+        :return: The series as parallel arrays under key, doc_count and each of the metrics
+        """
+
+        histogram = {
+            'field':         field,
+            'min_doc_count': min_doc_count,
+            'calendar_interval' if interval in _CALENDAR_INTERVALS else 'fixed_interval': interval
+        }
+        if time_zone is not None:
+            histogram['time_zone'] = time_zone
+        if extended_bounds is not None:
+            histogram['extended_bounds'] = {'min': extended_bounds[0], 'max': extended_bounds[1]}
+
+        body = {'date_histogram': histogram}
+        metric_names = []
+        if metrics:
+            body['aggs'] = {}
+            for kind, metric_field in metrics:
+                metric_name = f'{kind}_{metric_field}'
+                body['aggs'][metric_name] = {kind: {'field': metric_field}}
+                metric_names.append(metric_name)
+
+        return self._add(name or f'date_histogram_{field}', body,
+                         lambda aggregation: _time_series(aggregation, metric_names, as_numpy))
+
+    def execute(self, batch: 'ElasticsearchBatch' = None) \
+            -> Union[Dict[str, any], 'ElasticsearchFuture[Dict[str, any]]']:
+        """
+        Run all added aggregations in a single request
+
+        :param batch: If supplied the request is deferred to it and a future is returned
+        :return: The result of each aggregation keyed by its name
+        """
+
+        if batch is not None:
+            return batch.search(self.body(), self.parse)
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        index = object.__getattribute__(self.__model, f'_{self.__model.__name__}__index')
+        return self.parse(ElasticsearchIntegration.search(index, self.body()))
+
+    def max(self, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the maximum of a numeric or date field, dates are returned as datetime
+        """
+
+        return self.__metric('max', field, name)
+
+    def min(self, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the minimum of a numeric or date field, dates are returned as datetime
+        """
+
+        return self.__metric('min', field, name)
+
+    def parse(self, search_response: Dict[str, any]) -> Dict[str, any]:
+        """
+        Extract the results of all added aggregations from a search response
+
+        :param search_response: The response to a request built by body
+        :return: The result of each aggregation keyed by its name
+        """
+
+        aggregations = search_response['aggregations']
+        if self.__sampler is not None:
+            aggregations = aggregations[self._SAMPLE]
+        return {name: parse(aggregations[name]) for name, (_, parse) in self.__aggregations.items()}
+
+    def percentile_ranks(self, field: str, values: List[float], name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the approximate percentage of values of a numeric field below each of the supplied values,
+        as a dict of value to percentage
+        """
+
+        return self._add(name or f'percentile_ranks_{field}',
+                         {'percentile_ranks': {'field': field, 'values': list(values)}}, _keyed_values)
+
+    def percentiles(self, field: str, percents: List[float] = None, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add approximate percentiles of a numeric field, as a dict of percent to value
+
+        :param field: The field to compute percentiles of
+        :param percents: The percentiles to compute, e.g. [50, 95, 99], elasticsearch has defaults if not supplied
+        :param name: The name of the result, defaults to percentiles_field
+        """
+
+        percentiles = {'field': field}
+        if percents is not None:
+            percentiles['percents'] = list(percents)
+        return self._add(name or f'percentiles_{field}', {'percentiles': percentiles}, _keyed_values)
+
+    def random_sample(self, probability: float, seed: int = None) -> 'ElasticsearchAggregation':
+        """
+        Run all aggregations over a random sample of the matching models (random_sampler, requires elasticsearch 8)
+
+        Counts and sums are not scaled back up, averages and percentiles remain representative
+
+        :param probability: The probability of each model to be sampled, between 0 and 0.5 or exactly 1
+        :param seed: Fixes the sample so results are repeatable
+        """
+
+        sampler = {'probability': probability}
+        if seed is not None:
+            sampler['seed'] = seed
+        return self.__sample({'random_sampler': sampler})
+
+    def sample(self, shard_size: int = 100) -> 'ElasticsearchAggregation':
+        """
+        Run all aggregations over only the best scoring models of each shard (sampler)
+
+        :param shard_size: The amount of models to sample per shard
+        """
+
+        return self.__sample({'sampler': {'shard_size': shard_size}})
+
+    def sum(self, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the sum of a numeric field
+        """
+
+        return self.__metric('sum', field, name)
+
+    def terms(self, field: str, size: int = 10, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the most common values of a field, as a list of values coupled with their counts
+        """
+
+        return self._add(name or f'terms_{field}', {'terms': {'field': field, 'size': size}}, _terms_buckets)
+
+    def value_count(self, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        """
+        Add the amount of values a field has across all matching models
+        """
+
+        return self.__metric('value_count', field, name)
+
+    def _add(self, name: str, body: Dict[str, any], parse: Callable[[Dict[str, any]], any]) \
+            -> 'ElasticsearchAggregation':
+        if name in self.__aggregations:
+            raise ValueError(f'An aggregation named {name} was already added')
+
+        self.__aggregations[name] = (body, parse)
+        return self
+
+    def __sample(self, sampler: Dict[str, any]) -> 'ElasticsearchAggregation':
+        if self.__sampler is not None:
+            raise RuntimeError('Cannot sample an aggregation more than once')
+
+        self.__sampler = sampler
+        return self
+
+    def __metric(self, kind: str, field: str, name: str = None) -> 'ElasticsearchAggregation':
+        return self._add(name or f'{kind}_{field}', {kind: {'field': field}}, _metric_value)
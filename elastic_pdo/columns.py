@@ -0,0 +1,196 @@
+import functools
+import typing
+from datetime import date, datetime
+from typing import Dict, List, Optional, Type, TYPE_CHECKING
+
+from .util import _is, _is_builtin, _is_dunder, _require
+
+if TYPE_CHECKING:
+    import pyarrow
+    from .elasticsearch_model import ElasticsearchModel
+
+_NUMERIC = (bool, int, float)
+_MAPPED_INTEGERS = frozenset({'long', 'integer', 'short', 'byte'})
+_MAPPED_FLOATS = frozenset({'double', 'float', 'half_float', 'scaled_float'})
+
+
+@functools.lru_cache(maxsize=None)
+def _declared_types(klass: type) -> Dict[str, type]:
+    # swagger types first, then constructor annotations, then the types of whatever the constructor sets by default,
+    # resolved once per class as it takes building an instance, the result is shared and mustn't be modified
+    try:
+        hints = typing.get_type_hints(klass.__init__)
+    except (NameError, TypeError):
+        hints = dict(getattr(klass.__init__, '__annotations__', {}))
+    hints.pop('return', None)
+
+    try:
+        instance = klass()
+    except TypeError:
+        instance = None
+
+    # swagger models declare their types per instance
+    res = dict(getattr(instance, 'swagger_types', None) or {})
+    for name, hint in hints.items():
+        res.setdefault(name, hint)
+    if instance is not None:
+        for name, value in vars(instance).items():
+            if not _is_dunder(name) and not name.startswith('_') and value is not None:
+                res.setdefault(name, type(value))
+    return res
+
+
+def field_type(model: Type['ElasticsearchModel'], field: str) -> Optional[type]:
+    """
+    Resolve the python type of a (possibly nested) field of a model from its constructor and swagger types
+
+    :param model: The model the field belongs to
+    :param field: The field, nested fields are separated by dots, e.g. states.status
+    :return: The type of the field or <span style="color:#0055aa">None</span> if unknown
+    """
+
+    klass = model
+    for part in field.split('.'):
+        if klass is None or _is_builtin(klass) or getattr(klass, '__origin__', None) is not None:
+            return None
+        klass = _declared_types(klass).get(part)
+    return klass
+
+
+def model_field_types(model: Type['ElasticsearchModel']) -> Dict[str, type]:
+    """
+    Resolve the python types of the top level fields of a model
+
+    :param model: The model to resolve the fields of
+    :return: The type of each field
+    """
+
+    from .elasticsearch_model import ElasticsearchModel
+    return {name: klass for name, klass in _declared_types(model).items()
+            if name not in ElasticsearchModel._ATTRS_TO_INTERCEPT}
+
+
+def _parse_datetime64(value: any):
+    import numpy
+    if value is None:
+        return numpy.datetime64('NaT', 'ms')
+    if isinstance(value, (int, float)):
+        return numpy.datetime64(int(value), 'ms')
+
+    from dateutil import parser, tz
+    parsed = value if isinstance(value, datetime) else parser.isoparse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(tz.UTC).replace(tzinfo=None)
+    return numpy.datetime64(parsed, 'ms')
+
+
+def to_numpy(values: List[any], klass: Optional[type]):
+    """
+    Convert the values of a single field into a numpy array based off the type of the field
+
+    Dates become datetime64[ms] in UTC, numbers become float64 with NaN in place of missing values unless none are
+    missing, anything else is kept as objects
+
+    :param values: The values of the field, <span style="color:#0055aa">None</span> for missing ones
+    :param klass: The type of the field, see field_type
+    :return: The numpy array
+    """
+
+    numpy = _require('numpy', 'to_numpy')
+    if klass in (datetime, date):
+        return numpy.array([_parse_datetime64(value) for value in values], dtype='datetime64[ms]')
+
+    if klass in _NUMERIC and all(value is None or isinstance(value, _NUMERIC) for value in values):
+        if klass is bool and all(isinstance(value, bool) for value in values):
+            return numpy.array(values, dtype=numpy.bool_)
+        if klass is int and all(isinstance(value, int) for value in values):
+            return numpy.array(values, dtype=numpy.int64)
+        return numpy.array([numpy.nan if value is None else value for value in values], dtype=numpy.float64)
+
+    res = numpy.empty(len(values), dtype=object)
+    res[:] = values
+    return res
+
+
+def value_at(document: Dict[str, any], field: str) -> any:
+    """
+    Get the value of a (possibly nested) field of a document
+
+    :param document: The document to get the value from
+    :param field: The field, nested fields are separated by dots
+    :return: The value or <span style="color:#0055aa">None</span> if missing
+    """
+
+    value = document
+    for part in field.split('.'):
+        if not _is(type(value), dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _arrow_type(klass: Optional[type], depth: int = 0):
+    import pyarrow
+    if klass in (None, any, object) or depth > 8:
+        return None
+    if klass is bool:
+        return pyarrow.bool_()
+    if klass is int:
+        return pyarrow.int64()
+    if klass is float:
+        return pyarrow.float64()
+    if klass is str:
+        return pyarrow.string()
+    if klass is datetime:
+        return pyarrow.timestamp('ms', tz='UTC')
+    if klass is date:
+        return pyarrow.date32()
+    if _is(klass, list):
+        args = getattr(klass, '__args__', None)
+        item = _arrow_type(args[0], depth + 1) if args else None
+        return None if item is None else pyarrow.list_(item)
+    if _is(klass, dict) or _is_builtin(klass):
+        return None
+
+    # models nest as structs of their declared fields
+    fields = [(name, _arrow_type(klass_, depth + 1)) for name, klass_ in _declared_types(klass).items()]
+    fields = [pyarrow.field(name, arrow_type) for name, arrow_type in fields if arrow_type is not None]
+    return pyarrow.struct(fields) if fields else None
+
+
+def _mapped_arrow_type(params: Optional[Dict[str, any]]):
+    import pyarrow
+    mapped = None if params is None else params.get('type')
+    if mapped in _MAPPED_INTEGERS:
+        return pyarrow.int64()
+    if mapped in _MAPPED_FLOATS:
+        return pyarrow.float64()
+    if mapped == 'boolean':
+        return pyarrow.bool_()
+    return None
+
+
+def arrow_schema(model: Type['ElasticsearchModel'], fields: List[str] = None) -> 'pyarrow.Schema':
+    """
+    Derive an Arrow schema from the declared types of a model
+
+    Dates become UTC timestamps, nested models become structs, and fields whose type can't be expressed
+    (e.g. Dict[str, any]) become strings holding their JSON.
+    Numbers take the type the model maps them with (see elastic_pdo.mapping), so a field declared double in its
+    __mapping is a float even if its constructor defaults it to 0
+
+    :param model: The model to derive the schema of
+    :param fields: The top level fields to include, all if <span style="color:#0055aa">None</span>
+    :return: The schema
+    """
+
+    pyarrow = _require('pyarrow', 'arrow_schema')
+    from .mapping import model_mapping
+    types = model_field_types(model)
+    properties = model_mapping(model)['properties']
+    res = []
+    for name in fields or types:
+        arrow_type = _mapped_arrow_type(properties.get(name)) or _arrow_type(types.get(name))
+        res.append(pyarrow.field(name, pyarrow.string() if arrow_type is None else arrow_type,
+                                 metadata=None if arrow_type is not None else {'encoding': 'json'}))
+    return pyarrow.schema(res)
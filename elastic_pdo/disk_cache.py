@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+
+class CachedDocument(NamedTuple):
+    source: Dict[str, any]
+    meta_id: str
+    seq_no: int
+    primary_term: int
+    stored_at: float
+
+
+class DiskCache:
+    """
+    DiskCache is an sqlite backed store of documents fetched by primary key
+
+    Every process on the host that opens the same path shares the cache,
+    entries remember the _seq_no and _primary_term they were fetched at so they can be revalidated cheaply
+    """
+
+    def __init__(self, path: str, indices: List[str] = None, max_age: float = 0):
+        """
+        :param path: The file to store the cache in, created if missing
+        :param indices: The indices to cache, all if <span style="color:#0055aa">None</span>
+        :param max_age: The amount of seconds an entry is trusted without revalidating it against elasticsearch
+        """
+
+        self.__path = path
+        self.__indices = None if indices is None else frozenset(indices)
+        self.__max_age = max_age
+        self.__local = threading.local()
+
+        with self.__connection() as connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS documents (
+                    idx          TEXT    NOT NULL,
+                    lookup       TEXT    NOT NULL,
+                    meta_id      TEXT    NOT NULL,
+                    source       TEXT    NOT NULL,
+                    seq_no       INTEGER NOT NULL,
+                    primary_term INTEGER NOT NULL,
+                    stored_at    REAL    NOT NULL,
+                    PRIMARY KEY (idx, lookup)
+                )''')
+            connection.execute('CREATE INDEX IF NOT EXISTS documents_meta_id ON documents (idx, meta_id)')
+
+    @property
+    def max_age(self) -> float:
+        """The amount of seconds an entry is trusted without revalidating it"""
+        return self.__max_age
+
+    @staticmethod
+    def lookup(key: str, value: any, source: Optional[Dict[str, List[str]]] = None) -> str:
+        """
+        Create the lookup of a document in its index, documents fetched with different projections are kept apart
+
+        :param key: The key the document is fetched by
+        :param value: The value the key is matched against
+        :param source: The _source filtering the document is fetched with
+        :return: The lookup of the document
+        """
+
+        return json.dumps([key, value, source], sort_keys=True, separators=(',', ':'), default=str)
+
+    def caches(self, index: str) -> bool:
+        """
+        :param index: The index to check
+        :return: Whether documents of the supplied index are cached
+        """
+
+        return self.__indices is None or index in self.__indices
+
+    def clear(self) -> None:
+        """
+        Remove all entries from this cache
+        """
+
+        with self.__connection() as connection:
+            connection.execute('DELETE FROM documents')
+
+    def get(self, index: str, lookup: str) -> Optional[CachedDocument]:
+        """
+        Get a cached document
+
+        :param index: The index of the document
+        :param lookup: The lookup of the document, see DiskCache.lookup
+        :return: The cached document or <span style="color:#0055aa">None</span> if missing
+        """
+
+        row = self.__connection().execute(
+            'SELECT source, meta_id, seq_no, primary_term, stored_at FROM documents WHERE idx = ? AND lookup = ?',
+            (index, lookup)).fetchone()
+        if row is None:
+            return None
+        return CachedDocument(json.loads(row[0]), row[1], row[2], row[3], row[4])
+
+    def invalidate(self, index: str, meta_id: str = None) -> None:
+        """
+        Remove the entries of a document or of an entire index
+
+        :param index: The index to invalidate
+        :param meta_id: The meta id of the document to invalidate, the whole index if
+        <span style="color:#0055aa">None</span>
+        """
+
+        with self.__connection() as connection:
+            if meta_id is None:
+                connection.execute('DELETE FROM documents WHERE idx = ?', (index,))
+            else:
+                connection.execute('DELETE FROM documents WHERE idx = ? AND meta_id = ?', (index, meta_id))
+
+    def put(self, index: str, lookup: str, source: Dict[str, any], meta_id: str, seq_no: int,
+            primary_term: int) -> None:
+        """
+        Cache a document
+
+        :param index: The index of the document
+        :param lookup: The lookup of the document, see DiskCache.lookup
+        :param source: The _source of the document
+        :param meta_id: The meta id of the document
+        :param seq_no: The _seq_no the document was fetched at
+        :param primary_term: The _primary_term the document was fetched at
+        """
+
+        with self.__connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (index, lookup, meta_id, json.dumps(source, default=str), seq_no, primary_term,
+                                time.time()))
+
+    def touch(self, index: str, lookup: str) -> None:
+        """
+        Mark a cached document as revalidated now
+
+        :param index: The index of the document
+        :param lookup: The lookup of the document, see DiskCache.lookup
+        """
+
+        with self.__connection() as connection:
+            connection.execute('UPDATE documents SET stored_at = ? WHERE idx = ? AND lookup = ?',
+                               (time.time(), index, lookup))
+
+    def __connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.__local.connection = connection
+        return connection
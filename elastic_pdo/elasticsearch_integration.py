@@ -1,9 +1,18 @@
-from typing import Dict, List, Optional, Tuple, Type, TYPE_CHECKING, Union
+import threading
+import time
+import warnings
+from typing import Dict, Iterator, List, Optional, Tuple, Type, TYPE_CHECKING, Union
 
 from .util import _is
 
 if TYPE_CHECKING:
+    import logging
+    from .disk_cache import DiskCache
     from .elasticsearch_model import ElasticsearchModel
+    from .instrumentation import Listener, SlowQueryLog
+    from .profiling import SearchProfile
+    from .query_cache import QueryCache
+    from .schema import IndexSchema, SchemaCache
     from elasticsearch import Elasticsearch
 
 
@@ -17,12 +26,134 @@ class _Meta(type):
     def client(cls) -> 'Elasticsearch':
         return cls._client
 
+    @property
+    def disk_cache(cls) -> Optional['DiskCache']:
+        return cls._disk_cache
+
+    @property
+    def query_cache(cls) -> Optional['QueryCache']:
+        return cls._query_cache
+
+    @property
+    def schema_cache(cls) -> Optional['SchemaCache']:
+        return cls._schema_cache
+
+
+class _BulkClient:
+    """ Stands in for the client given to the elasticsearch helpers so their bulk requests are instrumented """
+
+    def __getattr__(self, item):
+        return getattr(ElasticsearchIntegration.client, item)
+
+    @staticmethod
+    def bulk(**kwargs):
+        return ElasticsearchIntegration._call('bulk', kwargs.get('index'), **kwargs)
+
 
 # noinspection GrazieInspection
 class ElasticsearchIntegration(metaclass=_Meta):
     _META_ID_FIELD = '__meta_id__'
 
     _client: 'Elasticsearch' = None
+    _disk_cache: Optional['DiskCache'] = None
+    _listeners: Tuple['Listener', ...] = ()
+    _listeners_lock = threading.Lock()
+    _query_cache: Optional['QueryCache'] = None
+    _schema_cache: Optional['SchemaCache'] = None
+    _slow_query_log: Optional['SlowQueryLog'] = None
+
+    @classmethod
+    def _cached(cls, operation: str, index: str, body: Dict[str, any]) -> Dict[str, any]:
+        cache = cls._query_cache
+        if cache is None:
+            return cls._call(operation, index, index=index, body=body)
+
+        key = cache.key(operation, index, body)
+        response = cache.get(key)
+        if response is None:
+            # a write landing while the request is in flight must not leave its stale response behind
+            generation = cache.generation(index)
+            response = cls._call(operation, index, index=index, body=body)
+            cache.put(key, index, response, generation)
+        return response
+
+    @classmethod
+    def _call(cls, operation: str, index: Optional[str], /, **kwargs) -> any:
+        # every request the library makes goes through here, the listeners are only paid for when there are any
+        func = cls.client
+        for part in operation.split('.'):
+            func = getattr(func, part)
+
+        listeners = cls._listeners
+        if not listeners:
+            return func(**kwargs)
+
+        from .instrumentation import emit
+        start = time.perf_counter()
+        try:
+            response = func(**kwargs)
+        except Exception as e:
+            emit(listeners, operation, index, kwargs.get('body'), None, time.perf_counter() - start, e)
+            raise
+        emit(listeners, operation, index, kwargs.get('body'), response, time.perf_counter() - start)
+        return response
+
+    @classmethod
+    def _documents_from_hits(cls, hits: List[Dict[str, any]]) -> List[Dict[str, any]]:
+        res = []
+        for hit in hits:
+            document = hit.get('_source', {})
+            document[cls.META_ID_FIELD] = hit['_id']
+            res.append(document)
+        return res
+
+    @classmethod
+    def _get_through_disk_cache(cls, index: str, request_body_search: Dict[str, any], key: str, value: any) \
+            -> Optional[Tuple[Dict[str, any], int]]:
+        disk_cache = cls._disk_cache
+        lookup = disk_cache.lookup(key, value, request_body_search.get('_source'))
+        cached = disk_cache.get(index, lookup)
+
+        # revalidating only fetches the version of the document which is much cheaper than fetching it whole
+        if cached is not None:
+            if time.time() - cached.stored_at < disk_cache.max_age:
+                cached.source[cls.META_ID_FIELD] = cached.meta_id
+                return cached.source, 1
+
+            version_search = dict(request_body_search, _source=False, seq_no_primary_term=True, size=1)
+            search_response = cls._call('search', index, index=index, body=version_search)
+            hits = search_response['hits']['hits']
+            if not hits:
+                disk_cache.invalidate(index, cached.meta_id)
+                return None
+
+            if (hits[0]['_id'], hits[0]['_seq_no'], hits[0]['_primary_term']) == \
+                    (cached.meta_id, cached.seq_no, cached.primary_term):
+                disk_cache.touch(index, lookup)
+                cached.source[cls.META_ID_FIELD] = cached.meta_id
+                return cached.source, search_response['hits']['total']['value']
+
+        search_response = cls._call('search', index, index=index,
+                                    body=dict(request_body_search, seq_no_primary_term=True))
+        hits = search_response['hits']['hits']
+        if not hits:
+            return None
+
+        hit = hits[0]
+        res = hit.get('_source', {})
+        disk_cache.put(index, lookup, res, hit['_id'], hit['_seq_no'], hit['_primary_term'])
+        res[cls.META_ID_FIELD] = hit['_id']
+        return res, search_response['hits']['total']['value']
+
+    @classmethod
+    def _invalidate(cls, index: str, meta_id: str = None):
+        cache = cls._query_cache
+        if cache is not None:
+            cache.invalidate(index)
+
+        disk_cache = cls._disk_cache
+        if disk_cache is not None and disk_cache.caches(index):
+            disk_cache.invalidate(index, meta_id)
 
     @classmethod
     def create_client(cls, elasticsearch_endpoint: str, elasticsearch_authorization: Tuple[str, str]):
@@ -30,6 +161,21 @@ class ElasticsearchIntegration(metaclass=_Meta):
         cls._client = Elasticsearch(hosts=[f'{elasticsearch_endpoint}:443'],
                                     http_auth=elasticsearch_authorization, use_ssl=True)
 
+    @classmethod
+    def set_client(cls, client: 'Elasticsearch'):
+        """
+        Use an already constructed client instead of creating one,
+        e.g. the FakeElasticsearch of tests.fake for offline tests
+
+        :param client: Anything implementing the parts of the elasticsearch client the library uses
+        """
+
+        cls._client = client
+        if cls._query_cache is not None:
+            cls._query_cache.clear()
+        if cls._schema_cache is not None:
+            cls._schema_cache.refresh()
+
     @classmethod
     def add(cls, *args: Union['ElasticsearchModel', List['ElasticsearchModel']]):
         """
@@ -57,7 +203,9 @@ class ElasticsearchIntegration(metaclass=_Meta):
 
         from elasticsearch import helpers
         for t, l in by_type.items():
-            helpers.bulk(cls.client, [model.to_elastic_document() for model in l], index=l[0].index, doc_type='_doc')
+            helpers.bulk(_BulkClient(), [model.to_elastic_document() for model in l], index=l[0].index,
+                         doc_type='_doc')
+            cls._invalidate(l[0].index)
 
         # fetch the meta ids, HIGH: there's gotta be a better way than querying them all
         from .elasticsearch_model import _META_ID
@@ -70,55 +218,289 @@ class ElasticsearchIntegration(metaclass=_Meta):
                     break
 
     @classmethod
-    def count(cls, index: str, query: Dict[str, any] = None, max_elements: int = None, offset: int = None) -> int:
-        term = {'term': query} if query else {'match_all': {}}
-        search_response = cls.client.search(index=index, body={'query': term}, track_total_hits=True,
-                                            size=max_elements, from_=offset)
+    def add_listener(cls, listener: 'Listener'):
+        """
+        Get notified of every request made to elasticsearch, see instrumentation.RequestEvent
+
+        Listeners are called synchronously on the thread that made the request, after it completed (or failed),
+        exceptions they raise propagate to the caller of the operation
+
+        :param listener: A callable taking a RequestEvent
+        """
+
+        with cls._listeners_lock:
+            if listener not in cls._listeners:
+                cls._listeners = cls._listeners + (listener,)
+
+    @classmethod
+    def count(cls, index: str, query: Dict[str, any] = None, max_elements: int = None, offset: int = None, *,
+              at_least: int = None) -> int:
+        """
+        Count the models of an index whose fields equal the supplied values
+
+        :param index: The index of the models
+        :param query: The field values to match as a term query, all models are counted if not supplied
+        :param max_elements: Deprecated and ignored, it never affected the count
+        :param offset: Deprecated and ignored, it never affected the count
+        :param at_least: Stop counting accurately past this amount, see count_matching
+        :return: The amount of models matching the supplied query
+        """
+
+        if query is not None and not isinstance(query, dict):
+            raise ValueError(f'query must be a dict of field values, got {type(query).__name__}')
+        if max_elements is not None or offset is not None:
+            warnings.warn('max_elements and offset are ignored by count, use at_least to cap the count',
+                          DeprecationWarning, stacklevel=2)
+
+        return cls.count_matching(index, {'term': query} if query else None, at_least)
+
+    @classmethod
+    def count_matching(cls, index: str, query: Dict[str, any] = None, at_least: int = None) -> int:
+        """
+        Count the models of an index matching the supplied query without fetching any of them
+
+        :param index: The index of the models
+        :param query: The query to match against, if <span style="color:#0055aa">None</span> defaults to match all
+        :param at_least: If supplied, only count accurately up to this amount which is much cheaper for large results,
+        a return value equal to <b><i>at_least</i></b> means there are at least that many matching models
+        :return: The amount of models matching the supplied query
+        """
+
+        if at_least is None:
+            return cls._cached('count', index, {'query': query or {'match_all': {}}})['count']
+
+        search_response = cls.search(index, cls.count_body(query, at_least))
         return search_response['hits']['total']['value']
 
+    @staticmethod
+    def count_body(query: Dict[str, any] = None, at_least: int = None) -> Dict[str, any]:
+        """
+        Build a search request that counts matching models without fetching any of them
+
+        :param query: The query to match against, if <span style="color:#0055aa">None</span> defaults to match all
+        :param at_least: Only count accurately up to this amount
+        :return: The search request body, the count is in ['hits']['total']['value'] of its response
+        """
+
+        return {
+            'query':            query or {'match_all': {}},
+            'size':             0,
+            'track_total_hits': True if at_least is None else at_least
+        }
+
+    @classmethod
+    def disable_disk_cache(cls):
+        """
+        Stop using the on-disk cache for fetching models by primary key, its file is kept
+        """
+
+        cls._disk_cache = None
+
     @classmethod
-    def distinct(cls, index: str, field: str) -> List[Tuple[str, int]]:
+    def disable_query_cache(cls):
+        """
+        Stop caching search responses and drop everything cached so far
+        """
+
+        cache, cls._query_cache = cls._query_cache, None
+        if cache is not None:
+            cache.clear()
+
+    @classmethod
+    def disable_schema_cache(cls):
+        """
+        Stop using index mappings, queries and hydration go back to guessing from python types
+        """
+
+        cls._schema_cache = None
+
+    @classmethod
+    def disable_slow_query_log(cls):
+        """
+        Stop logging slow requests
+        """
+
+        if cls._slow_query_log is not None:
+            cls.remove_listener(cls._slow_query_log)
+            cls._slow_query_log = None
+
+    @classmethod
+    def distinct(cls, index: str, field: str, size: int = None) -> List[Tuple[str, int]]:
         """
         Fetch distinct values of the supplied field for a models based of their index
 
         :param index: The index of the models
         :param field: The field to fetch distinct values of
+        :param size: The maximum amount of values to fetch, the most common ones are kept,
+        elasticsearch defaults to 10. Use iter_distinct to go over all values of high cardinality fields
         :return: A list of all distinct values coupled with their counts
         """
 
-        aggregate = {
+        search_response = cls.search(index, cls.distinct_body(field, size))
+        return cls.distinct_from_response(search_response)
+
+    @staticmethod
+    def distinct_body(field: str, size: int = None) -> Dict[str, any]:
+        """
+        Build a search request that aggregates the distinct values of the supplied field
+
+        :param field: The field to fetch distinct values of
+        :param size: The maximum amount of values to fetch
+        :return: The search request body, parse its response with distinct_from_response
+        """
+
+        terms = {'field': field}
+        if size is not None:
+            terms['size'] = size
+
+        return {
             'size': 0,
             'aggs': {
                 '*': {
-                    'terms': {
-                        'field': field
-                    }
+                    'terms': terms
                 }
             }
         }
-        search_response = cls.client.search(index=index, body=aggregate)
+
+    @staticmethod
+    def distinct_from_response(search_response: Dict[str, any]) -> List[Tuple[str, int]]:
         return [(bucket['key'], bucket['doc_count']) for bucket in search_response['aggregations']['*']['buckets']]
 
     @classmethod
-    def get(cls, index: str, key: str, value: any) -> Optional[Tuple[Dict[str, any], int]]:
+    def enable_disk_cache(cls, path: str, indices: List[str] = None, max_age: float = 0):
+        """
+        Fetch models by primary key through an on-disk cache shared by all processes on this host, see DiskCache
+
+        Cached documents are revalidated against their _seq_no and _primary_term,
+        which only transfers the version of the document instead of all of it
+
+        :param path: The file to store the cache in, created if missing
+        :param indices: The indices to cache, best suited for rarely changing ones,
+        all if <span style="color:#0055aa">None</span>
+        :param max_age: The amount of seconds a cached document is used without revalidating it
+        """
+
+        from .disk_cache import DiskCache
+        cls._disk_cache = DiskCache(path, indices, max_age)
+
+    @classmethod
+    def enable_query_cache(cls, max_size: int = 1024, ttl: float = 60):
+        """
+        Cache responses of searches, counts and aggregations in-process, see QueryCache
+
+        Writes made by this process invalidate the cached responses of their index,
+        writes made by others only become visible once the cached responses expire
+
+        :param max_size: The maximum amount of cached responses
+        :param ttl: The amount of seconds a response stays cached
+        """
+
+        from .query_cache import QueryCache
+        cls._query_cache = QueryCache(max_size, ttl)
+
+    @classmethod
+    def enable_schema_cache(cls):
+        """
+        Fetch the mapping of each index once and use it, see SchemaCache
+
+        Primary key lookups and queries built with a schema match exact fields with term queries,
+        hydration decodes date fields into datetimes and models can be validated against their index
+        """
+
+        from .schema import SchemaCache
+        cls._schema_cache = SchemaCache()
+
+    @classmethod
+    def enable_slow_query_log(cls, threshold: float = 1.0, logger: 'logging.Logger' = None):
+        """
+        Log every request taking at least the threshold with its full body and timings, see SlowQueryLog
+
+        :param threshold: The seconds of wall time from which a request is logged
+        :param logger: The logger to log to, elastic_pdo.slow_queries if <span style="color:#0055aa">None</span>
+        """
+
+        from .instrumentation import SlowQueryLog
+        cls.disable_slow_query_log()
+        cls._slow_query_log = SlowQueryLog(threshold, logger)
+        cls.add_listener(cls._slow_query_log)
+
+    @classmethod
+    def iter_distinct(cls, index: str, field: str, page_size: int = 1000, query: Dict[str, any] = None) \
+            -> Iterator[Tuple[any, int]]:
+        """
+        Stream all distinct values of the supplied field using a paginated composite aggregation
+
+        Only a single page of values is held in memory, values come ordered by value rather than by count
+
+        :param index: The index of the models
+        :param field: The field to fetch distinct values of
+        :param page_size: The amount of values to fetch per request
+        :param query: The query to match against, if <span style="color:#0055aa">None</span> defaults to match all
+        :return: A generator of all distinct values coupled with their counts
+        """
+
+        composite = {
+            'size':    page_size,
+            'sources': [{'*': {'terms': {'field': field}}}]
+        }
+        body = {
+            'query': query or {'match_all': {}},
+            'size':  0,
+            'aggs':  {
+                '*': {
+                    'composite': composite
+                }
+            }
+        }
+
+        while True:
+            aggregation = cls.search(index, body)['aggregations']['*']
+            for bucket in aggregation['buckets']:
+                yield bucket['key']['*'], bucket['doc_count']
+
+            after_key = aggregation.get('after_key')
+            if after_key is None or len(aggregation['buckets']) < page_size:
+                return
+            composite['after'] = after_key
+
+    @classmethod
+    def get(cls, index: str, key: str, value: any, fields: List[str] = None, exclude: List[str] = None) \
+            -> Optional[Tuple[Dict[str, any], int]]:
         """
         Fetch a single model from elasticsearch based off its index and [key]=value match
 
         :param index: The index of the model
         :param key: The key to use for searching
         :param value: The value to match against
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned document
         """
 
+        # a mapped key can be looked up with a term query, which is cheaper and cacheable
+        schema = cls.schema(index)
+        if schema is not None and schema.exact_field(key) is not None:
+            from .elasticsearch_model import ElasticsearchQuery
+            clause = ElasticsearchQuery.equals(key, value, exact=True, schema=schema)
+        else:
+            clause = {'match_phrase': {key: value}}
+
         request_body_search = {
             'query': {
                 'bool': {
                     'must': [
-                        {'match_phrase': {key: value}}
+                        clause
                     ]
                 }
             }
         }
-        search_response = cls.client.search(index=index, body=request_body_search)
+        source = cls.source_filter(fields, exclude)
+        if source is not None:
+            request_body_search['_source'] = source
+
+        if cls._disk_cache is not None and cls._disk_cache.caches(index):
+            return cls._get_through_disk_cache(index, request_body_search, key, value)
+
+        search_response = cls._call('search', index, index=index, body=request_body_search)
         hits = search_response['hits']['hits']
         if not hits:
             return None
@@ -128,23 +510,27 @@ class ElasticsearchIntegration(metaclass=_Meta):
         return res, search_response['hits']['total']['value']
 
     @classmethod
-    def get_all(cls, index: str, sort: Union[Dict[str, any], List[Dict[str, any]]] = None) \
-            -> Tuple[List[Dict[str, any]], int]:
+    def get_all(cls, index: str, sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
+                fields: List[str] = None, exclude: List[str] = None) -> Tuple[List[Dict[str, any]], int]:
         """
         Fetch all models from elasticsearch based off their index
 
         :param index: The index of the models
         :param sort: The order by which to sort the documents
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned documents
         :return: The all models for the supplied index,<br>
         <b><u>This request can be slow if many items exist for the supplied index<u><b>
         """
 
-        return cls.get_matching(index, sort=sort)
+        return cls.get_matching(index, sort=sort, fields=fields, exclude=exclude)
 
     @classmethod
     def get_matching(cls, index: str, query: Dict[str, any] = None,
                      sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
-                     max_elements: int = 10000, offset: int = 0) -> Tuple[List[Dict[str, any]], int]:
+                     max_elements: int = 10000, offset: int = 0, fields: List[str] = None,
+                     exclude: List[str] = None, track_total_hits: Union[bool, int] = None) \
+            -> Tuple[List[Dict[str, any]], int]:
         """
         Fetch all models from elasticsearch based off their index that match the supplied query
 
@@ -154,28 +540,84 @@ class ElasticsearchIntegration(metaclass=_Meta):
         :param sort: The order by which to sort the documents
         :param max_elements: The maximum number of documents to return
         :param offset: The to start from during pagination
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned documents
+        :param track_total_hits: Whether (or up to what number) to accurately count the total matching documents
         """
 
-        joint = {'query': query or {'match_all': {}}}
+        joint = cls.matching_body(query, sort, max_elements, offset, fields, exclude, track_total_hits)
+        search_response = cls.search(index, joint)  # FIXME: see how to fetch more
+        # FIXME: also disable the output for the above line
+        return cls.documents_from_response(search_response)
+
+    @classmethod
+    def matching_body(cls, query: Dict[str, any] = None, sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
+                      max_elements: int = 10000, offset: int = 0, fields: List[str] = None,
+                      exclude: List[str] = None, track_total_hits: Union[bool, int] = None) -> Dict[str, any]:
+        """
+        Build the search request used by get_matching, see it for the meaning of the parameters
+
+        :return: The search request body, parse its response with documents_from_response
+        """
+
+        joint = {'query': query or {'match_all': {}}, 'size': max_elements, 'from': offset}
         if sort:
             joint['sort'] = sort if _is(type(sort), list) else [sort]
+        source = cls.source_filter(fields, exclude)
+        if source is not None:
+            joint['_source'] = source
+        if track_total_hits is not None:
+            joint['track_total_hits'] = track_total_hits
+        return joint
 
-        search_response = cls.client.search(index=index, body=joint, size=max_elements,
-                                            from_=offset)  # FIXME: see how to fetch more
-        # FIXME: also disable the output for the above line
+    @classmethod
+    def documents_from_response(cls, search_response: Dict[str, any]) -> Tuple[List[Dict[str, any]], int]:
+        """
+        Extract the documents of a search response, each marked with its meta id
+
+        :param search_response: The response of a search request
+        :return: The documents coupled with the total amount of matching documents
+        """
+
+        return cls._documents_from_hits(search_response['hits']['hits']), search_response['hits']['total']['value']
+
+    @classmethod
+    def get_by_meta_ids(cls, index: str, meta_ids: List[str], fields: List[str] = None) \
+            -> List[Optional[Dict[str, any]]]:
+        """
+        Fetch multiple models from elasticsearch in a single request based off their index and meta ids
+
+        :param index: The index of the models
+        :param meta_ids: The meta ids of the models to fetch
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :return: The documents in the order of <b><i>meta_ids</i></b>,
+        <span style="color:#0055aa">None</span> for ones that weren't found
+        """
+
+        if not meta_ids:
+            return []
+
+        params = {'_source_includes': list(fields)} if fields else {}
+        mget_response = cls._call('mget', index, index=index, body={'ids': list(meta_ids)}, **params)
         res = []
-        for hit in search_response['hits']['hits']:
-            document = hit['_source']
-            document[cls.META_ID_FIELD] = hit['_id']
+        for doc in mget_response['docs']:
+            if not doc.get('found'):
+                res.append(None)
+                continue
+
+            document = doc.get('_source', {})
+            document[cls.META_ID_FIELD] = doc['_id']
             res.append(document)
-        return res, search_response['hits']['total']['value']
+        return res
 
     @classmethod
-    def get_one(cls, index: str) -> Dict[str, any]:
+    def get_one(cls, index: str, fields: List[str] = None, exclude: List[str] = None) -> Dict[str, any]:
         """
         Fetch a single model from elasticsearch based off its index
 
         :param index: The index of the model
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned document
         :return: The first model for the supplied index<br>
         <b><u>This may change based off model modifications DO NOT rely on consistent results<u><b>
         """
@@ -186,11 +628,67 @@ class ElasticsearchIntegration(metaclass=_Meta):
             },
             'size':  1
         }
-        search_response = cls.client.search(index=index, body=request_body_search)
+        source = cls.source_filter(fields, exclude)
+        if source is not None:
+            request_body_search['_source'] = source
+
+        search_response = cls._call('search', index, index=index, body=request_body_search)
         res = search_response['hits']['hits'][0]['_source']
         res[cls.META_ID_FIELD] = search_response['hits']['hits'][0]['_id']
         return res
 
+    @classmethod
+    def msearch(cls, searches: List[Tuple[str, Dict[str, any]]]) -> List[Dict[str, any]]:
+        """
+        Run multiple searches in a single request
+
+        :param searches: The searches to run, each an index coupled with a search request body
+        :return: The responses in the order of <b><i>searches</i></b>,
+        failed searches have their failure under 'error' instead of a result
+        """
+
+        if not searches:
+            return []
+
+        # serve whatever we can from the cache and only send the rest
+        cache = cls._query_cache
+        responses: List[Optional[Dict[str, any]]] = [None] * len(searches)
+        keys: List[Optional[str]] = [None] * len(searches)
+        generations: List[Optional[Tuple[int, int]]] = [None] * len(searches)
+        if cache is not None:
+            for i, (index, search) in enumerate(searches):
+                keys[i] = cache.key('search', index, search)
+                responses[i] = cache.get(keys[i])
+                generations[i] = cache.generation(index)
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if not missing:
+            return responses
+
+        body = []
+        for i in missing:
+            body.append({'index': searches[i][0]})
+            body.append(searches[i][1])
+        indices = ','.join(dict.fromkeys(searches[i][0] for i in missing))
+        for i, response in zip(missing, cls._call('msearch', indices, body=body)['responses']):
+            responses[i] = response
+            if cache is not None and 'error' not in response:
+                cache.put(keys[i], searches[i][0], response, generations[i])
+        return responses
+
+    @classmethod
+    def profile(cls, index: str, body: Dict[str, any]) -> 'SearchProfile':
+        """
+        Run a search with elasticsearch's profiler to find out where its time goes
+
+        :param index: The index to search
+        :param body: The search request body
+        :return: The per-shard breakdown of the search, print it or look at its slowest clauses
+        """
+
+        from .profiling import SearchProfile
+        return SearchProfile(cls.search(index, body, profile=True))
+
     @classmethod
     def remove(cls, index: str, key: str, value: any):
         """
@@ -208,7 +706,8 @@ class ElasticsearchIntegration(metaclass=_Meta):
                 }
             }
         }
-        cls.client.delete_by_query(index=index, body=query)
+        cls._call('delete_by_query', index, index=index, body=query)
+        cls._invalidate(index)
 
     @classmethod
     def remove_by_meta_id(cls, index: str, meta_id: str):
@@ -219,8 +718,116 @@ class ElasticsearchIntegration(metaclass=_Meta):
         :param meta_id: The meta id for removal
         """
 
-        cls.client.delete(index=index, id=meta_id)
+        cls._call('delete', index, index=index, id=meta_id)
+        cls._invalidate(index, meta_id)
+
+    @classmethod
+    def remove_listener(cls, listener: 'Listener'):
+        """
+        Stop notifying a listener added with add_listener, does nothing if it isn't registered
+
+        :param listener: The listener to remove
+        """
+
+        with cls._listeners_lock:
+            cls._listeners = tuple(registered for registered in cls._listeners if registered != listener)
+
+    @classmethod
+    def scan(cls, index: str, query: Dict[str, any] = None, page_size: int = 1000, fields: List[str] = None,
+             exclude: List[str] = None, keep_alive: str = '1m') -> Iterator[List[Dict[str, any]]]:
+        """
+        Stream all documents matching the supplied query page by page, using a point in time and search_after
+
+        Unlike get_matching this isn't limited to 10000 documents and only holds a single page in memory
+
+        :param index: The index of the documents
+        :param query: The query to match against, if <span style="color:#0055aa">None</span> defaults to match all
+        :param page_size: The amount of documents to fetch per request
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned documents
+        :param keep_alive: How long elasticsearch should keep the point in time between pages
+        :return: A generator of pages, each a list of documents marked with their meta ids
+        """
+
+        pit_id = cls._call('open_point_in_time', index, index=index, keep_alive=keep_alive)['id']
+        try:
+            body = {
+                'query':            query or {'match_all': {}},
+                'size':             page_size,
+                'sort':             [{'_shard_doc': 'asc'}],
+                'track_total_hits': False,
+                'pit':              {'id': pit_id, 'keep_alive': keep_alive}
+            }
+            source = cls.source_filter(fields, exclude)
+            if source is not None:
+                body['_source'] = source
+
+            while True:
+                search_response = cls._call('search', index, body=body)
+                hits = search_response['hits']['hits']
+                if not hits:
+                    return
+
+                pit_id = search_response.get('pit_id', pit_id)
+                yield cls._documents_from_hits(hits)
+                if len(hits) < page_size:
+                    return
+
+                body['pit']['id'] = pit_id
+                body['search_after'] = hits[-1]['sort']
+        finally:
+            cls._call('close_point_in_time', index, body={'id': pit_id})
+
+    @classmethod
+    def schema(cls, index: str) -> Optional['IndexSchema']:
+        """
+        Get the mapped fields of an index through the schema cache
+
+        :param index: The index
+        :return: The schema of the index, <span style="color:#0055aa">None</span> if the schema cache is disabled
+        """
+
+        cache = cls._schema_cache
+        return None if cache is None else cache.get(index)
+
+    @classmethod
+    def search(cls, index: str, body: Dict[str, any], profile: bool = False) -> Dict[str, any]:
+        """
+        Run a raw search, served from the query cache when enabled
+
+        :param index: The index to search
+        :param body: The search request body
+        :param profile: Whether to run it with elasticsearch's profiler, the response then holds a profile
+        (see SearchProfile) and never comes from the cache
+        :return: The search response
+        """
+
+        if profile:
+            return cls._call('search', index, index=index, body=dict(body, profile=True))
+        return cls._cached('search', index, body)
+
+    @staticmethod
+    def source_filter(fields: List[str] = None, exclude: List[str] = None) -> Optional[Dict[str, List[str]]]:
+        """
+        Build the _source filtering clause of a search request
+
+        :param fields: The only source fields to return, all if <span style="color:#0055aa">None</span>
+        :param exclude: The source fields to leave out of the returned documents
+        :return: The value for _source or <span style="color:#0055aa">None</span> if the whole source is wanted
+        """
+
+        if not fields and not exclude:
+            return None
+
+        source = {}
+        if fields:
+            source['includes'] = list(fields)
+        if exclude:
+            source['excludes'] = list(exclude)
+        return source
 
     @classmethod
     def update_model(cls, model: 'ElasticsearchModel', data: Dict[str, any]):
-        return cls.client.update(index=model.index, body={'doc': data}, id=model.meta_id)
+        response = cls._call('update', model.index, index=model.index, body={'doc': data}, id=model.meta_id)
+        cls._invalidate(model.index, model.meta_id)
+        return response
@@ -1,15 +1,31 @@
+import weakref
 from datetime import datetime
+from fnmatch import fnmatchcase
 from types import TracebackType
-from typing import Dict, Iterable, List, Optional, Tuple, Type, TypeVar, Union
+from typing import Callable, Dict, Generic, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar, \
+    TYPE_CHECKING, Union
 
-from .util import _is, _is_builtin, _is_dunder, _is_swagger
+from .util import _is, _is_builtin, _is_dunder, _is_swagger, _require
+
+if TYPE_CHECKING:
+    import pyarrow
+    from .aggregation import ElasticsearchAggregation
+    from .profiling import SearchProfile
+    from .schema import IndexSchema
 
 _EXTENDS_ElasticsearchModel = TypeVar('_EXTENDS_ElasticsearchModel', bound='ElasticsearchModel')
+_RESULT = TypeVar('_RESULT')
+_LAZY = '_ElasticsearchModel__lazy'
 _META_ID = '_ElasticsearchModel__meta_id'
+_NOTHING_UNLOADED = frozenset()
 _PATH = '__path__'
 _OWNER = '__owner__'
 _WRAPPED = '__wrapped__'
 
+# index -> the model class declaring it, filled as model classes are defined
+_MODELS: Dict[str, Type['ElasticsearchModel']] = {}
+_DEFAULTS: Dict[type, Dict[str, any]] = {}
+
 
 # noinspection PyProtectedMember
 class _BaseElasticObject:
@@ -159,6 +175,66 @@ class ElasticObjectWrapper(_ElasticWrappedBase):
         return str(_get(self, _WRAPPED))
 
 
+def _is_projected_out(field: str, fields: Optional[List[str]], exclude: Optional[List[str]]) -> bool:
+    if exclude and any(fnmatchcase(field, pattern) for pattern in exclude):
+        return True
+
+    # including a nested path such as states.status still loads the top level field
+    return bool(fields) and not any(fnmatchcase(field, pattern) or pattern.startswith(f'{field}.')
+                                    for pattern in fields)
+
+
+def model_for_index(index: Optional[str]) -> Optional[Type['ElasticsearchModel']]:
+    """
+    Look up the model class stored in an index
+
+    :param index: The name of the index
+    :return: The last defined model class declaring the index, <span style="color:#0055aa">None</span> if there's none
+    """
+
+    return _MODELS.get(index) if index is not None else None
+
+
+def _defaults(klass: type) -> Dict[str, any]:
+    # the fields of a default constructed model, only ever read to tell what an unloaded field should hold
+    res = _DEFAULTS.get(klass)
+    if res is None:
+        res = _DEFAULTS[klass] = vars(klass())
+    return res
+
+
+def _empty_value(template: any) -> any:
+    klass = type(template)
+    if _is(klass, dict):
+        return {}
+    if _is(klass, list):
+        return []
+    if _is_swagger(klass):
+        return klass()
+    return None
+
+
+# noinspection PyProtectedMember
+class _LazyLoader:
+    """ Loads lazy fields for every model of a single result set, once per field """
+
+    def __init__(self, models: List['ElasticsearchModel']):
+        self.__models = [weakref.ref(model) for model in models]
+
+    def load(self, field: str):
+        models = [model for model in (ref() for ref in self.__models)
+                  if model is not None and model.meta_id is not None and model._is_lazy_unloaded(field)]
+        if not models:
+            return
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        documents = ElasticsearchIntegration.get_by_meta_ids(models[0].index, [model.meta_id for model in models],
+                                                            [field])
+        template = _defaults(type(models[0])).get(field)
+        for model, document in zip(models, documents):
+            model._load_lazy(field, document, template)
+
+
 # noinspection PyProtectedMember
 class ElasticsearchTransaction:
     def __init__(self, owner: 'ElasticsearchModel'):
@@ -183,6 +259,143 @@ class ElasticsearchTransaction:
         self.__owner._start_transaction()
 
 
+class ElasticsearchFuture(Generic[_RESULT]):
+    """ ElasticsearchFuture is the deferred result of a search added to an ElasticsearchBatch """
+
+    def __init__(self, parse: Callable[[Dict[str, any]], _RESULT]):
+        self.__parse = parse
+        self.__done = False
+        self.__error = None
+        self.__result = None
+
+    @property
+    def done(self) -> bool:
+        """Whether the batch this future belongs to was executed"""
+        return self.__done
+
+    def result(self) -> _RESULT:
+        """
+        Get the result of the deferred search
+
+        :return: The parsed result of the search
+        """
+
+        if not self.__done:
+            raise RuntimeError('Cannot get the result of a search before its batch was executed')
+        if self.__error is not None:
+            raise RuntimeError(f'The search failed: {self.__error}')
+        return self.__result
+
+    def _resolve(self, search_response: Dict[str, any]):
+        self.__done = True
+        if 'error' in search_response:
+            self.__error = search_response['error']
+        else:
+            self.__result = self.__parse(search_response)
+
+
+# noinspection PyProtectedMember
+class ElasticsearchBatch:
+    """
+    ElasticsearchBatch collects searches of a model and runs them in a single _msearch request
+
+    Each search returns an ElasticsearchFuture which is resolved once the batch is executed,
+    which happens automatically when leaving its <span style="color:#0055aa">with</span> block
+    """
+
+    def __init__(self, model: Type['ElasticsearchModel']):
+        self.__model = model
+        self.__searches: List[Tuple[str, Dict[str, any], ElasticsearchFuture]] = []
+
+    def __enter__(self) -> 'ElasticsearchBatch':
+        return self
+
+    def __exit__(self, ex_type: Optional[Type[BaseException]], ex_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> bool:
+        if ex_type is None:
+            self.execute()
+        return False
+
+    def __len__(self):
+        return len(self.__searches)
+
+    def count(self, query: Dict[str, any] = None, at_least: int = None) -> ElasticsearchFuture[int]:
+        """
+        Defer counting models matching the supplied query, see ElasticsearchModel.count
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        body = ElasticsearchIntegration.count_body({'term': query} if query else None, at_least)
+        return self.search(body, lambda response: response['hits']['total']['value'])
+
+    def count_matching(self, query: Dict[str, any] = None, at_least: int = None) -> ElasticsearchFuture[int]:
+        """
+        Defer counting models matching the supplied full query, see ElasticsearchIntegration.count_matching
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        body = ElasticsearchIntegration.count_body(query, at_least)
+        return self.search(body, lambda response: response['hits']['total']['value'])
+
+    def distinct(self, field: str, size: int = None) -> ElasticsearchFuture[List[Tuple[str, int]]]:
+        """
+        Defer fetching distinct values of the supplied field, see ElasticsearchModel.distinct
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        return self.search(ElasticsearchIntegration.distinct_body(field, size),
+                           ElasticsearchIntegration.distinct_from_response)
+
+    def execute(self) -> None:
+        """
+        Run all searches added so far in a single request and resolve their futures
+        """
+
+        searches, self.__searches = self.__searches, []
+        if not searches:
+            return
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        responses = ElasticsearchIntegration.msearch([(index, body) for index, body, _ in searches])
+        for (_, _, future), response in zip(searches, responses):
+            future._resolve(response)
+
+    def fetch_matching(self, query: Dict[str, any] = None, sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
+                       max_elements: int = 10000, offset: int = 0, fields: List[str] = None,
+                       exclude: List[str] = None, track_total_hits: Union[bool, int] = None) \
+            -> ElasticsearchFuture[Tuple[List['ElasticsearchModel'], int]]:
+        """
+        Defer fetching models matching the supplied query, see ElasticsearchModel.fetch_matching
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        model = self.__model
+        exclude = model._projection(fields, exclude)
+        body = ElasticsearchIntegration.matching_body(query, sort, max_elements, offset, fields, exclude,
+                                                      track_total_hits)
+
+        def parse(response: Dict[str, any]):
+            documents, count = ElasticsearchIntegration.documents_from_response(response)
+            return model._hydrate_all(documents, fields, exclude), count
+
+        return self.search(body, parse)
+
+    def search(self, body: Dict[str, any], parse: Callable[[Dict[str, any]], _RESULT] = None) \
+            -> ElasticsearchFuture[_RESULT]:
+        """
+        Defer a raw search against the index of the model
+
+        :param body: The search request body, size and from must be part of it
+        :param parse: Converts the search response into the result of the future, the raw response if not supplied
+        :return: The future to be resolved when this batch is executed
+        """
+
+        future = ElasticsearchFuture(parse or (lambda response: response))
+        index = object.__getattribute__(self.__model, f'_{self.__model.__name__}__index')
+        self.__searches.append((index, body, future))
+        return future
+
+
 class ElasticsearchQuery:
     """ ElasticsearchQuery contains useful query builders for elasticsearch """
 
@@ -195,16 +408,67 @@ class ElasticsearchQuery:
         }
 
     @staticmethod
-    def equals(field: str, value: any):
+    def equals(field: str, value: any, exact: bool = False, schema: 'IndexSchema' = None):
+        """
+        Match models whose field equals the supplied value
+
+        Booleans, numbers and dates are matched by a term query and lists by a terms query matching any of their
+        values, these don't score and can be cached by elasticsearch when used in a filter.
+        Strings are matched as a phrase of the analyzed field unless <b><i>exact</i></b>.
+        With a schema the mapped type of the field decides instead, e.g. keyword fields are always matched by term
+
+        :param field: The field to match
+        :param value: The value to match against
+        :param exact: Match strings as a whole against the keyword sub-field with a term query, e.g. for ids
+        :param schema: The schema of the index, see ElasticsearchModel.schema
+        """
+
+        if _is(type(value), list):
+            return ElasticsearchQuery.or_(field, value, schema)
+
+        if schema is not None and field in schema:
+            target = schema.exact_field(field)
+            if target is None or schema.field_type(field) == 'text' and not exact:
+                return {
+                    'match_phrase': {
+                        field: value
+                    }
+                }
+            return {
+                'term': {
+                    target: value
+                }
+            }
+
+        if isinstance(value, str):
+            if not exact:
+                return {
+                    'match_phrase': {
+                        field: value
+                    }
+                }
+            field = f'{field}.keyword'
+
         return {
-            'match_phrase': {
+            'term': {
                 field: value
             }
         }
 
     @staticmethod
-    def or_(field: str, values: List[any]):
-        if values and type(values[0]) == str:
+    def or_(field: str, values: List[any], schema: 'IndexSchema' = None):
+        if schema is not None and field in schema:
+            exact = schema.exact_field(field)
+            if exact is None:
+                # text without a keyword sub-field, each value has to be matched as a phrase
+                return {
+                    'bool': {
+                        'should': [{'match_phrase': {field: value}} for value in values],
+                        'minimum_should_match': 1
+                    }
+                }
+            field = exact
+        elif values and type(values[0]) == str:
             field = f'{field}.keyword'
 
         return {
@@ -238,6 +502,34 @@ class ElasticsearchQuery:
             }
         }
 
+    @staticmethod
+    def sort(field: str, order: str = 'asc', schema: 'IndexSchema' = None,
+             model: Type['ElasticsearchModel'] = None):
+        """
+        Order models by the supplied field, for the sort of fetch_matching
+
+        :param field: The field to sort by, or _score to order by relevance
+        :param order: asc or desc
+        :param schema: The schema of the index, text fields are then sorted by their keyword sub-field
+        :param model: The model sorted, without a schema fields it declares as strings are sorted by their keyword
+        sub-field like or_ matches them, which is where dynamic mapping puts them
+        """
+
+        if order not in ('asc', 'desc'):
+            raise ValueError(f'order must be asc or desc, got {order}')
+        if schema is not None and field in schema:
+            field = schema.exact_field(field) or field
+        elif model is not None:
+            from .columns import field_type
+            if _is(field_type(model, field), str):
+                field = f'{field}.keyword'
+
+        return {
+            field: {
+                'order': order
+            }
+        }
+
     @staticmethod
     def text(value: str):
         return {
@@ -260,7 +552,7 @@ class ElasticsearchModel(_BaseElasticObject):
     """
 
     _ATTRS_TO_INTERCEPT = ['_ElasticsearchModel__index', _META_ID, '_ElasticsearchModel__primary_key',
-                           '_ElasticsearchModel__trans']
+                           '_ElasticsearchModel__trans', '_ElasticsearchModel__unloaded', _LAZY]
 
     @classmethod
     def _add_transaction_step(cls, base, path, value):
@@ -290,17 +582,96 @@ class ElasticsearchModel(_BaseElasticObject):
             return base
 
     @classmethod
-    def count(cls, query: Dict[str, any] = None) -> int:
+    def _hydrate_all(cls: Type[_EXTENDS_ElasticsearchModel], documents: List[Dict[str, any]],
+                     fields: List[str] = None, exclude: List[str] = None) -> List[_EXTENDS_ElasticsearchModel]:
+        from .identity_map import IdentityMap
+        identity_map = IdentityMap.current()
+        if identity_map is None:
+            models = fresh = [cls().from_elastic_document(document, fields, exclude) for document in documents]
+        else:
+            from .elasticsearch_integration import ElasticsearchIntegration
+            index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+            models, fresh = [], []
+            for document in documents:
+                model = identity_map.get(index, document[ElasticsearchIntegration.META_ID_FIELD])
+                if model is None:
+                    model = cls().from_elastic_document(document, fields, exclude)
+                    identity_map.add(model)
+                    fresh.append(model)
+                elif model.unloaded_fields:
+                    model._merge_document(document, fields, exclude, _defaults(cls))
+                models.append(model)
+
+        lazy = cls._lazy_fields()
+        if (fields or exclude) and lazy and fresh:
+            loader = _LazyLoader(fresh)
+            for model in fresh:
+                model._attach_lazy_loader(loader, lazy)
+        return models
+
+    @classmethod
+    def _lazy_fields(cls) -> List[str]:
+        return getattr(cls, f'_{cls.__name__}__lazy', [])
+
+    @classmethod
+    def _projection(cls, fields: Optional[List[str]], exclude: Optional[List[str]]) -> Optional[List[str]]:
+        # lazy fields are left out unless explicitly asked for
+        if fields:
+            return exclude
+
+        lazy = [field for field in cls._lazy_fields() if not exclude or field not in exclude]
+        return list(exclude or []) + lazy or None
+
+    @classmethod
+    def aggregate(cls, query: Dict[str, any] = None) -> 'ElasticsearchAggregation':
+        """
+        Create a builder to compute multiple aggregations of models of this type in a single request
+
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :return: The builder, chain aggregations onto it and call execute
+        """
+
+        from .aggregation import ElasticsearchAggregation
+        return ElasticsearchAggregation(cls, query)
+
+    @classmethod
+    def batch(cls) -> ElasticsearchBatch:
+        """
+        Create a batch to join multiple searches of this model into a single request
+
+        :return: The batch for use within a <span style="color:#0055aa">with</span> block
+        """
+
+        return ElasticsearchBatch(cls)
+
+    @classmethod
+    def cardinality(cls, field: str, query: Dict[str, any] = None, precision_threshold: int = None) -> int:
+        """
+        Approximately counts the distinct values of the supplied field for this model
+
+        :param field: The field to count distinct values of
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :param precision_threshold: Counts below this are expected to be close to accurate
+        :return: The approximate amount of distinct values
+        """
+
+        return cls.aggregate(query).cardinality(field, precision_threshold, name='*').execute()['*']
+
+    @classmethod
+    def count(cls, query: Dict[str, any] = None, at_least: int = None) -> int:
         """
         Counts all models of this type matching the supplied query
 
         :param query: The query to match models against or <span style="color:#0055aa">True</span> if not supplied
+        :param at_least: Only count accurately up to this amount, useful for badges such as "1000+"
         :return: The amount of models matching the supplied query or total amount if no query supplied
         """
 
         from .elasticsearch_integration import ElasticsearchIntegration
         index = object.__getattribute__(cls, f'_{cls.__name__}__index')
-        return ElasticsearchIntegration.count(index, query)
+        return ElasticsearchIntegration.count(index, query, at_least=at_least)
 
     @classmethod
     def delete_static(cls, primary_key_value: any) -> None:
@@ -316,58 +687,115 @@ class ElasticsearchModel(_BaseElasticObject):
         return ElasticsearchIntegration.remove(index, primary_key, primary_key_value)
 
     @classmethod
-    def distinct(cls, field: str) -> List[Tuple[str, int]]:
+    def distinct(cls, field: str, size: int = None) -> List[Tuple[str, int]]:
         """
         Gets distinct values of the supplied field for this model from elasticsearch
 
         :param field: The field to fetch distinct values of
+        :param size: The maximum amount of values to fetch, the most common ones are kept, defaults to 10
         :return: A list of all distinct values coupled with their counts
         """
 
         from .elasticsearch_integration import ElasticsearchIntegration
         index = object.__getattribute__(cls, f'_{cls.__name__}__index')
-        return ElasticsearchIntegration.distinct(index, field)
+        return ElasticsearchIntegration.distinct(index, field, size)
 
     @classmethod
-    def fetch(cls: Type[_EXTENDS_ElasticsearchModel], primary_key_value: any = None) \
-            -> Optional[_EXTENDS_ElasticsearchModel]:
+    def fetch(cls: Type[_EXTENDS_ElasticsearchModel], primary_key_value: any = None, fields: List[str] = None,
+              exclude: List[str] = None) -> Optional[_EXTENDS_ElasticsearchModel]:
         """
         Fetches a single model from elasticsearch based off primary_key_value
 
         :param primary_key_value: The value of the primary key to search for
+        :param fields: The only fields to load, the model will be partial if supplied
+        :param exclude: The fields not to load, the model will be partial if supplied
         :return: Either the first model matching <b><i>primary_key_value</i></b> or the first model if none supplied
         """
 
         from .elasticsearch_integration import ElasticsearchIntegration
         index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+        exclude = cls._projection(fields, exclude)
 
         if primary_key_value is None:
-            return cls().from_elastic_document(ElasticsearchIntegration.get_one(index))
+            return cls._hydrate_all([ElasticsearchIntegration.get_one(index, fields, exclude)], fields, exclude)[0]
 
         primary_key = object.__getattribute__(cls, f'_{cls.__name__}__primary_key')
-        document = ElasticsearchIntegration.get(index, primary_key, primary_key_value)
+        from .identity_map import IdentityMap
+        identity_map = IdentityMap.current()
+        if identity_map is not None:
+            model = identity_map.get_by_key(index, primary_key, primary_key_value)
+            if model is not None and model._covers(fields, exclude):
+                return model
+
+        document = ElasticsearchIntegration.get(index, primary_key, primary_key_value, fields, exclude)
         if document is not None:
-            return cls().from_elastic_document(document[0])
+            return cls._hydrate_all([document[0]], fields, exclude)[0]
 
     @classmethod
-    def fetch_all(cls: Type[_EXTENDS_ElasticsearchModel], sort: Union[Dict[str, any], List[Dict[str, any]]] = None) \
+    def fetch_all(cls: Type[_EXTENDS_ElasticsearchModel], sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
+                  fields: List[str] = None, exclude: List[str] = None) \
             -> Tuple[List[_EXTENDS_ElasticsearchModel], int]:
         """
         Fetches all models of this type from elasticsearch
 
         :param sort: The order by which to sort the models
+        :param fields: The only fields to load, the models will be partial if supplied
+        :param exclude: The fields not to load, the models will be partial if supplied
         :return: A list of all models belonging to this index
         """
 
         from .elasticsearch_integration import ElasticsearchIntegration
         index = object.__getattribute__(cls, f'_{cls.__name__}__index')
-        documents, count = ElasticsearchIntegration.get_all(index, sort)
-        return [cls().from_elastic_document(document) for document in documents], count
+        exclude = cls._projection(fields, exclude)
+        documents, count = ElasticsearchIntegration.get_all(index, sort, fields, exclude)
+        return cls._hydrate_all(documents, fields, exclude), count
+
+    @classmethod
+    def fetch_columns(cls, query: Dict[str, any] = None, fields: List[str] = None, page_size: int = 10000,
+                      as_arrow: bool = False) -> Union[Dict[str, any], 'pyarrow.Table']:
+        """
+        Fetches only the supplied fields of all models matching the supplied query as columns,
+        without building models
+
+        All matching models are streamed page by page, dates become datetime64[ms] (UTC) and numeric fields become
+        int64/float64 (NaN for missing values), which allows vectorized computation over millions of models
+
+        :param query: The query to search and match against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :param fields: The fields to fetch, nested fields are separated by dots, e.g. states.status
+        :param page_size: The amount of models to fetch per request
+        :param as_arrow: Whether to return a pyarrow Table instead of a dict of numpy arrays
+        :return: A numpy array of each field in the order of the models
+        """
+
+        if not fields:
+            raise ValueError('fields must be supplied')
+
+        numpy = _require('numpy', 'fetch_columns')
+        from .columns import field_type, to_numpy, value_at
+        from .elasticsearch_integration import ElasticsearchIntegration
+        index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+        types = {field: field_type(cls, field) for field in fields}
+
+        # pages are converted as they arrive so only their arrays are kept around
+        chunks = {field: [] for field in fields}
+        for page in ElasticsearchIntegration.scan(index, query, page_size, fields=fields):
+            for field in fields:
+                chunks[field].append(to_numpy([value_at(document, field) for document in page], types[field]))
+
+        columns = {field: numpy.concatenate(field_chunks) if field_chunks else to_numpy([], types[field])
+                   for field, field_chunks in chunks.items()}
+        if not as_arrow:
+            return columns
+
+        pyarrow = _require('pyarrow', 'as_arrow')
+        return pyarrow.table({field: pyarrow.array(column) for field, column in columns.items()})
 
     @classmethod
     def fetch_matching(cls: Type[_EXTENDS_ElasticsearchModel], query: Dict[str, any] = None,
                        sort: Union[Dict[str, any], List[Dict[str, any]]] = None, max_elements: int = 10000,
-                       offset: int = 0) -> Tuple[List[_EXTENDS_ElasticsearchModel], int]:
+                       offset: int = 0, fields: List[str] = None, exclude: List[str] = None,
+                       track_total_hits: Union[bool, int] = None) -> Tuple[List[_EXTENDS_ElasticsearchModel], int]:
         """
         Fetches all models of this type from elasticsearch that match the supplied query
 
@@ -376,14 +804,144 @@ class ElasticsearchModel(_BaseElasticObject):
         :param sort: The order by which to sort the models
         :param max_elements: The maximum number of documents to return
         :param offset: The to start from during pagination
+        :param fields: The only fields to load, the models will be partial if supplied
+        :param exclude: The fields not to load, the models will be partial if supplied
+        :param track_total_hits: Whether (or up to what number) to accurately count the total matching models
         :return: A list of all models belonging to this index matching the supplied query
         """
 
         from .elasticsearch_integration import ElasticsearchIntegration
         index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+        exclude = cls._projection(fields, exclude)
         documents, count = ElasticsearchIntegration.get_matching(index, query=query, sort=sort,
-                                                                 max_elements=max_elements, offset=offset)
-        return [cls().from_elastic_document(document) for document in documents], count
+                                                                 max_elements=max_elements, offset=offset,
+                                                                 fields=fields, exclude=exclude,
+                                                                 track_total_hits=track_total_hits)
+        return cls._hydrate_all(documents, fields, exclude), count
+
+    @classmethod
+    def iter_distinct(cls, field: str, page_size: int = 1000, query: Dict[str, any] = None) \
+            -> Iterator[Tuple[any, int]]:
+        """
+        Streams all distinct values of the supplied field for this model in constant memory
+
+        :param field: The field to fetch distinct values of
+        :param page_size: The amount of values to fetch per request
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :return: A generator of all distinct values coupled with their counts, ordered by value
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+        return ElasticsearchIntegration.iter_distinct(index, field, page_size, query)
+
+    @classmethod
+    def percentile_ranks(cls, field: str, values: List[float], query: Dict[str, any] = None) \
+            -> Dict[float, Optional[float]]:
+        """
+        Approximates the percentage of values of the supplied numeric field below each of the supplied values
+
+        :param field: The field to rank values of
+        :param values: The values to rank
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :return: The percentage of each value
+        """
+
+        return cls.aggregate(query).percentile_ranks(field, values, name='*').execute()['*']
+
+    @classmethod
+    def percentiles(cls, field: str, percents: List[float] = None, query: Dict[str, any] = None) \
+            -> Dict[float, Optional[float]]:
+        """
+        Approximates percentiles of the supplied numeric field for this model
+
+        :param field: The field to compute percentiles of
+        :param percents: The percentiles to compute, e.g. [50, 95, 99]
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :return: The value of each percentile
+        """
+
+        return cls.aggregate(query).percentiles(field, percents, name='*').execute()['*']
+
+    @classmethod
+    def profile(cls, query: Dict[str, any] = None, sort: Union[Dict[str, any], List[Dict[str, any]]] = None,
+                max_elements: int = 10, track_total_hits: Union[bool, int] = None) -> 'SearchProfile':
+        """
+        Profiles the search fetch_matching would make with elasticsearch's profiler, to find which clause is slow
+
+        :param query: The query to search and match against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :param sort: The order by which to sort the models
+        :param max_elements: The maximum number of documents to return
+        :param track_total_hits: Whether (or up to what number) to accurately count the total matching models
+        :return: The per-shard breakdown of the search, print it or look at its slowest clauses
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+        body = ElasticsearchIntegration.matching_body(query, sort, max_elements, track_total_hits=track_total_hits)
+        return ElasticsearchIntegration.profile(index, body)
+
+    @classmethod
+    def schema(cls) -> Optional['IndexSchema']:
+        """
+        Gets the mapped fields of the index of this model, for building queries with ElasticsearchQuery
+
+        :return: The schema, <span style="color:#0055aa">None</span> unless the schema cache is enabled
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        return ElasticsearchIntegration.schema(object.__getattribute__(cls, f'_{cls.__name__}__index'))
+
+    @classmethod
+    def time_series(cls, field: str, interval: str, query: Dict[str, any] = None, time_zone: str = None,
+                    metrics: List[Tuple[str, str]] = None, min_doc_count: int = 0,
+                    extended_bounds: Tuple[any, any] = None, as_numpy: bool = False) -> Dict[str, any]:
+        """
+        Computes a time series of models of this type with a single date_histogram aggregation
+
+        :param field: The date field to bucket models by
+        :param interval: The size of each bucket, e.g. 1h, 1d or 30m
+        :param query: The query to match models against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :param time_zone: The time zone buckets are aligned to, as an offset such as +03:00 or a zone id
+        :param metrics: Metrics to compute per bucket as (kind, field) pairs, e.g. [('sum', 'duration')]
+        :param min_doc_count: The minimal amount of models in a bucket for it to be returned
+        :param extended_bounds: The (min, max) the series should span even if there are no models at its edges
+        :param as_numpy: Whether to return numpy arrays (datetime64 keys) instead of lists
+        :return: The series as parallel arrays under key, doc_count and kind_field of each metric,
+        keys are the UTC starts of the buckets regardless of the time zone
+        """
+
+        return cls.aggregate(query).date_histogram(field, interval, time_zone, metrics, min_doc_count,
+                                                   extended_bounds, as_numpy, name='*').execute()['*']
+
+    @classmethod
+    def validate_schema(cls) -> None:
+        """
+        Checks that every field of this model is mapped in its index, requires the schema cache
+
+        Fields that were never set on any document aren't mapped by dynamic mapping either
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        cache = ElasticsearchIntegration.schema_cache
+        if cache is None:
+            raise RuntimeError('Validating a schema requires ElasticsearchIntegration.enable_schema_cache()')
+
+        missing = cache.missing_fields(cls)
+        if missing:
+            index = object.__getattribute__(cls, f'_{cls.__name__}__index')
+            raise ValueError(f'{cls.__name__} has fields that are not mapped in {index}: {", ".join(missing)}')
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        index = cls.__dict__.get(f'_{cls.__name__}__index')
+        if index is not None:
+            _MODELS[index] = cls
 
     def __init__(self):
         super().__init__()
@@ -391,6 +949,8 @@ class ElasticsearchModel(_BaseElasticObject):
         self.__primary_key = self.__getattribute__(f'_{type(self).__name__}__primary_key')
         self.__trans = None
         self.__meta_id = None
+        self.__unloaded = _NOTHING_UNLOADED
+        self.__lazy = None
 
     @property
     def index(self) -> str:
@@ -407,15 +967,34 @@ class ElasticsearchModel(_BaseElasticObject):
         """The primary key of this model used for most searches"""
         return self.__primary_key
 
+    @property
+    def unloaded_fields(self) -> frozenset:
+        """The fields that were left out when this model was fetched, these cannot be updated"""
+        return frozenset(self.__unloaded)
+
     def __getattribute__(self, attr):
         res = object.__getattribute__(self, attr)
         return res if _is_dunder(attr) or attr in ElasticsearchModel._ATTRS_TO_INTERCEPT \
             else _wrap_if_needed(self, _AttrKey(attr), res)
 
+    def __getattr__(self, attr):
+        # only reached for missing attributes, which is how lazy fields that weren't loaded yet look
+        loader = None if attr == _LAZY else object.__getattribute__(self, _LAZY)
+        if loader is None or not self._is_lazy_unloaded(attr):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{attr}'")
+
+        loader.load(attr)
+        return self.__getattribute__(attr)
+
     def __setattr__(self, attr, value):
+        synced = not _is_dunder(attr) and attr not in ElasticsearchModel._ATTRS_TO_INTERCEPT \
+            and self.__meta_id is not None
+        if synced:
+            self._check_loaded(attr)
+
         object.__setattr__(self, attr, value)
 
-        if not _is_dunder(attr) and attr not in ElasticsearchModel._ATTRS_TO_INTERCEPT and self.__meta_id is not None:
+        if synced:
             trans = self.__trans
             if trans is not None:
                 trans.append(([_AttrKey(attr)], value))
@@ -450,18 +1029,27 @@ class ElasticsearchModel(_BaseElasticObject):
 
         from .elasticsearch_integration import ElasticsearchIntegration
         ElasticsearchIntegration.remove_by_meta_id(self.index, self.__meta_id)
+
+        from .identity_map import IdentityMap
+        identity_map = IdentityMap.current()
+        if identity_map is not None:
+            identity_map.discard(self)
         self.__meta_id = None
 
-    def from_elastic_document(self, dikt: Dict[str, any]) -> 'ElasticsearchModel':
+    def from_elastic_document(self, dikt: Dict[str, any], fields: List[str] = None,
+                              exclude: List[str] = None) -> 'ElasticsearchModel':
         """
         Load values from the supplied elasticsearch document into this model
 
         :param dikt: The elasticsearch document to load values from
+        :param fields: The only source fields the document was fetched with, if any
+        :param exclude: The source fields the document was fetched without, these cannot be updated
         :return: Self for chaining
         """
 
         if self.__trans is not None:
             raise RuntimeError('Cannot load from elasticsearch during a transaction')
+        self.__lazy = None
 
         # unset all previous values
         attrs_old = dict(vars(self))
@@ -474,25 +1062,22 @@ class ElasticsearchModel(_BaseElasticObject):
         self.__meta_id = dikt[ElasticsearchIntegration.META_ID_FIELD]
         del dikt[ElasticsearchIntegration.META_ID_FIELD]
 
-        # set values based off the provided dictionary
+        # set values based off the provided dictionary, the mapping (if known) decides over the python types
+        schema = ElasticsearchIntegration.schema(self.__index)
         for k, v in dikt.items():
             if k in attrs_old and _is_swagger(type(attrs_old[k])):
                 object.__setattr__(self, k, type(attrs_old[k]).from_dict(v))
             else:
-                object.__setattr__(self, k, v)
+                object.__setattr__(self, k, v if schema is None else schema.decode(k, v))
 
         # any values that don't exist in elasticsearch will be set to None or empty version
+        unloaded = set()
         for k, v in attrs_old.items():
             if not hasattr(self, k):
-                klass = type(v)
-                value_empty = None
-                if _is(klass, dict):
-                    value_empty = {}
-                elif _is(klass, list):
-                    value_empty = []
-                elif _is_swagger(klass):
-                    value_empty = klass()
-                object.__setattr__(self, k, value_empty)
+                if _is_projected_out(k, fields, exclude):
+                    unloaded.add(k)
+                object.__setattr__(self, k, _empty_value(v))
+        self.__unloaded = unloaded or _NOTHING_UNLOADED
 
         return self
 
@@ -523,6 +1108,45 @@ class ElasticsearchModel(_BaseElasticObject):
                 f'Cannot start a transaction on {self.__class__.__name__} before connecting it to elastic')
         return ElasticsearchTransaction(self)
 
+    def _attach_lazy_loader(self, loader: _LazyLoader, lazy: List[str]):
+        fields = [field for field in lazy if field in self.__unloaded]
+        if not fields:
+            return
+
+        for field in fields:
+            object.__delattr__(self, field)
+        self.__lazy = loader
+
+    def _check_loaded(self, attr: str):
+        if attr in self.__unloaded:
+            # overwriting a lazy field entirely doesn't require knowing its previous value
+            if self._is_lazy_unloaded(attr):
+                self.__unloaded.discard(attr)
+                return
+            raise RuntimeError(f'Cannot update {attr} of {self.__class__.__name__} as it was not fetched')
+
+    def _covers(self, fields: Optional[List[str]], exclude: Optional[List[str]]) -> bool:
+        # whether every field wanted by the projection is either loaded or lazily loadable
+        return all(_is_projected_out(field, fields, exclude) or self._is_lazy_unloaded(field)
+                   for field in self.__unloaded)
+
+    def _is_lazy_unloaded(self, attr: str) -> bool:
+        return self.__lazy is not None and attr in self.__unloaded and attr in type(self)._lazy_fields()
+
+    def _load_lazy(self, field: str, document: Optional[Dict[str, any]], template: any):
+        if document is not None and field in document:
+            value = document[field]
+            if _is_swagger(type(template)):
+                value = type(template).from_dict(value)
+            else:
+                from .elasticsearch_integration import ElasticsearchIntegration
+                schema = ElasticsearchIntegration.schema(self.__index)
+                value = value if schema is None else schema.decode(field, value)
+            object.__setattr__(self, field, value)
+        else:
+            object.__setattr__(self, field, _empty_value(template))
+        self.__unloaded.discard(field)
+
     def _apply_transaction(self):
         transaction: list = self.__trans
         self.__trans = None
@@ -537,8 +1161,16 @@ class ElasticsearchModel(_BaseElasticObject):
     def _start_transaction(self):
         self.__trans = []
 
+    def _merge_document(self, dikt: Dict[str, any], fields: Optional[List[str]], exclude: Optional[List[str]],
+                        template: Dict[str, any]):
+        # fill in the fields this model is missing and the document has, loaded fields keep their local values
+        for field in list(self.__unloaded):
+            if not _is_projected_out(field, fields, exclude):
+                self._load_lazy(field, dikt, template.get(field))
+
     def _notify_child_update(self, path: List[Tuple[any, type]], value: any):
         if self.__meta_id is not None:
+            self._check_loaded(path[0][0].key)
             trans = self.__trans
             if trans is not None:
                 trans.append((path, value))
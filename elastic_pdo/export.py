@@ -0,0 +1,212 @@
+import json
+import os
+import queue
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Type, TYPE_CHECKING, TypeVar
+
+from .elasticsearch_integration import ElasticsearchIntegration
+from .util import _require
+
+if TYPE_CHECKING:
+    import pyarrow
+    from .elasticsearch_model import ElasticsearchModel
+
+_T = TypeVar('_T')
+_DONE = object()
+
+
+def _prefetch(iterator: Iterator[_T], depth: int) -> Iterator[_T]:
+    # fetch the next pages while the current one is being written
+    pages = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item: any) -> bool:
+        # gives up once the consumer is gone, which may happen while the queue is full
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in iterator:
+                if not put(page):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(e)
+        finally:
+            # e.g. closes the point in time of a scan left early
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    producer = threading.Thread(target=produce, name='ModelExporter', daemon=True)
+    producer.start()
+    try:
+        while True:
+            page = pages.get()
+            if page is _DONE:
+                return
+            if isinstance(page, BaseException):
+                raise page
+            yield page
+    finally:
+        stop.set()
+        producer.join()
+
+
+class ModelExporter:
+    """
+    ModelExporter streams an entire index (or the models matching a query) into NDJSON or Parquet files
+
+    Documents are never turned into models, pages are fetched through a point in time while the previous one is
+    written, and the output is split into files of roughly max_file_bytes named prefix-00000.ndjson and so on
+    """
+
+    FORMATS = ('ndjson', 'parquet')
+
+    def __init__(self, model: Type['ElasticsearchModel'], directory: str, file_format: str = 'ndjson',
+                 prefix: str = None, max_file_bytes: int = 1 << 30, page_size: int = 5000,
+                 query: Dict[str, any] = None, fields: List[str] = None, include_meta_id: bool = False,
+                 schema: 'pyarrow.Schema' = None):
+        """
+        :param model: The model whose index to export
+        :param directory: The directory to write the files into, created if missing
+        :param file_format: Either ndjson or parquet, the latter requires pyarrow
+        :param prefix: The prefix of the file names, the index by default
+        :param max_file_bytes: The size after which a new file is started
+        :param page_size: The amount of documents to fetch per request
+        :param query: The query to match documents against, if <span style="color:#0055aa">None</span> defaults to
+        match all
+        :param fields: The only fields to export, all if <span style="color:#0055aa">None</span>
+        :param include_meta_id: Whether to export the meta id of each document under the meta id field
+        :param schema: The Arrow schema of parquet files, derived from the model if not supplied, see arrow_schema
+        """
+
+        if file_format not in self.FORMATS:
+            raise ValueError(f'file_format must be one of {self.FORMATS}')
+        if file_format == 'parquet':
+            # rather than after the export already started
+            _require('pyarrow', 'parquet export')
+
+        self.__model = model
+        self.__index = object.__getattribute__(model, f'_{model.__name__}__index')
+        self.__directory = directory
+        self.__file_format = file_format
+        self.__prefix = prefix or self.__index
+        self.__max_file_bytes = max_file_bytes
+        self.__page_size = page_size
+        self.__query = query
+        self.__fields = fields
+        self.__include_meta_id = include_meta_id
+        self.__schema = schema
+
+    def run(self, progress: Callable[[int, List[str]], None] = None) -> List[str]:
+        """
+        Export all matching documents
+
+        :param progress: Called after every page with the amount of documents exported so far and the files written
+        :return: The paths of the written files
+        """
+
+        os.makedirs(self.__directory, exist_ok=True)
+        pages = _prefetch(ElasticsearchIntegration.scan(self.__index, self.__query, self.__page_size,
+                                                        fields=self.__fields), 2)
+        if self.__file_format == 'ndjson':
+            return self.__run_ndjson(pages, progress)
+        return self.__run_parquet(pages, progress)
+
+    def __path(self, files: List[str]) -> str:
+        path = os.path.join(self.__directory, f'{self.__prefix}-{len(files):05d}.{self.__file_format}')
+        files.append(path)
+        return path
+
+    def __strip(self, page: List[Dict[str, any]]) -> List[Dict[str, any]]:
+        if not self.__include_meta_id:
+            for document in page:
+                document.pop(ElasticsearchIntegration.META_ID_FIELD, None)
+        return page
+
+    def __run_ndjson(self, pages: Iterator[List[Dict[str, any]]], progress: Optional[Callable]) -> List[str]:
+        files, exported = [], 0
+        file, written = None, 0
+        try:
+            for page in pages:
+                lines = ''.join(json.dumps(document, separators=(',', ':'), default=str) + '\n'
+                                for document in self.__strip(page)).encode('utf-8')
+                if file is None or written >= self.__max_file_bytes:
+                    if file is not None:
+                        file.close()
+                    file, written = open(self.__path(files), 'wb'), 0
+
+                file.write(lines)
+                written += len(lines)
+                exported += len(page)
+                if progress is not None:
+                    progress(exported, files)
+        finally:
+            if file is not None:
+                file.close()
+        return files
+
+    def __run_parquet(self, pages: Iterator[List[Dict[str, any]]], progress: Optional[Callable]) -> List[str]:
+        import pyarrow
+        from pyarrow import parquet
+        from .columns import arrow_schema
+
+        schema = self.__schema or arrow_schema(self.__model, self.__fields)
+        if self.__include_meta_id and ElasticsearchIntegration.META_ID_FIELD not in schema.names:
+            schema = schema.append(pyarrow.field(ElasticsearchIntegration.META_ID_FIELD, pyarrow.string()))
+
+        files, exported = [], 0
+        writer, path = None, None
+        try:
+            for page in pages:
+                batch = pyarrow.RecordBatch.from_pylist(self.__prepare(self.__strip(page), schema), schema=schema)
+                if writer is None or os.path.getsize(path) >= self.__max_file_bytes:
+                    if writer is not None:
+                        writer.close()
+                    path = self.__path(files)
+                    writer = parquet.ParquetWriter(path, schema)
+
+                writer.write_batch(batch)
+                exported += len(page)
+                if progress is not None:
+                    progress(exported, files)
+        finally:
+            if writer is not None:
+                writer.close()
+        return files
+
+    @staticmethod
+    def __prepare(page: List[Dict[str, any]], schema: 'pyarrow.Schema') -> List[Dict[str, any]]:
+        # arrow can't parse dates itself and fields without a type are kept as json
+        import pyarrow
+        from dateutil import parser
+        dates = [field.name for field in schema if pyarrow.types.is_timestamp(field.type)]
+        jsons = [field.name for field in schema if field.metadata and field.metadata.get(b'encoding') == b'json']
+        integers = [field.name for field in schema if pyarrow.types.is_integer(field.type)]
+        if not dates and not jsons and not integers:
+            return page
+
+        for document in page:
+            # arrow truncates fractions silently
+            for name in integers:
+                value = document.get(name)
+                if isinstance(value, float) and not value.is_integer():
+                    raise ValueError(f'{name} holds {value} which its integer column would truncate, '
+                                     f'map it as a double or pass a schema')
+            for name in dates:
+                value = document.get(name)
+                if isinstance(value, str):
+                    document[name] = parser.isoparse(value)
+                elif isinstance(value, (int, float)):
+                    document[name] = int(value)
+            for name in jsons:
+                if name in document:
+                    document[name] = json.dumps(document[name], default=str)
+        return page
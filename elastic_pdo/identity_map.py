@@ -0,0 +1,111 @@
+from contextvars import ContextVar, Token
+from types import TracebackType
+from typing import Dict, List, Optional, Tuple, Type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchModel
+
+_CURRENT: ContextVar[Optional['IdentityMap']] = ContextVar('elastic_pdo_identity_map', default=None)
+
+
+class IdentityMap:
+    """
+    IdentityMap makes each document be hydrated into a single model while it is active
+
+    Use it within a <span style="color:#0055aa">with</span> block around a unit of work (e.g. a request handler),
+    fetching a document that was already hydrated returns the same model instead of a divergent copy,
+    fetching by a primary key that was already seen doesn't even reach elasticsearch.
+    The active map is held in a context variable so threads and asyncio tasks each get their own
+    """
+
+    def __init__(self):
+        self.__models: Dict[Tuple[str, str], 'ElasticsearchModel'] = {}
+        self.__meta_ids_by_key: Dict[Tuple[str, str, any], str] = {}
+        self.__tokens: List[Token] = []
+
+    def __contains__(self, model: 'ElasticsearchModel'):
+        return self.__models.get((model.index, model.meta_id)) is model
+
+    def __enter__(self) -> 'IdentityMap':
+        self.__tokens.append(_CURRENT.set(self))
+        return self
+
+    def __exit__(self, ex_type: Optional[Type[BaseException]], ex_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> bool:
+        _CURRENT.reset(self.__tokens.pop())
+        return False
+
+    def __len__(self):
+        return len(self.__models)
+
+    @staticmethod
+    def current() -> Optional['IdentityMap']:
+        """
+        Get the identity map active in the current context
+
+        :return: The active identity map or <span style="color:#0055aa">None</span> if there is none
+        """
+
+        return _CURRENT.get()
+
+    def add(self, model: 'ElasticsearchModel') -> None:
+        """
+        Track a model that was fetched from elasticsearch
+
+        :param model: The model to track, must have a meta id
+        """
+
+        if model.meta_id is None:
+            raise RuntimeError(f"Cannot track a {model.__class__.__name__} that wasn't fetched from elasticsearch")
+
+        self.__models[(model.index, model.meta_id)] = model
+        value = vars(model).get(model.primary_key)
+        if value is not None:
+            self.__meta_ids_by_key[(model.index, model.primary_key, value)] = model.meta_id
+
+    def clear(self) -> None:
+        """
+        Stop tracking all models
+        """
+
+        self.__models.clear()
+        self.__meta_ids_by_key.clear()
+
+    def discard(self, model: 'ElasticsearchModel') -> None:
+        """
+        Stop tracking a model, e.g. once it was deleted
+
+        :param model: The model to stop tracking
+        """
+
+        if model in self:
+            del self.__models[(model.index, model.meta_id)]
+
+    def get(self, index: str, meta_id: str) -> Optional['ElasticsearchModel']:
+        """
+        Get the tracked model of a document
+
+        :param index: The index of the document
+        :param meta_id: The meta id of the document
+        :return: The tracked model or <span style="color:#0055aa">None</span> if not tracked
+        """
+
+        return self.__models.get((index, meta_id))
+
+    def get_by_key(self, index: str, key: str, value: any) -> Optional['ElasticsearchModel']:
+        """
+        Get the tracked model with the supplied [key]=value
+
+        :param index: The index of the model
+        :param key: The field the model was tracked by, its primary key
+        :param value: The value of the field
+        :return: The tracked model or <span style="color:#0055aa">None</span> if not tracked
+        """
+
+        meta_id = self.__meta_ids_by_key.get((index, key, value))
+        model = None if meta_id is None else self.__models.get((index, meta_id))
+
+        # the key may have been changed locally since the model was tracked
+        if model is None or vars(model).get(key) != value:
+            return None
+        return model
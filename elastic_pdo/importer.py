@@ -0,0 +1,175 @@
+import gzip
+import json
+import os
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Type, TYPE_CHECKING, Union
+
+from .elasticsearch_integration import ElasticsearchIntegration, _BulkClient
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchModel
+
+
+class ImportResult(NamedTuple):
+    """
+    The outcome of an import, errors holds the first max_errors failures,
+    bulk item errors as elasticsearch reports them and lines rejected by validation alike
+    """
+    imported: int
+    failed: int
+    skipped: int
+    errors: List[Dict[str, any]]
+
+
+class ImportProgress(NamedTuple):
+    imported: int
+    failed: int
+    skipped: int
+    bytes_read: int
+    total_bytes: int
+
+
+class ModelImporter:
+    """
+    ModelImporter loads NDJSON dumps (one document per line, e.g. written by ModelExporter) into a model's index
+
+    Files are streamed line by line and fed into the bulk helpers a chunk at a time, so memory stays bounded by
+    chunk_size regardless of the size of the dump. Unless a transform, validation or models are asked for, lines
+    are sent as is without being parsed
+    """
+
+    def __init__(self, model: Type['ElasticsearchModel'], chunk_size: int = 1000,
+                 max_chunk_bytes: int = 50 * 1024 * 1024,
+                 transform: Callable[[Dict[str, any]], Optional[Dict[str, any]]] = None,
+                 validate: bool = False, through_models: bool = False, keep_meta_ids: bool = False,
+                 max_errors: int = 100):
+        """
+        :param model: The model whose index to import into
+        :param chunk_size: The amount of documents per bulk request
+        :param max_chunk_bytes: The maximal size of a bulk request
+        :param transform: Called with every parsed document, returns the document to index
+        or <span style="color:#0055aa">None</span> to skip it
+        :param validate: Whether to reject documents holding fields the model doesn't declare,
+        these count as failed and the import goes on
+        :param through_models: Whether to round trip every document through the model, slow but normalizes them
+        :param keep_meta_ids: Whether to index documents under the meta id they were exported with
+        :param max_errors: The amount of failures to keep in the result
+        """
+
+        self.__model = model
+        self.__index = object.__getattribute__(model, f'_{model.__name__}__index')
+        self.__chunk_size = chunk_size
+        self.__max_chunk_bytes = max_chunk_bytes
+        self.__transform = transform
+        self.__through_models = through_models
+        self.__keep_meta_ids = keep_meta_ids
+        self.__max_errors = max_errors
+        self.__fields = None
+        if validate:
+            from .columns import model_field_types
+            self.__fields = set(model_field_types(model))
+
+        self.__skipped = 0
+        self.__failed = 0
+        self.__errors: List[Dict[str, any]] = []
+
+    def run(self, *paths: str, progress: Callable[[ImportProgress], None] = None,
+            progress_every: int = 10000) -> ImportResult:
+        """
+        Import the documents of the supplied files, files ending with .gz are decompressed on the fly
+
+        :param paths: The NDJSON files to import
+        :param progress: Called every progress_every documents and once done
+        :param progress_every: The amount of documents between progress reports
+        :return: The amount of imported, failed and skipped documents
+        """
+
+        from elasticsearch import helpers
+        total_bytes = sum(os.path.getsize(path) for path in paths)
+        read = [0]
+        imported = 0
+        self.__skipped = self.__failed = 0
+        self.__errors = []
+
+        def report():
+            if progress is not None:
+                progress(ImportProgress(imported, self.__failed, self.__skipped, read[0], total_bytes))
+
+        try:
+            for ok, item in helpers.streaming_bulk(_BulkClient(), self.__actions(paths, read),
+                                                   chunk_size=self.__chunk_size,
+                                                   max_chunk_bytes=self.__max_chunk_bytes,
+                                                   raise_on_error=False, index=self.__index):
+                if ok:
+                    imported += 1
+                else:
+                    self.__fail(item)
+
+                if (imported + self.__failed) % progress_every == 0:
+                    report()
+        finally:
+            ElasticsearchIntegration._invalidate(self.__index)
+
+        report()
+        return ImportResult(imported, self.__failed, self.__skipped, self.__errors)
+
+    def __fail(self, item: Dict[str, any]):
+        self.__failed += 1
+        if len(self.__errors) < self.__max_errors:
+            self.__errors.append(item)
+
+    def __actions(self, paths: List[str], read: List[int]) -> Iterator[Union[str, Dict[str, any]]]:
+        raw = self.__transform is None and self.__fields is None and not self.__through_models \
+            and not self.__keep_meta_ids
+
+        meta_id_field = f'"{ElasticsearchIntegration.META_ID_FIELD}"'.encode('utf-8')
+
+        # gzip reports its position in decompressed bytes, so progress is tracked through the raw file
+        for path in paths:
+            start = read[0]
+            with open(path, 'rb') as raw_file:
+                file = gzip.GzipFile(fileobj=raw_file) if path.endswith('.gz') else raw_file
+                for number, line in enumerate(file, 1):
+                    read[0] = start + raw_file.tell()
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    if raw and meta_id_field not in line:
+                        # the bulk helpers index strings as they are
+                        yield line.decode('utf-8')
+                        continue
+
+                    failed = self.__failed
+                    action = self.__action(json.loads(line), path, number)
+                    if action is not None:
+                        yield action
+                    elif self.__failed == failed:
+                        self.__skipped += 1
+
+    def __action(self, document: Dict[str, any], path: str, number: int) -> Optional[Dict[str, any]]:
+        meta_id = document.pop(ElasticsearchIntegration.META_ID_FIELD, None)
+        if self.__transform is not None:
+            document = self.__transform(document)
+            if document is None:
+                return None
+
+        if self.__fields is not None:
+            unknown = set(document) - self.__fields
+            if unknown:
+                # reported like the bulk item errors, raising here would abort an import already under way
+                self.__fail({'index': {'_index': self.__index, '_id': meta_id, 'status': 400, 'error': {
+                    'type':   'unknown_fields_exception',
+                    'reason': f'{path}:{number} holds fields {sorted(unknown)} not declared by '
+                              f'{self.__model.__name__}'
+                }}})
+                return None
+
+        if self.__through_models:
+            # hydrating requires a meta id, the model doesn't carry it back into the document
+            hydrated = dict(document, **{ElasticsearchIntegration.META_ID_FIELD: meta_id})
+            document = self.__model().from_elastic_document(hydrated).to_elastic_document()
+
+        action = {'_source': document}
+        if self.__keep_meta_ids and meta_id is not None:
+            action['_id'] = meta_id
+        return action
@@ -0,0 +1,360 @@
+"""
+Observe the requests the library makes to elasticsearch
+
+Every client call of ElasticsearchIntegration emits a RequestEvent to the listeners registered with
+ElasticsearchIntegration.add_listener, RequestCollector is a listener aggregating them in-process:
+
+    collector = RequestCollector().install()
+    Cdr.fetch('session-1')
+    print(collector.prometheus())
+"""
+
+import bisect
+import json
+import logging
+import threading
+from types import TracebackType
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchModel
+
+# seconds, the buckets of the prometheus client libraries stretched down to a millisecond
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+
+
+class RequestEvent(NamedTuple):
+    """
+    A single request made to elasticsearch
+
+    body is the request body as handed to the client and response the response it returned,
+    <span style="color:#0055aa">None</span> if it failed. request_bytes and response_bytes are the sizes of the
+    bodies as json, the client doesn't expose what went over the wire, they're only computed when read so listeners
+    that don't need them don't pay for serializing every response. took is in milliseconds as reported by
+    elasticsearch, wall_time is in seconds as measured around the client call. hits is the amount of documents
+    the response carries (or the bulk request holds), <span style="color:#0055aa">None</span> for requests that
+    don't deal in documents
+    """
+
+    operation: str
+    index: Optional[str]
+    model: Optional[Type['ElasticsearchModel']]
+    body: any
+    response: any
+    took: Optional[int]
+    wall_time: float
+    hits: Optional[int]
+    error: Optional[BaseException] = None
+
+    @property
+    def request_bytes(self) -> int:
+        return _size(self.body)
+
+    @property
+    def response_bytes(self) -> int:
+        return _size(self.response)
+
+
+Listener = Callable[[RequestEvent], None]
+
+
+def _size(body: any) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, str):
+        return len(body.encode())
+    if isinstance(body, bytes):
+        return len(body)
+    if isinstance(body, (list, tuple)):
+        # msearch and bulk bodies are newline delimited
+        return sum(_size(line) + 1 for line in body)
+    return len(json.dumps(body, default=str).encode())
+
+
+def _hits(operation: str, response: Dict[str, any]) -> Optional[int]:
+    if operation == 'search':
+        return len(response['hits']['hits']) if 'hits' in response else None
+    if operation == 'msearch':
+        return sum(len(r['hits']['hits']) for r in response.get('responses', []) if 'hits' in r)
+    if operation == 'mget':
+        return sum(1 for doc in response.get('docs', []) if doc.get('found'))
+    if operation == 'bulk':
+        return len(response.get('items', []))
+    if operation == 'delete_by_query':
+        return response.get('deleted')
+    return None
+
+
+def _event(operation: str, index: Optional[str], body: any, response: any, wall_time: float,
+           error: BaseException = None) -> RequestEvent:
+    from .elasticsearch_model import model_for_index
+
+    took = hits = None
+    if isinstance(response, dict):
+        took = response.get('took')
+        hits = _hits(operation, response)
+    return RequestEvent(operation, index, model_for_index(index), body, response, took, wall_time, hits, error)
+
+
+def emit(listeners: Iterable[Listener], operation: str, index: Optional[str], body: any, response: any,
+         wall_time: float, error: BaseException = None):
+    """
+    Build the event of a request and hand it to every listener, exceptions raised by listeners propagate
+
+    :param listeners: The listeners to notify
+    :param operation: The name of the client method called, e.g. search or indices.get_mapping
+    :param index: The index the request targeted, <span style="color:#0055aa">None</span> if it wasn't bound to one
+    :param body: The body of the request
+    :param response: The response of the request, <span style="color:#0055aa">None</span> if it failed
+    :param wall_time: The seconds the client call took
+    :param error: The exception the client call raised if it failed
+    """
+
+    event = _event(operation, index, body, response, wall_time, error)
+    for listener in listeners:
+        listener(event)
+
+
+class Histogram:
+    """
+    A cumulative histogram over fixed bucket upper bounds, in the manner of prometheus
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[float, int]]:
+        """
+        :return: Each upper bound coupled with the amount of observations up to it, ending with +Inf
+        """
+
+        res, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            res.append((bound, total))
+        return res
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile by interpolating linearly within its bucket, like prometheus' histogram_quantile
+
+        :param q: The quantile, between 0 and 1
+        :return: The estimate, nan without observations and the highest bound if it falls in the +Inf bucket
+        """
+
+        if not self.count:
+            return float('nan')
+
+        rank = q * self.count
+        lower, below = 0.0, 0
+        for bound, total in self.cumulative():
+            if total >= rank:
+                if bound == float('inf'):
+                    return self.buckets[-1] if self.buckets else float('nan')
+                in_bucket = total - below
+                return lower + (bound - lower) * ((rank - below) / in_bucket if in_bucket else 0)
+            lower, below = bound, total
+        return float('nan')
+
+
+class _Series:
+    def __init__(self, buckets: Sequence[float]):
+        self.requests = 0
+        self.errors = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.hits = 0
+        self.wall_time = Histogram(buckets)
+        self.took = Histogram(buckets)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class RequestCollector:
+    """
+    Aggregate request events in-process into counters and latency histograms per operation, index and model
+
+    Install it as a listener of ElasticsearchIntegration, then dump it or export it in prometheus' text format
+    """
+
+    LABELS = ('operation', 'index', 'model')
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        """
+        :param buckets: The upper bounds in seconds of the wall time and took histograms
+        """
+
+        self.__buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__series: Dict[Tuple[str, str, str], _Series] = {}
+
+    def __call__(self, event: RequestEvent):
+        key = (event.operation, event.index or '', event.model.__name__ if event.model is not None else '')
+        with self.__lock:
+            series = self.__series.get(key)
+            if series is None:
+                series = self.__series[key] = _Series(self.__buckets)
+            series.requests += 1
+            series.request_bytes += event.request_bytes
+            series.response_bytes += event.response_bytes
+            series.wall_time.observe(event.wall_time)
+            if event.error is not None:
+                series.errors += 1
+            if event.hits is not None:
+                series.hits += event.hits
+            if event.took is not None:
+                series.took.observe(event.took / 1000)
+
+    def __enter__(self) -> 'RequestCollector':
+        return self.install()
+
+    def __exit__(self, ex_type: Optional[Type[BaseException]], ex_value: Optional[BaseException],
+                 traceback: Optional[TracebackType]):
+        self.uninstall()
+
+    def dump(self) -> List[Dict[str, any]]:
+        """
+        :return: A json serializable summary of every series, latencies are in milliseconds
+        """
+
+        res = []
+        with self.__lock:
+            for (operation, index, model), series in sorted(self.__series.items()):
+                res.append({
+                    'operation':      operation,
+                    'index':          index,
+                    'model':          model,
+                    'requests':       series.requests,
+                    'errors':         series.errors,
+                    'request_bytes':  series.request_bytes,
+                    'response_bytes': series.response_bytes,
+                    'hits':           series.hits,
+                    'wall_time':      self.__latencies(series.wall_time),
+                    'took':           self.__latencies(series.took),
+                })
+        return res
+
+    def install(self) -> 'RequestCollector':
+        """
+        Start collecting the requests of ElasticsearchIntegration
+
+        :return: The collector itself
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        ElasticsearchIntegration.add_listener(self)
+        return self
+
+    def prometheus(self, prefix: str = 'elastic_pdo') -> str:
+        """
+        Export the collected series in prometheus' text exposition format
+
+        :param prefix: The prefix of the metric names
+        :return: The exposition, ready to be served as text/plain; version=0.0.4
+        """
+
+        counters = [
+            ('requests_total', 'Requests made to elasticsearch', lambda s: s.requests),
+            ('request_errors_total', 'Requests that raised', lambda s: s.errors),
+            ('request_bytes_total', 'Bytes of request bodies as json', lambda s: s.request_bytes),
+            ('response_bytes_total', 'Bytes of response bodies as json', lambda s: s.response_bytes),
+            ('hits_total', 'Documents carried by responses', lambda s: s.hits),
+        ]
+        histograms = [
+            ('request_duration_seconds', 'Wall time of requests', lambda s: s.wall_time),
+            ('request_took_seconds', 'Time elasticsearch reported spending on requests', lambda s: s.took),
+        ]
+
+        with self.__lock:
+            series = sorted(self.__series.items())
+            lines = []
+            for name, description, value in counters:
+                lines.append(f'# HELP {prefix}_{name} {description}')
+                lines.append(f'# TYPE {prefix}_{name} counter')
+                for key, s in series:
+                    lines.append(f'{prefix}_{name}{{{self.__labels(key)}}} {value(s)}')
+            for name, description, histogram in histograms:
+                lines.append(f'# HELP {prefix}_{name} {description}')
+                lines.append(f'# TYPE {prefix}_{name} histogram')
+                for key, s in series:
+                    labels = self.__labels(key)
+                    for bound, count in histogram(s).cumulative():
+                        le = '+Inf' if bound == float('inf') else repr(float(bound))
+                        lines.append(f'{prefix}_{name}_bucket{{{labels},le="{le}"}} {count}')
+                    lines.append(f'{prefix}_{name}_sum{{{labels}}} {histogram(s).sum!r}')
+                    lines.append(f'{prefix}_{name}_count{{{labels}}} {histogram(s).count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        """
+        Drop everything collected so far
+        """
+
+        with self.__lock:
+            self.__series.clear()
+
+    def uninstall(self):
+        """
+        Stop collecting, what was collected so far is kept
+        """
+
+        from .elasticsearch_integration import ElasticsearchIntegration
+        ElasticsearchIntegration.remove_listener(self)
+
+    def __labels(self, key: Tuple[str, str, str]) -> str:
+        return ','.join(f'{label}="{_escape(value)}"' for label, value in zip(self.LABELS, key))
+
+    @staticmethod
+    def __latencies(histogram: Histogram) -> Dict[str, float]:
+        return {
+            'count': histogram.count,
+            'mean':  histogram.sum / histogram.count * 1000 if histogram.count else float('nan'),
+            'p50':   histogram.quantile(0.5) * 1000,
+            'p90':   histogram.quantile(0.9) * 1000,
+            'p99':   histogram.quantile(0.99) * 1000,
+        }
+
+
+class SlowQueryLog:
+    """
+    Log every request whose wall time reaches a threshold, with its full body and timings
+
+    Records go to the elastic_pdo.slow_queries logger (unless another is supplied) at WARNING, the event itself
+    is attached to them as elastic_pdo_event for handlers that want more than the message.
+    Enable it with ElasticsearchIntegration.enable_slow_query_log or install it as any other listener
+    """
+
+    def __init__(self, threshold: float = 1.0, logger: logging.Logger = None, level: int = logging.WARNING):
+        """
+        :param threshold: The seconds of wall time from which a request is logged
+        :param logger: The logger to log to
+        :param level: The level to log at
+        """
+
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger('elastic_pdo.slow_queries')
+        self.level = level
+
+    def __call__(self, event: RequestEvent):
+        if event.wall_time < self.threshold or not self.logger.isEnabledFor(self.level):
+            return
+
+        target = event.index or 'elasticsearch'
+        if event.model is not None:
+            target += f' ({event.model.__name__})'
+        took = f'{event.took}ms in elasticsearch' if event.took is not None else 'no took reported'
+        hits = f', {event.hits} hits' if event.hits is not None else ''
+        failed = f', failed with {type(event.error).__name__}' if event.error is not None else ''
+        body = event.body if isinstance(event.body, str) else json.dumps(event.body, default=str)
+        self.logger.log(self.level, 'slow %s of %s took %.1fms, %s%s%s: %s', event.operation, target,
+                        event.wall_time * 1000, took, hits, failed, body, extra={'elastic_pdo_event': event})
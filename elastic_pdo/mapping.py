@@ -0,0 +1,372 @@
+"""
+Derive the mapping of an index from the declared types of a model instead of leaving it to dynamic mapping
+
+Dynamic mapping turns every string into text with a keyword multi-field, which is rarely what a model needs.
+Strings are mapped as keyword here, numbers, booleans and dates by their type and nested models by their own
+declared types. Models refine that with a __mapping class field, coupling (possibly nested) fields with hints:
+
+    class Cdr(ElasticsearchModel):
+        __mapping = {
+            'caller_transcription.text': 'text',     # analyzed for full text search, no keyword multi-field
+            'metadata':                  'payload',  # stored in _source only, neither indexed nor aggregatable
+            'duration':                  {'type': 'double'},
+        }
+
+The hints are 'text', 'keyword', 'unaggregated' (no doc values, the field can't be sorted or aggregated on),
+'payload' and 'unstored' (left out of _source, the field can then only be searched, never fetched or reindexed),
+a list of hints or a dict merged over the derived mapping. Settings of the index come from an __index_settings
+class field, and an __index_sort class field (e.g. {'start': 'desc'}) stores the index sorted by those fields, so
+searches sorted the same way with a limited track_total_hits stop once they have enough hits.
+Create or compare the index from the command line:
+
+    python -m elastic_pdo.mapping show tests.cdr:Cdr
+    python -m elastic_pdo.mapping diff tests.cdr:Cdr
+    python -m elastic_pdo.mapping create tests.cdr:Cdr --template
+
+Strings have no keyword sub-field, while the queries the library builds target one unless the schema cache says
+otherwise. create and diff therefore turn the schema cache on, other processes using such an index have to call
+ElasticsearchIntegration.enable_schema_cache() themselves
+"""
+
+import argparse
+import copy
+import importlib
+import json
+import os
+import sys
+from datetime import date, datetime
+from typing import Dict, List, NamedTuple, Optional, Type, TYPE_CHECKING
+
+from .columns import _declared_types, model_field_types
+from .elasticsearch_integration import ElasticsearchIntegration
+from .util import _is, _is_builtin, _is_swagger
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchModel
+
+_TYPES = {str: 'keyword', bool: 'boolean', int: 'long', float: 'double', datetime: 'date', date: 'date'}
+_HINTS = ('text', 'keyword', 'unaggregated', 'payload', 'unstored')
+# strings the model doesn't declare shouldn't get a text field and a keyword multi-field either
+_DYNAMIC_TEMPLATES = [{'strings': {'match_mapping_type': 'string', 'mapping': {'type': 'keyword'}}}]
+
+
+class MappingDifference(NamedTuple):
+    """
+    A field whose mapping in the index differs from the one derived from the model
+
+    expected is <span style="color:#0055aa">None</span> for fields the model doesn't declare, actual for fields
+    missing from the index. Both hold the parameters of the field itself, without its sub-fields
+    """
+
+    field: str
+    expected: Optional[Dict[str, any]]
+    actual: Optional[Dict[str, any]]
+
+    def __str__(self):
+        if self.actual is None:
+            return f'missing {self.field}: {json.dumps(self.expected, sort_keys=True)}'
+        if self.expected is None:
+            return f'unexpected {self.field}: {json.dumps(self.actual, sort_keys=True)}'
+        return f'changed {self.field}: {json.dumps(self.actual, sort_keys=True)} ' \
+               f'-> {json.dumps(self.expected, sort_keys=True)}'
+
+
+def _field_mapping(klass: Optional[type], depth: int = 0) -> Optional[Dict[str, any]]:
+    if klass in (None, any, object) or depth > 8:
+        return None
+    if klass in _TYPES:
+        return {'type': _TYPES[klass]}
+    if _is(klass, list):
+        # elasticsearch has no arrays, any field holds as many values as it's given
+        args = getattr(klass, '__args__', None)
+        return _field_mapping(args[0], depth + 1) if args else None
+    if _is(klass, dict):
+        return {'type': 'object'}
+    if _is_builtin(klass) or getattr(klass, '__origin__', None) is not None:
+        return None
+
+    types = _declared_types(klass)
+    if _is_swagger(klass):
+        # the instance attributes describing the model aren't fields of it
+        types = {name: klass_ for name, klass_ in types.items() if name not in ('swagger_types', 'attribute_map')}
+    properties = _properties(types, depth + 1)
+    return {'properties': properties} if properties else {'type': 'object'}
+
+
+def _properties(types: Dict[str, type], depth: int = 0) -> Dict[str, Dict[str, any]]:
+    res = {}
+    for name, klass in types.items():
+        mapping = _field_mapping(klass, depth)
+        if mapping is not None:
+            res[name] = mapping
+    return res
+
+
+def _apply(mappings: Dict[str, any], field: str, hint: any):
+    if isinstance(hint, list):
+        for item in hint:
+            _apply(mappings, field, item)
+        return
+
+    if hint == 'unstored':
+        excludes = mappings.setdefault('_source', {}).setdefault('excludes', [])
+        if field not in excludes:
+            excludes.append(field)
+        return
+
+    properties, mapping = mappings['properties'], None
+    for part in field.split('.'):
+        if properties is None:
+            raise ValueError(f'Cannot apply {hint} to {field}, its parent is not an object')
+        mapping = properties.get(part)
+        if mapping is None:
+            if not isinstance(hint, dict):
+                raise ValueError(f'Cannot apply {hint} to {field}, its type is unknown, supply its mapping instead')
+            # declares a field whose type can't be derived
+            mapping = properties[part] = {}
+        properties = mapping.get('properties')
+
+    if isinstance(hint, dict):
+        if 'type' in hint and hint['type'] != 'object':
+            mapping.pop('properties', None)
+        mapping.update(copy.deepcopy(hint))
+        return
+
+    if hint not in _HINTS:
+        raise ValueError(f'Unknown mapping hint {hint} of {field}, use one of {", ".join(_HINTS)} or a dict')
+
+    field_type = mapping.get('type', 'object')
+    if hint in ('text', 'keyword'):
+        mapping.pop('properties', None)
+        mapping['type'] = hint
+    elif hint == 'payload':
+        if field_type == 'object':
+            mapping.clear()
+            mapping.update({'type': 'object', 'enabled': False})
+        else:
+            mapping['index'] = False
+            if field_type != 'text':
+                mapping['doc_values'] = False
+    elif field_type not in ('text', 'object'):
+        # unaggregated, text and objects have no doc values to turn off
+        mapping['doc_values'] = False
+
+
+def _hints(model: Type['ElasticsearchModel'], name: str) -> Dict[str, any]:
+    return getattr(model, f'_{model.__name__}__{name}', None) or {}
+
+
+def model_mapping(model: Type['ElasticsearchModel']) -> Dict[str, any]:
+    """
+    Derive the mappings of the index of a model from its declared types and the hints of its __mapping
+
+    :param model: The model to derive the mappings of
+    :return: The mappings, as under 'mappings' when creating an index
+    """
+
+    res = {'dynamic_templates': copy.deepcopy(_DYNAMIC_TEMPLATES),
+           'properties':        _properties(model_field_types(model))}
+    for field, hint in _hints(model, 'mapping').items():
+        _apply(res, field, hint)
+    return res
+
+
+def _index_sort(model: Type['ElasticsearchModel'], mappings: Dict[str, any]) -> Optional[Dict[str, List[str]]]:
+    index_sort = _hints(model, 'index_sort')
+    if not index_sort:
+        return None
+
+    fields = _flatten(mappings)
+    for field, order in index_sort.items():
+        params = fields.get(field)
+        if params is None or params['type'] in ('text', 'object') or params.get('doc_values') is False:
+            raise ValueError(f'Cannot sort the index of {model.__name__} by {field}, it has no doc values')
+        if order not in ('asc', 'desc'):
+            raise ValueError(f'The index sort order of {field} must be asc or desc, got {order}')
+    return {'field': list(index_sort), 'order': list(index_sort.values())}
+
+
+def index_body(model: Type['ElasticsearchModel'], settings: Dict[str, any] = None) -> Dict[str, any]:
+    """
+    Build the body creating the index of a model
+
+    :param model: The model to build the body for
+    :param settings: Settings of the index, on top of those of the __index_settings and __index_sort of the model
+    :return: The body, with the settings and mappings of the index
+    """
+
+    mappings = model_mapping(model)
+    res = copy.deepcopy(_hints(model, 'index_settings'))
+    index_sort = _index_sort(model, mappings)
+    if index_sort is not None:
+        res.setdefault('index', {})['sort'] = index_sort
+    res.update(settings or {})
+    return {
+        'settings': res,
+        'mappings': mappings
+    }
+
+
+def index_template(model: Type['ElasticsearchModel'], patterns: List[str] = None, priority: int = 100,
+                   settings: Dict[str, any] = None) -> Dict[str, any]:
+    """
+    Build a composable index template applying the mappings of a model to every index created by its name
+
+    :param model: The model to build the template for
+    :param patterns: The patterns of the names of the indices, the index of the model and those it prefixes
+    with a dash (e.g. cdrs-2024) if <span style="color:#0055aa">None</span>
+    :param priority: The priority of the template over others matching the same indices
+    :param settings: Settings of the indices, on top of those of the __index_settings of the model
+    :return: The body of the template
+    """
+
+    index = object.__getattribute__(model, f'_{model.__name__}__index')
+    return {
+        'index_patterns': patterns or [index, f'{index}-*'],
+        'priority':       priority,
+        'template':       index_body(model, settings)
+    }
+
+
+def _use_schema_cache(index: str):
+    # without the mapping at hand queries on strings look for the keyword sub-field these mappings don't have
+    cache = ElasticsearchIntegration.schema_cache
+    if cache is None:
+        ElasticsearchIntegration.enable_schema_cache()
+    else:
+        cache.refresh(index)
+
+
+def _flatten(mappings: Dict[str, any]) -> Dict[str, Dict[str, any]]:
+    res = {}
+    for key, value in mappings.items():
+        if key != 'properties':
+            res[key] = value if isinstance(value, dict) else {'value': value}
+
+    def walk(properties: Dict[str, any], prefix: str):
+        for name, mapping in properties.items():
+            path = f'{prefix}{name}'
+            params = {key: value for key, value in mapping.items() if key not in ('properties', 'fields')}
+            params.setdefault('type', 'object')
+            res[path] = params
+            for sub, sub_mapping in mapping.get('fields', {}).items():
+                res[f'{path}.{sub}'] = sub_mapping
+            walk(mapping.get('properties', {}), f'{path}.')
+
+    walk(mappings.get('properties', {}), '')
+    return res
+
+
+def diff(model: Type['ElasticsearchModel']) -> List[MappingDifference]:
+    """
+    Compare the mappings derived from a model against those of its index, and its index sort as index.sort
+
+    Types of mapped fields and the index sort can't be changed, differences other than missing fields require
+    reindexing into an index created with the derived mappings. Turns the schema cache on
+
+    :param model: The model to compare
+    :return: The fields that differ, sorted by name
+    """
+
+    from elasticsearch import NotFoundError
+    index = object.__getattribute__(model, f'_{model.__name__}__index')
+    _use_schema_cache(index)
+    try:
+        response = ElasticsearchIntegration._call('indices.get_mapping', index, index=index)
+    except NotFoundError:
+        response = {}
+
+    # an alias may point at several indices, their fields are merged
+    actual_mappings = {'properties': {}}
+    for mapping in response.values():
+        mappings = mapping.get('mappings', {})
+        actual_mappings.update({key: value for key, value in mappings.items() if key != 'properties'})
+        actual_mappings['properties'].update(mappings.get('properties', {}))
+
+    expected_mappings = model_mapping(model)
+    expected, actual = _flatten(expected_mappings), _flatten(actual_mappings)
+    index_sort = _index_sort(model, expected_mappings)
+    if index_sort is not None:
+        expected['index.sort'] = index_sort
+    if response:
+        sorts = []
+        for settings in ElasticsearchIntegration._call('indices.get_settings', index, index=index).values():
+            sort = settings['settings'].get('index', {}).get('sort', {})
+            # a single field comes back as is rather than as a list
+            sorts.append({key: value if _is(type(value), list) else [value] for key, value in sort.items()
+                          if key in ('field', 'order')} or None)
+        # of the indices behind an alias, the first one sorted differently is reported
+        actual_sort = next((sort for sort in sorts if sort != index_sort), index_sort)
+        if actual_sort is not None:
+            actual['index.sort'] = actual_sort
+
+    return [MappingDifference(field, expected.get(field), actual.get(field))
+            for field in sorted(expected.keys() | actual.keys()) if expected.get(field) != actual.get(field)]
+
+
+def create(model: Type['ElasticsearchModel'], template: bool = False, settings: Dict[str, any] = None) \
+        -> Dict[str, any]:
+    """
+    Create the index of a model with the derived mappings, or an index template applying them to new indices
+
+    Turns the schema cache on, which the queries on the strings of the index rely on
+
+    :param model: The model to create the index of
+    :param template: Put an index template named after the index instead of creating the index itself
+    :param settings: Settings of the index, on top of those of the __index_settings of the model
+    :return: The response of elasticsearch
+    """
+
+    index = object.__getattribute__(model, f'_{model.__name__}__index')
+    if template:
+        response = ElasticsearchIntegration._call('indices.put_index_template', index, name=index,
+                                                  body=index_template(model, settings=settings))
+    else:
+        response = ElasticsearchIntegration._call('indices.create', index, index=index,
+                                                  body=index_body(model, settings))
+    _use_schema_cache(index)
+    return response
+
+
+def _load_model(path: str) -> Type['ElasticsearchModel']:
+    module, _, name = path.partition(':')
+    if not name:
+        raise ValueError(f'Expected the model as module:Class, got {path}')
+    return getattr(importlib.import_module(module), name)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog='python -m elastic_pdo.mapping', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('show', 'diff', 'create'),
+                        help='print the derived mappings, compare them against the index or create it')
+    parser.add_argument('model', help='the model, as module:Class')
+    parser.add_argument('--template', action='store_true', help='an index template instead of the index itself')
+    parser.add_argument('--endpoint', default=os.environ.get('ELASTIC_ENDPOINT'),
+                        help='the elasticsearch endpoint, defaults to $ELASTIC_ENDPOINT')
+    parser.add_argument('--username', default='elastic', help='the elasticsearch user')
+    parser.add_argument('--password', default=os.environ.get('ELASTIC_PASSWORD'),
+                        help='the password of the user, defaults to $ELASTIC_PASSWORD')
+    args = parser.parse_args()
+
+    model = _load_model(args.model)
+    if args.command == 'show':
+        print(json.dumps(index_template(model) if args.template else index_body(model), indent=2))
+        return 0
+
+    if not args.endpoint or not args.password:
+        parser.error('an endpoint and password are required, supply them or set the environment variables')
+    ElasticsearchIntegration.create_client(args.endpoint, (args.username, args.password))
+
+    if args.command == 'create':
+        print(json.dumps(create(model, args.template)))
+        return 0
+
+    differences = diff(model)
+    for difference in differences:
+        print(difference)
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+import copy
+import threading
+from typing import Dict, Generic, List, Optional, Set, Tuple, Type, TypeVar
+
+from .elasticsearch_integration import ElasticsearchIntegration
+from .schema import _DATE_TYPES
+from .util import _is
+
+_EXTENDS_ElasticsearchModel = TypeVar('_EXTENDS_ElasticsearchModel', bound='ElasticsearchModel')
+_MISSING = object()
+
+
+def _field_values(document: Dict[str, any], field: str) -> List[any]:
+    # resolve a dotted path the way elasticsearch does, flattening lists along the way
+    values = [document]
+    for part in field.split('.'):
+        nested = []
+        for value in values:
+            if _is(type(value), dict) and part in value:
+                value = value[part]
+                nested.extend(value if _is(type(value), list) else [value])
+        values = nested
+    return values
+
+
+def _strip_keyword(field: str) -> str:
+    return field[:-len('.keyword')] if field.endswith('.keyword') else field
+
+
+# noinspection PyProtectedMember
+class ModelMirror(Generic[_EXTENDS_ElasticsearchModel]):
+    """
+    ModelMirror keeps an entire (small) index in memory and answers lookups of its model locally
+
+    fetch, fetch_all and fetch_matching with term equality queries (term, terms, match, match_phrase
+    and bool filter/must combinations of them) never reach elasticsearch, any other query falls back to it.
+    Strings are only compared locally on fields that aren't analyzed, keyword sub-fields or fields the schema
+    cache knows to be keyword, elasticsearch would match them by their tokens otherwise.
+    Calling sync picks up documents changed since the highest value of high_water_field seen so far,
+    without such a field (or to notice deletions) the whole index is reloaded
+    """
+
+    def __init__(self, model: Type[_EXTENDS_ElasticsearchModel], high_water_field: str = None,
+                 indexed_fields: List[str] = None, page_size: int = 1000):
+        """
+        :param model: The model to mirror
+        :param high_water_field: A field that only grows when a document changes, e.g. an updated at timestamp
+        :param indexed_fields: Fields to keep a value index of, speeding up equality lookups on them,
+        the primary key is always indexed. Keyword sub-fields index the field they belong to, e.g. language.keyword
+        :param page_size: The amount of documents to load per request
+        """
+
+        self.__model = model
+        self.__index = object.__getattribute__(model, f'_{model.__name__}__index')
+        self.__primary_key = object.__getattribute__(model, f'_{model.__name__}__primary_key')
+        self.__high_water_field = high_water_field
+        # lookups on keyword sub-fields are answered from the values of their field, which is what documents hold
+        self.__indexed_fields = list(dict.fromkeys(_strip_keyword(field)
+                                                   for field in [self.__primary_key] + list(indexed_fields or [])))
+        self.__page_size = page_size
+
+        self.__lock = threading.RLock()
+        self.__documents: Dict[str, Dict[str, any]] = {}
+        self.__indexes: Dict[str, Dict[any, Set[str]]] = {}
+        self.__high_water = None
+        self.__loaded = False
+
+        self.__poller: Optional[threading.Thread] = None
+        self.__stop = threading.Event()
+
+    def __len__(self):
+        return len(self.__documents)
+
+    @property
+    def high_water(self) -> any:
+        """The highest value of high_water_field seen so far"""
+        return self.__high_water
+
+    def fetch(self, primary_key_value: any) -> Optional[_EXTENDS_ElasticsearchModel]:
+        """
+        Fetches a single model from the mirror based off primary_key_value
+
+        :param primary_key_value: The value of the primary key to search for
+        :return: The model matching <b><i>primary_key_value</i></b> or <span style="color:#0055aa">None</span>
+        """
+
+        self.__ensure_loaded()
+        with self.__lock:
+            meta_ids = self.__indexes[self.__primary_key].get(primary_key_value)
+            documents = [self.__documents[meta_id] for meta_id in sorted(meta_ids)[:1]] if meta_ids else []
+            models = self.__hydrate(documents)
+        return models[0] if models else None
+
+    def fetch_all(self) -> Tuple[List[_EXTENDS_ElasticsearchModel], int]:
+        """
+        Fetches all models from the mirror
+
+        :return: A list of all models belonging to the mirrored index
+        """
+
+        self.__ensure_loaded()
+        with self.__lock:
+            models = self.__hydrate(list(self.__documents.values()))
+        return models, len(models)
+
+    def fetch_matching(self, query: Dict[str, any] = None) -> Tuple[List[_EXTENDS_ElasticsearchModel], int]:
+        """
+        Fetches all models matching the supplied query, locally if it's a term equality query
+
+        :param query: The query to search and match against,
+        if <span style="color:#0055aa">None</span> defaults to match all
+        :return: A list of all models belonging to the mirrored index matching the supplied query
+        """
+
+        self.__ensure_loaded()
+        with self.__lock:
+            meta_ids = self.__match(query or {'match_all': {}})
+            if meta_ids is not None:
+                models = self.__hydrate([self.__documents[meta_id] for meta_id in sorted(meta_ids)])
+                return models, len(models)
+
+        return self.__model.fetch_matching(query)
+
+    def refresh(self) -> None:
+        """
+        Reload the entire index, this also drops documents that were deleted
+        """
+
+        documents, high_water = {}, None
+        for page in ElasticsearchIntegration.scan(self.__index, page_size=self.__page_size):
+            for document in page:
+                documents[document[ElasticsearchIntegration.META_ID_FIELD]] = document
+                high_water = self.__higher_water(high_water, document)
+
+        indexes = {field: {} for field in self.__indexed_fields}
+        for meta_id, document in documents.items():
+            self.__index_document(indexes, meta_id, document)
+
+        with self.__lock:
+            self.__documents, self.__indexes, self.__high_water = documents, indexes, high_water
+            self.__loaded = True
+
+    def start(self, interval: float) -> None:
+        """
+        Keep the mirror current by calling sync in a background thread
+
+        :param interval: The amount of seconds between syncs
+        """
+
+        if self.__poller is not None:
+            raise RuntimeError('This mirror is already being synced')
+
+        self.__stop.clear()
+
+        def poll():
+            while not self.__stop.wait(interval):
+                self.sync()
+
+        self.__ensure_loaded()
+        self.__poller = threading.Thread(target=poll, name=f'ModelMirror({self.__index})', daemon=True)
+        self.__poller.start()
+
+    def stop(self) -> None:
+        """
+        Stop syncing in the background
+        """
+
+        poller, self.__poller = self.__poller, None
+        if poller is not None:
+            self.__stop.set()
+            poller.join()
+
+    def sync(self) -> None:
+        """
+        Pick up documents changed since the last sync, the whole index is reloaded if there's no high_water_field
+        """
+
+        if self.__high_water_field is None or self.__high_water is None:
+            self.refresh()
+            return
+
+        # gte since multiple documents may share the high water mark, the ones already seen are simply replaced
+        query = {'range': {self.__high_water_field: {'gte': self.__high_water}}}
+        for page in ElasticsearchIntegration.scan(self.__index, query, page_size=self.__page_size):
+            with self.__lock:
+                for document in page:
+                    meta_id = document[ElasticsearchIntegration.META_ID_FIELD]
+                    previous = self.__documents.get(meta_id)
+                    if previous is not None:
+                        self.__unindex_document(meta_id, previous)
+                    self.__documents[meta_id] = document
+                    self.__index_document(self.__indexes, meta_id, document)
+                    self.__high_water = self.__higher_water(self.__high_water, document)
+
+    def __ensure_loaded(self):
+        if not self.__loaded:
+            self.refresh()
+
+    def __higher_water(self, high_water: any, document: Dict[str, any]) -> any:
+        if self.__high_water_field is None:
+            return None
+
+        for value in _field_values(document, self.__high_water_field):
+            if value is not None and (high_water is None or value > high_water):
+                high_water = value
+        return high_water
+
+    def __hydrate(self, documents: List[Dict[str, any]]) -> List[_EXTENDS_ElasticsearchModel]:
+        # models are handed out mutable, so they mustn't share state with the mirror
+        return self.__model._hydrate_all([copy.deepcopy(document) for document in documents])
+
+    @staticmethod
+    def __index_document(indexes: Dict[str, Dict[any, Set[str]]], meta_id: str, document: Dict[str, any]):
+        for field, index in indexes.items():
+            for value in _field_values(document, field):
+                try:
+                    index.setdefault(value, set()).add(meta_id)
+                except TypeError:
+                    pass  # unhashable values can only be matched by scanning
+
+    def __match(self, query: Dict[str, any]) -> Optional[Set[str]]:
+        # the meta ids of the matching documents or None if the query isn't supported locally
+        if len(query) != 1:
+            return None
+
+        kind, clause = next(iter(query.items()))
+        if kind == 'match_all':
+            return set(self.__documents)
+
+        if kind == 'bool':
+            if set(clause) - {'must', 'filter'}:
+                return None
+
+            res = set(self.__documents)
+            for occur in ('must', 'filter'):
+                sub_queries = clause.get(occur, [])
+                for sub_query in sub_queries if _is(type(sub_queries), list) else [sub_queries]:
+                    matching = self.__match(sub_query)
+                    if matching is None:
+                        return None
+                    res &= matching
+            return res
+
+        if kind not in ('term', 'terms', 'match', 'match_phrase') or len(clause) != 1:
+            return None
+
+        field, value = next(iter(clause.items()))
+        if _is(type(value), dict):
+            if set(value) - {'value', 'query'}:
+                return None
+            value = value.get('value', value.get('query'))
+
+        values = value if kind == 'terms' else [value]
+        if not _is(type(values), list):
+            return None
+
+        field = self.__exact_field(field, values)
+        if field is None:
+            return None
+
+        res = set()
+        for value in values:
+            res |= self.__matching_value(field, value)
+        return res
+
+    def __exact_field(self, field: str, values: List[any]) -> Optional[str]:
+        # the field whose values equal the supplied ones exactly, None where elasticsearch would analyze them
+        if field.endswith('.keyword'):
+            return _strip_keyword(field)
+
+        strings = any(isinstance(value, str) for value in values)
+        schema = ElasticsearchIntegration.schema(self.__index)
+        field_type = None if schema is None else schema.field_type(field)
+        if field_type is None:
+            # unknown, strings may well be analyzed text
+            return None if strings else field
+        if field_type == 'text' or strings and field_type in _DATE_TYPES:
+            return None
+        return field
+
+    def __matching_value(self, field: str, value: any) -> Set[str]:
+        index = self.__indexes.get(field)
+        if index is not None:
+            try:
+                return set(index.get(value, ()))
+            except TypeError:
+                pass
+
+        return {meta_id for meta_id, document in self.__documents.items()
+                if value in _field_values(document, field)}
+
+    def __unindex_document(self, meta_id: str, document: Dict[str, any]):
+        for field, index in self.__indexes.items():
+            for value in _field_values(document, field):
+                try:
+                    meta_ids = index.get(value, _MISSING)
+                except TypeError:
+                    continue
+                if meta_ids is not _MISSING:
+                    meta_ids.discard(meta_id)
+                    if not meta_ids:
+                        del index[value]
@@ -0,0 +1,121 @@
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+_DESCRIPTION_WIDTH = 100
+
+
+class ProfiledNode(NamedTuple):
+    """
+    A query clause, collector or aggregation of a profiled search
+
+    time is in milliseconds and includes the children, self_time leaves them out,
+    which is what points at the clause actually doing the work
+    """
+
+    type: str
+    description: str
+    time: float
+    breakdown: Dict[str, int]
+    children: List['ProfiledNode']
+
+    @property
+    def self_time(self) -> float:
+        return max(0.0, self.time - sum(child.time for child in self.children))
+
+    def walk(self, depth: int = 0) -> Iterator[Tuple[int, 'ProfiledNode']]:
+        """
+        :param depth: The depth of this node
+        :return: A generator of this node and all of its descendants coupled with their depths, depth first
+        """
+
+        yield depth, self
+        for child in self.children:
+            yield from child.walk(depth + 1)
+
+
+class ShardProfile(NamedTuple):
+    """
+    The profile of a search on a single shard, times are in milliseconds
+    """
+
+    id: str
+    queries: List[ProfiledNode]
+    rewrite_time: float
+    collectors: List[ProfiledNode]
+    aggregations: List[ProfiledNode]
+
+    @property
+    def index(self) -> Optional[str]:
+        # ids look like [node][index][shard]
+        parts = self.id.strip('[]').split('][')
+        return parts[1] if len(parts) == 3 else None
+
+    @property
+    def query_time(self) -> float:
+        return sum(query.time for query in self.queries)
+
+
+def _node(profile: Dict[str, any], name_key: str = 'type', description_key: str = 'description') -> ProfiledNode:
+    return ProfiledNode(profile.get(name_key, ''), profile.get(description_key, ''),
+                        profile.get('time_in_nanos', 0) / 1e6, profile.get('breakdown', {}),
+                        [_node(child, name_key, description_key) for child in profile.get('children', [])])
+
+
+def _shorten(description: str) -> str:
+    return description if len(description) <= _DESCRIPTION_WIDTH else f'{description[:_DESCRIPTION_WIDTH - 3]}...'
+
+
+class SearchProfile:
+    """
+    SearchProfile is the readable form of the profile elasticsearch returns for searches made with profile=True
+
+    Printing it gives a per-shard breakdown of the query tree, collectors and aggregations,
+    slowest lists the clauses that took the most time themselves across all shards
+    """
+
+    def __init__(self, search_response: Dict[str, any]):
+        """
+        :param search_response: The response of a search made with profile=True
+        """
+
+        if 'profile' not in search_response:
+            raise ValueError('The search response holds no profile, search with profile=True')
+
+        self.took: int = search_response.get('took', 0)
+        self.total: Optional[int] = search_response.get('hits', {}).get('total', {}).get('value')
+        self.shards: List[ShardProfile] = []
+        for shard in search_response['profile']['shards']:
+            queries, collectors, rewrite_time = [], [], 0.0
+            for search in shard.get('searches', []):
+                queries.extend(_node(query) for query in search.get('query', []))
+                collectors.extend(_node(collector, 'name', 'reason') for collector in search.get('collector', []))
+                rewrite_time += search.get('rewrite_time', 0) / 1e6
+            self.shards.append(ShardProfile(shard['id'], queries, rewrite_time, collectors,
+                                            [_node(aggregation) for aggregation in shard.get('aggregations', [])]))
+
+    def __str__(self):
+        lines = [f'took {self.took}ms over {len(self.shards)} shards' +
+                 (f', {self.total} hits' if self.total is not None else '')]
+        for shard in self.shards:
+            lines.append(f'{shard.id} query {shard.query_time:.3f}ms, rewrite {shard.rewrite_time:.3f}ms')
+            for query in shard.queries:
+                for depth, node in query.walk(1):
+                    lines.append(f'{"  " * depth}{node.type} {node.time:.3f}ms (self {node.self_time:.3f}ms) '
+                                 f'{_shorten(node.description)}')
+            for collector in shard.collectors:
+                for depth, node in collector.walk(1):
+                    lines.append(f'{"  " * depth}collector {node.type} ({node.description}) {node.time:.3f}ms')
+            for aggregation in shard.aggregations:
+                for depth, node in aggregation.walk(1):
+                    lines.append(f'{"  " * depth}aggregation {node.type} [{node.description}] {node.time:.3f}ms')
+        return '\n'.join(lines)
+
+    def slowest(self, amount: int = 5) -> List[Tuple[str, ProfiledNode]]:
+        """
+        Find the query clauses that took the most time themselves, i.e. excluding their children
+
+        :param amount: The amount of clauses to return
+        :return: The clauses coupled with the ids of their shards, slowest first
+        """
+
+        nodes = [(shard.id, node) for shard in self.shards for query in shard.queries for _, node in query.walk()]
+        return sorted(nodes, key=lambda pair: pair[1].self_time, reverse=True)[:amount]
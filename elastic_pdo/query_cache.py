@@ -0,0 +1,163 @@
+import copy
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+
+class QueryCache:
+    """
+    QueryCache is an in-process cache of search responses
+
+    Entries expire after ttl seconds and the least recently used ones are evicted once max_size is exceeded,
+    all entries of an index are invalidated whenever this process writes to it.
+    A response is only stored if its index wasn't invalidated since the generation taken before requesting it
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60):
+        if max_size <= 0:
+            raise ValueError('max_size must be positive')
+
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__lock = Lock()
+        self.__entries: 'OrderedDict[str, Tuple[float, str, Dict[str, any]]]' = OrderedDict()
+        self.__keys_by_index: Dict[str, Set[str]] = {}
+        self.__generation = 0
+        self.__generations: Dict[str, int] = {}
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """The hit, miss, eviction and invalidation counts of this cache along with its current size"""
+        with self.__lock:
+            return {
+                'hits':          self.__hits,
+                'misses':        self.__misses,
+                'evictions':     self.__evictions,
+                'invalidations': self.__invalidations,
+                'size':          len(self.__entries)
+            }
+
+    @staticmethod
+    def key(operation: str, index: str, body: Dict[str, any]) -> str:
+        """
+        Create the canonical key of a request, equal requests get equal keys regardless of the order of their fields
+
+        :param operation: The api used for the request, e.g. search or count
+        :param index: The index the request is made against
+        :param body: The body of the request
+        :return: The key of the request
+        """
+
+        canonical = json.dumps([operation, index, body], sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def clear(self) -> None:
+        """
+        Remove all entries from this cache
+        """
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__keys_by_index.clear()
+            self.__generation += 1
+
+    def generation(self, index: str) -> Tuple[int, int]:
+        """
+        Get the invalidation generation of an index, it changes whenever the entries of the index are invalidated
+
+        :param index: The index
+        :return: An opaque value to pass to put along with the response of a request made after getting it
+        """
+
+        with self.__lock:
+            return self.__generation, self.__generations.get(index, 0)
+
+    def get(self, key: str) -> Optional[Dict[str, any]]:
+        """
+        Get a cached response
+
+        :param key: The key of the request
+        :return: A copy of the cached response or <span style="color:#0055aa">None</span> if missing or expired
+        """
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.__remove(key)
+                entry = None
+
+            if entry is None:
+                self.__misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+            response = entry[2]
+
+        # callers are free to modify the responses they get
+        return copy.deepcopy(response)
+
+    def invalidate(self, index: str = None) -> None:
+        """
+        Remove all entries of an index
+
+        :param index: The index to invalidate, everything is invalidated if <span style="color:#0055aa">None</span>
+        """
+
+        with self.__lock:
+            if index is None:
+                self.__generation += 1
+                keys = list(self.__entries)
+            else:
+                self.__generations[index] = self.__generations.get(index, 0) + 1
+                keys = self.__keys_by_index.get(index, ())
+            if not keys:
+                return
+
+            self.__invalidations += 1
+            for key in list(keys):
+                self.__remove(key)
+
+    def put(self, key: str, index: str, response: Dict[str, any], generation: Tuple[int, int] = None) -> None:
+        """
+        Cache a response
+
+        :param key: The key of the request
+        :param index: The index the request was made against, used for invalidation
+        :param response: The response to cache, a copy of it is stored
+        :param generation: The generation of the index taken before making the request,
+        the response is dropped if the index was invalidated since,
+        it is stored unconditionally if <span style="color:#0055aa">None</span>
+        """
+
+        response = copy.deepcopy(response)
+        with self.__lock:
+            if generation is not None and generation != (self.__generation, self.__generations.get(index, 0)):
+                return
+
+            if key in self.__entries:
+                self.__remove(key)
+
+            self.__entries[key] = (time.monotonic() + self.__ttl, index, response)
+            self.__keys_by_index.setdefault(index, set()).add(key)
+
+            while len(self.__entries) > self.__max_size:
+                self.__remove(next(iter(self.__entries)))
+                self.__evictions += 1
+
+    def __remove(self, key: str):
+        _, index, _ = self.__entries.pop(key)
+        keys = self.__keys_by_index[index]
+        keys.discard(key)
+        if not keys:
+            del self.__keys_by_index[index]
@@ -0,0 +1,198 @@
+import os
+import threading
+import traceback
+import warnings
+from collections import deque
+from contextvars import ContextVar, Token
+from types import TracebackType
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple, Type
+
+from .instrumentation import RequestEvent
+
+_CURRENT: ContextVar[Tuple['RequestScope', ...]] = ContextVar('elastic_pdo_request_scopes', default=())
+_PACKAGE = os.path.dirname(os.path.abspath(__file__))
+_ACTIONS = ('warn', 'raise', 'record')
+_DESCRIPTIONS = {
+    'fetch':  ('single document fetches', 'fetch them together, e.g. with fetch_matching or batch()'),
+    'update': ('update_model calls', 'group the changes in a transaction()'),
+}
+
+# scopes entered anywhere, the listener is only registered while there are any
+_active = 0
+_active_lock = threading.Lock()
+
+
+class RepeatedRequests(NamedTuple):
+    """
+    A kind of request that was repeated against an index more often than a RequestScope allows
+
+    kind is 'fetch' for single document fetches and 'update' for update_model calls,
+    call_site is the stack of the request that crossed the limit, innermost frame last
+    """
+
+    kind: str
+    index: str
+    count: int
+    call_site: List[traceback.FrameSummary]
+
+    def __str__(self):
+        description, advice = _DESCRIPTIONS[self.kind]
+        return f'{self.count} {description} of {self.index} within one scope, {advice}\n' + \
+            ''.join(traceback.format_list(self.call_site))
+
+
+def _dispatch(event: RequestEvent):
+    for scope in _CURRENT.get():
+        scope._observe(event)
+
+
+def _looked_up_field(query: Dict[str, any]) -> Optional[str]:
+    # the field a query looks a single value up by, a bool holding nothing but that lookup included
+    if len(query) != 1:
+        return None
+    kind, clause = next(iter(query.items()))
+    if kind == 'bool':
+        clauses = [c for occur in ('must', 'filter') for c in _as_list(clause.get(occur, []))]
+        return _looked_up_field(clauses[0]) if len(clause) == 1 and len(clauses) == 1 else None
+    if kind == 'ids':
+        return '_id' if len(clause.get('values', ())) == 1 else None
+    if kind in ('term', 'match_phrase') and len(clause) == 1:
+        field, value = next(iter(clause.items()))
+        if isinstance(value, dict):
+            value = value.get('value', value.get('query'))
+        return field if value is not None and not isinstance(value, (list, dict)) else None
+    return None
+
+
+def _as_list(value: any) -> List[any]:
+    return value if isinstance(value, list) else [value]
+
+
+def _kind(event: RequestEvent) -> Optional[str]:
+    # classified by what was asked for, a listing that happens to match a single document isn't a fetch
+    if event.operation == 'update':
+        return 'update'
+    body = event.body or {}
+    if event.operation == 'mget':
+        return 'fetch' if len(body.get('ids', ())) == 1 else None
+    if event.operation != 'search' or body.get('size', 1) != 1 or 'pit' in body or 'aggs' in body or \
+            'aggregations' in body:
+        return None
+
+    field = _looked_up_field(body.get('query') or {})
+    if field is None:
+        return None
+    if event.model is None or field == '_id':
+        return 'fetch'
+    primary_key = object.__getattribute__(event.model, f'_{event.model.__name__}__primary_key')
+    return 'fetch' if field in (primary_key, f'{primary_key}.keyword') else None
+
+
+def _call_site() -> List[traceback.FrameSummary]:
+    stack = traceback.extract_stack()
+    while stack and os.path.abspath(stack[-1].filename).startswith(_PACKAGE):
+        stack.pop()
+    return stack
+
+
+class RequestScope:
+    """
+    RequestScope tracks the requests a unit of work (e.g. a request handler or a test) makes to elasticsearch
+
+    Use it within a <span style="color:#0055aa">with</span> block, it reports single document fetches (by primary
+    key, by meta id or lazy loading of a single model) and update_model calls (setting fields outside a
+    transaction) repeated against the same index, the typical result of fetching or modifying models in a loop.
+    The active scopes are held in a context variable so threads and asyncio tasks each get their own,
+    requests made by threads started within a scope aren't tracked by it
+    """
+
+    def __init__(self, max_fetches: int = 5, max_updates: int = 5, on_repeat: str = 'warn', max_events: int = 100):
+        """
+        :param max_fetches: The amount of single document fetches of an index allowed before reporting
+        :param max_updates: The amount of update_model calls of an index allowed before reporting
+        :param on_repeat: What to do once a limit is crossed, 'warn' issues a RuntimeWarning at the call site,
+        'raise' raises a RuntimeError once the <span style="color:#0055aa">with</span> block ends (raising from the
+        request itself would cut short the cache invalidation following writes), 'record' only adds it to repeats
+        :param max_events: The amount of most recent requests kept in events, so long lived scopes don't hold on to
+        every request body and response, requests counts all of them
+        """
+
+        if on_repeat not in _ACTIONS:
+            raise ValueError(f'on_repeat must be one of {", ".join(_ACTIONS)}, got {on_repeat}')
+
+        self.__limits = {'fetch': max_fetches, 'update': max_updates}
+        self.__on_repeat = on_repeat
+        self.__counts: Dict[Tuple[str, str], int] = {}
+        self.__tokens: List[Token] = []
+        self.__violation: Optional[RepeatedRequests] = None
+        self.events: Deque[RequestEvent] = deque(maxlen=max_events)
+        self.requests = 0
+        self.repeats: List[RepeatedRequests] = []
+
+    def __enter__(self) -> 'RequestScope':
+        global _active
+        with _active_lock:
+            if not _active:
+                from .elasticsearch_integration import ElasticsearchIntegration
+                ElasticsearchIntegration.add_listener(_dispatch)
+            _active += 1
+        self.__tokens.append(_CURRENT.set(_CURRENT.get() + (self,)))
+        return self
+
+    def __exit__(self, ex_type: Optional[Type[BaseException]], ex_value: Optional[BaseException],
+                 traceback_: Optional[TracebackType]) -> bool:
+        global _active
+        _CURRENT.reset(self.__tokens.pop())
+        with _active_lock:
+            _active -= 1
+            if not _active:
+                from .elasticsearch_integration import ElasticsearchIntegration
+                ElasticsearchIntegration.remove_listener(_dispatch)
+
+        # an exception already leaving the block takes precedence, the repeat is still in repeats
+        violation, self.__violation = self.__violation, None
+        if violation is not None and ex_type is None:
+            raise RuntimeError(str(violation))
+        return False
+
+    @staticmethod
+    def current() -> Optional['RequestScope']:
+        """
+        Get the innermost request scope active in the current context
+
+        :return: The active request scope or <span style="color:#0055aa">None</span> if there is none
+        """
+
+        scopes = _CURRENT.get()
+        return scopes[-1] if scopes else None
+
+    def count(self, kind: str, index: str) -> int:
+        """
+        :param kind: 'fetch' or 'update'
+        :param index: The index of the models
+        :return: The amount of single document requests of the supplied kind made to the index within this scope
+        """
+
+        return self.__counts.get((kind, index), 0)
+
+    def _observe(self, event: RequestEvent):
+        self.events.append(event)
+        self.requests += 1
+        kind = _kind(event)
+        if kind is None or event.index is None:
+            return
+
+        key = (kind, event.index)
+        count = self.__counts[key] = self.__counts.get(key, 0) + 1
+        if count != self.__limits[kind] + 1:
+            return
+
+        # reported once per kind and index, when the limit is first crossed
+        repeat = RepeatedRequests(kind, event.index, count, _call_site())
+        self.repeats.append(repeat)
+        if self.__on_repeat == 'raise':
+            self.__violation = self.__violation or repeat
+        if self.__on_repeat == 'warn':
+            frame = repeat.call_site[-1] if repeat.call_site else None
+            warnings.warn_explicit(str(repeat), RuntimeWarning, frame.filename if frame else '<unknown>',
+                                   frame.lineno if frame else 0)
@@ -0,0 +1,217 @@
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, Iterable, List, NamedTuple, Optional, Type, TYPE_CHECKING
+
+from .util import _is
+
+if TYPE_CHECKING:
+    from .elasticsearch_model import ElasticsearchModel
+
+# the types term queries match exactly, as opposed to analyzed text
+_EXACT_TYPES = frozenset({'keyword', 'constant_keyword', 'wildcard', 'boolean', 'date', 'date_nanos', 'ip', 'long',
+                          'integer', 'short', 'byte', 'double', 'float', 'half_float', 'scaled_float',
+                          'unsigned_long', 'version'})
+_DATE_TYPES = frozenset({'date', 'date_nanos'})
+
+
+class FieldMapping(NamedTuple):
+    """
+    The mapping of a single field, type is <span style="color:#0055aa">None</span> for objects,
+    fields are its multi-fields (e.g. keyword) coupled with their types and format is the mapped date format if any
+    """
+
+    type: Optional[str]
+    fields: Dict[str, Optional[str]]
+    format: Optional[str] = None
+
+
+def _epoch_divisor(date_format: Optional[str]) -> Optional[int]:
+    # elasticsearch tries the formats in order, the first epoch one decides what numbers are
+    for name in (date_format or 'strict_date_optional_time||epoch_millis').split('||'):
+        if name.strip() == 'epoch_second':
+            return 1
+        if name.strip() == 'epoch_millis':
+            return 1000
+    return None
+
+
+def _decode_date(value: any, date_format: str = None) -> any:
+    if isinstance(value, str):
+        from dateutil import parser
+        try:
+            return parser.isoparse(value)
+        except ValueError:
+            # a custom date format, left as is unless it's an epoch
+            try:
+                value = float(value)
+            except ValueError:
+                return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        divisor = _epoch_divisor(date_format)
+        return value if divisor is None else datetime.fromtimestamp(value / divisor, timezone.utc)
+    if _is(type(value), list):
+        return [_decode_date(item, date_format) for item in value]
+    return value
+
+
+class IndexSchema:
+    """
+    IndexSchema holds the mapped fields of an index, flattened into dotted paths such as states.status
+    """
+
+    def __init__(self, index: str, mappings: Dict[str, any]):
+        """
+        :param index: The name of the index
+        :param mappings: The mappings of the index, as under 'mappings' in the response of get_mapping
+        """
+
+        self.index = index
+        self.fields: Dict[str, FieldMapping] = {}
+        self.__flatten(mappings.get('properties', {}), '')
+
+    def __contains__(self, field: str):
+        return self.__resolve(field) is not None
+
+    def decode(self, field: str, value: any) -> any:
+        """
+        Convert a value of a field as found in a document into its python type, currently dates into datetimes
+
+        :param field: The field the value belongs to
+        :param value: The value from the document
+        :return: The converted value, or the value itself if there's nothing to convert
+        """
+
+        if self.field_type(field) not in _DATE_TYPES:
+            return value
+        mapping = self.fields.get(field)
+        return _decode_date(value, None if mapping is None else mapping.format)
+
+    def date_fields(self) -> List[str]:
+        """
+        :return: The top level fields mapped as dates
+        """
+
+        return [field for field, mapping in self.fields.items() if '.' not in field and mapping.type in _DATE_TYPES]
+
+    def exact_field(self, field: str) -> Optional[str]:
+        """
+        Find the field to run term queries against instead of the supplied one
+
+        :param field: The field to match exactly
+        :return: The field itself if it isn't analyzed, its keyword multi-field if it's text with one,
+        <span style="color:#0055aa">None</span> if it can only be matched as text or isn't mapped
+        """
+
+        field_type = self.field_type(field)
+        if field_type in _EXACT_TYPES:
+            return field
+
+        mapping = self.fields.get(field)
+        if mapping is not None:
+            for name, sub_type in mapping.fields.items():
+                if sub_type == 'keyword':
+                    return f'{field}.{name}'
+        return None
+
+    def field_type(self, field: str) -> Optional[str]:
+        """
+        :param field: The field, nested fields and multi-fields are separated by dots, e.g. language.keyword
+        :return: The mapped type of the field, <span style="color:#0055aa">None</span> if unmapped or an object
+        """
+
+        return self.__resolve(field)
+
+    def missing(self, fields: Iterable[str]) -> List[str]:
+        """
+        :param fields: The fields to look for
+        :return: The supplied fields that aren't mapped
+        """
+
+        return [field for field in fields if field not in self]
+
+    def __flatten(self, properties: Dict[str, any], prefix: str):
+        for name, mapping in properties.items():
+            path = f'{prefix}{name}'
+            sub_fields = {sub: sub_mapping.get('type') for sub, sub_mapping in mapping.get('fields', {}).items()}
+            self.fields[path] = FieldMapping(mapping.get('type', 'object' if 'properties' in mapping else None),
+                                             sub_fields, mapping.get('format'))
+            if 'properties' in mapping:
+                self.__flatten(mapping['properties'], f'{path}.')
+
+    def __resolve(self, field: str) -> Optional[str]:
+        mapping = self.fields.get(field)
+        if mapping is not None:
+            return mapping.type
+
+        parent, _, sub = field.rpartition('.')
+        mapping = self.fields.get(parent)
+        if mapping is not None and sub in mapping.fields:
+            return mapping.fields[sub]
+        return None
+
+
+class SchemaCache:
+    """
+    SchemaCache fetches the mapping of each index once and keeps it for the life of the process
+
+    Mappings only grow as documents with new fields are indexed, refresh an index to see fields added since
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__schemas: Dict[str, IndexSchema] = {}
+
+    def __len__(self):
+        return len(self.__schemas)
+
+    def get(self, index: str) -> IndexSchema:
+        """
+        Get the schema of an index, fetching its mapping if it wasn't yet
+
+        :param index: The name of the index (or an alias of it)
+        :return: The schema, empty if the index doesn't exist in which case it isn't cached
+        """
+
+        schema = self.__schemas.get(index)
+        if schema is not None:
+            return schema
+
+        from elasticsearch import NotFoundError
+        from .elasticsearch_integration import ElasticsearchIntegration
+        try:
+            response = ElasticsearchIntegration._call('indices.get_mapping', index, index=index)
+        except NotFoundError:
+            return IndexSchema(index, {})
+
+        # an alias may point at several indices, their fields are merged
+        properties = {}
+        for mapping in response.values():
+            properties.update(mapping.get('mappings', {}).get('properties', {}))
+        schema = IndexSchema(index, {'properties': properties})
+        with self.__lock:
+            return self.__schemas.setdefault(index, schema)
+
+    def missing_fields(self, model: Type['ElasticsearchModel']) -> List[str]:
+        """
+        Find the fields a model declares that aren't mapped in its index
+
+        :param model: The model to check
+        :return: The top level fields of the model missing from the mapping
+        """
+
+        from .columns import model_field_types
+        index = object.__getattribute__(model, f'_{model.__name__}__index')
+        return self.get(index).missing(model_field_types(model))
+
+    def refresh(self, index: str = None) -> None:
+        """
+        Drop the schema of an index so its mapping is fetched again when next needed
+
+        :param index: The index to refresh, all if <span style="color:#0055aa">None</span>
+        """
+
+        with self.__lock:
+            if index is None:
+                self.__schemas.clear()
+            else:
+                self.__schemas.pop(index, None)
@@ -1,3 +1,14 @@
+import importlib
+
+
+def _require(module: str, feature: str):
+    # optional dependencies are imported where used, missing ones are reported along with what needs them
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(f'{feature} requires {module}, install it from requirements-optional.txt') from e
+
+
 def _is(klass: type, match: type):
     return klass == match or getattr(klass, '__origin__', None) == match
 
@@ -30,8 +30,20 @@ class TestBasic(unittest.TestCase):
 
         from .swagger.calls_filter_request import CallsFilterRequest
         all_seconds = Cdr.sum('duration', CallsFilterRequest(caller_number='35095'))
-
-        dummy = Cdr.fetch('90b43306-abd0-11ea-8b61-0242ac170007')
+        listing, _ = Cdr.search(CallsFilterRequest(caller_number='35095'),
+                                fields=['caller_phone_number', 'duration', 'start'])
+
+        with Cdr.batch() as batch:
+            page = Cdr.search(CallsFilterRequest(caller_number='35095'), batch=batch)
+            total = Cdr.count(CallsFilterRequest(caller_number='35095'), batch=batch)
+            seconds = Cdr.sum('duration', CallsFilterRequest(caller_number='35095'), batch=batch)
+        self.assertEqual(page.result()[1], total.result())
+        self.assertEqual(seconds.result(), all_seconds)
+
+        from elastic_pdo.identity_map import IdentityMap
+        with IdentityMap():
+            dummy = Cdr.fetch('90b43306-abd0-11ea-8b61-0242ac170007')
+            self.assertIs(dummy, Cdr.fetch('90b43306-abd0-11ea-8b61-0242ac170007'))
         with dummy.transaction():
             dummy.is_loading = False
             dummy.states.status = -1
@@ -1,8 +1,10 @@
 from datetime import datetime
 from typing import Dict, List, Tuple, Union
 
+from elastic_pdo.aggregation import ElasticsearchAggregation
 from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
-from elastic_pdo.elasticsearch_model import ElasticsearchModel
+from elastic_pdo.elasticsearch_model import ElasticsearchBatch, ElasticsearchFuture, ElasticsearchModel
+from elastic_pdo.profiling import SearchProfile
 from .swagger.call_log_states import CallLogStates
 from .swagger.calls_filter_request import CallsFilterRequest
 from .swagger.comment import Comment
@@ -12,12 +14,22 @@ from .swagger.transcript_line import TranscriptLine
 # noinspection GrazieInspection
 class Cdr(ElasticsearchModel):
     __index = 'cdrs'
+    __index_sort = {'start': 'desc', 'session_id': 'desc'}
+    __lazy = ['callee_transcription', 'caller_transcription', 'metadata']
+    __mapping = {
+        'callee_transcription.text': 'text',
+        'caller_transcription.text': 'text',
+        'compliance_comments.text':  'text',
+        'review_comments.text':      'text',
+        'duration':                  {'type': 'double'},
+        'metadata':                  'payload',
+    }
     __primary_key = 'session_id'
 
     @staticmethod
     def _id_query(value: int):
         return {
-            'match': {
+            'term': {
                 'cdr_id': value
             }
         }
@@ -25,72 +37,80 @@ class Cdr(ElasticsearchModel):
     @classmethod
     def __generate_search_request(cls, request: CallsFilterRequest):
         from elastic_pdo.elasticsearch_model import ElasticsearchQuery
+        # only the free text search scores, everything else is a filter elasticsearch can cache
         filter_part, must_part = [], []
+        schema = cls.schema()
 
         if request.text_to_search:
             if request.text_to_search.isnumeric():
-                must_part.append(cls._id_query(value=int(request.text_to_search)))
+                filter_part.append(cls._id_query(value=int(request.text_to_search)))
             else:
                 must_part.append(ElasticsearchQuery.text(value=request.text_to_search))
 
         if request.assigned:
-            filter_part.append(ElasticsearchQuery.equals(field='assigned', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='assigned', value=True, schema=schema))
 
         if request.successful_calls:
-            filter_part.append(ElasticsearchQuery.equals(field='successful_call', value=request.successful_calls))
+            filter_part.append(
+                ElasticsearchQuery.equals(field='successful_call', value=request.successful_calls, schema=schema))
 
         if request.only_approved_calls:
             filter_part.append(ElasticsearchQuery.exists(field='approved_by'))
 
         if request.caller_number:
-            filter_part.append(ElasticsearchQuery.equals(field='caller', value=request.caller_number))
+            filter_part.append(
+                ElasticsearchQuery.equals(field='caller', value=request.caller_number, exact=True, schema=schema))
 
         if request.callee_number:
-            filter_part.append(ElasticsearchQuery.equals(field='callee', value=request.callee_number))
+            filter_part.append(
+                ElasticsearchQuery.equals(field='callee', value=request.callee_number, exact=True, schema=schema))
 
         if request.ai_tag:
-            filter_part.append(ElasticsearchQuery.equals(field='has_ai_tags', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='has_ai_tags', value=True, schema=schema))
 
         if request.online:
-            filter_part.append(ElasticsearchQuery.equals(field='online', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='online', value=True, schema=schema))
 
         if request.compound_phrases:
-            filter_part.append(ElasticsearchQuery.equals(field='has_compound_phrases', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='has_compound_phrases', value=True, schema=schema))
 
         if request.simple_phrases:
-            filter_part.append(ElasticsearchQuery.equals(field='has_simple_phrases', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='has_simple_phrases', value=True, schema=schema))
 
         if request.keywords:
-            filter_part.append(ElasticsearchQuery.equals(field='has_keyword_phrases', value=True))
+            filter_part.append(ElasticsearchQuery.equals(field='has_keyword_phrases', value=True, schema=schema))
 
         if request.approved_calls:
             filter_part.append(
-                ElasticsearchQuery.equals(field='only_approved_calls', value=request.only_approved_calls))
+                ElasticsearchQuery.equals(field='only_approved_calls', value=request.only_approved_calls,
+                                          schema=schema))
 
         if request.call_classifications:
             filter_part.append(
-                ElasticsearchQuery.or_(field='states.call_classification', values=request.call_classifications))
+                ElasticsearchQuery.or_(field='states.call_classification', values=request.call_classifications,
+                                       schema=schema))
 
         if request.topics:
-            must_part.append(ElasticsearchQuery.or_(field='topics', values=request.topics))
+            filter_part.append(ElasticsearchQuery.or_(field='topics', values=request.topics, schema=schema))
 
         if request.call_tags:
-            must_part.append(ElasticsearchQuery.or_(field='tags', values=request.call_tags))
+            filter_part.append(ElasticsearchQuery.or_(field='tags', values=request.call_tags, schema=schema))
 
         if request.agent_tags:
-            filter_part.append(ElasticsearchQuery.equals(field='agent_tags', value=request.agent_tags))
+            filter_part.append(ElasticsearchQuery.equals(field='agent_tags', value=request.agent_tags, schema=schema))
 
         if request.customer_tags:
-            filter_part.append(ElasticsearchQuery.equals(field='customer_tags', value=request.customer_tags))
+            filter_part.append(
+                ElasticsearchQuery.equals(field='customer_tags', value=request.customer_tags, schema=schema))
 
         if request.language_filter:
-            must_part.append(ElasticsearchQuery.or_(field='language', values=request.language_filter))
+            filter_part.append(ElasticsearchQuery.or_(field='language', values=request.language_filter, schema=schema))
 
         if request.assignees:
-            filter_part.append(ElasticsearchQuery.equals(field='assignees', value=request.assignees))
+            filter_part.append(ElasticsearchQuery.equals(field='assignees', value=request.assignees, schema=schema))
 
         if request.statuses:
-            filter_part.append(ElasticsearchQuery.equals(field='cdr_statuses', value=request.statuses))
+            filter_part.append(ElasticsearchQuery.equals(field='cdr_statuses', value=request.statuses, schema=schema))
 
         if request.duration_min is not None or request.duration_max is not None:
             filter_part.append(
@@ -105,59 +125,107 @@ class Cdr(ElasticsearchModel):
         if must_part:
             query['must'] = must_part
 
-        return {
+        res = {
             'query': {
                 'bool': query
             }
         }
+        # the primary key breaks ties on every page so models sorting equal don't move between pages, the index is
+        # sorted the same way so newest first listings can still terminate early
+        if request.sort:
+            order = request.order or 'desc'
+            res['sort'] = [ElasticsearchQuery.sort(field=request.sort, order=order, schema=schema, model=cls)]
+            if request.sort != cls.__primary_key:
+                res['sort'].append(ElasticsearchQuery.sort(field=cls.__primary_key, order=order, schema=schema,
+                                                           model=cls))
+        return res
+
+    @classmethod
+    def aggregate(cls, query_or_filter: Union[CallsFilterRequest, Dict[str, any]] = None) -> ElasticsearchAggregation:
+        if isinstance(query_or_filter, CallsFilterRequest):
+            query_or_filter = cls.__generate_search_request(query_or_filter)['query']
+        return super().aggregate(query_or_filter)
 
     @classmethod
-    def count(cls, query_or_filter: Union[CallsFilterRequest, Dict[str, any]] = None) -> int:
+    def count(cls, query_or_filter: Union[CallsFilterRequest, Dict[str, any]] = None, at_least: int = None,
+              batch: ElasticsearchBatch = None) -> Union[int, ElasticsearchFuture[int]]:
         """
         Counts all models of this type matching the supplied query or filter
 
         :param query_or_filter: The query/filter to match against,
         or <span style="color:#0055aa">True</span> if not supplied
+        :param at_least: Only count accurately up to this amount, useful for badges such as "1000+"
+        :param batch: If supplied the count is deferred to it and a future is returned
         :return: The amount of models matching the supplied query/filter or total amount if no query supplied
         """
 
         if not isinstance(query_or_filter, CallsFilterRequest):
-            return super().count(query_or_filter)
+            if batch is not None:
+                return batch.count(query_or_filter, at_least)
+            return super().count(query_or_filter, at_least)
 
         request_body_search = cls.__generate_search_request(query_or_filter)
-        search_response = ElasticsearchIntegration.client.search(index=cls.__index, body=request_body_search,
-                                                                 track_total_hits=True,
-                                                                 size=query_or_filter.max_elements,
-                                                                 from_=query_or_filter.offset)
-        return search_response['hits']['total']['value']
+        if batch is not None:
+            return batch.count_matching(request_body_search['query'], at_least)
+        return ElasticsearchIntegration.count_matching(cls.__index, request_body_search['query'], at_least)
 
     @classmethod
-    def search(cls, filter_: CallsFilterRequest) -> Tuple[List['Cdr'], int]:
-        request_body_search = cls.__generate_search_request(filter_)
-        search_response = ElasticsearchIntegration.client.search(index=cls.__index, body=request_body_search,
-                                                                 track_total_hits=True, size=filter_.max_elements,
-                                                                 from_=filter_.offset)
-        cdrs = [cls().from_elastic_document(cdr['_source']) for cdr in search_response['hits']['hits']]
-        number_of_calls = search_response['hits']['total']['value']
-
-        return cdrs, number_of_calls
+    def profile(cls, query_or_filter: Union[CallsFilterRequest, Dict[str, any]] = None,
+                sort: Union[Dict[str, any], List[Dict[str, any]]] = None, max_elements: int = 10,
+                track_total_hits: Union[bool, int] = None) -> SearchProfile:
+        if isinstance(query_or_filter, CallsFilterRequest):
+            max_elements = query_or_filter.max_elements
+            request_body_search = cls.__generate_search_request(query_or_filter)
+            query_or_filter, sort = request_body_search['query'], request_body_search.get('sort')
+            track_total_hits = True if track_total_hits is None else track_total_hits
+        return super().profile(query_or_filter, sort, max_elements, track_total_hits)
 
     @classmethod
-    def sum(cls, field: str, filter_: CallsFilterRequest) -> int:
+    def search(cls, filter_: CallsFilterRequest, fields: List[str] = None, exclude: List[str] = None,
+               batch: ElasticsearchBatch = None, track_total_hits: Union[bool, int] = True) \
+            -> Union[Tuple[List['Cdr'], int], ElasticsearchFuture[Tuple[List['Cdr'], int]]]:
+        """
+        Fetches the calls matching the supplied filter, ordered by its sort and order (newest first by default)
+
+        :param filter_: The filter to match against
+        :param fields: The only fields to load, the models will be partial if supplied
+        :param exclude: The fields not to load, the models will be partial if supplied
+        :param batch: If supplied the search is deferred to it and a future is returned
+        :param track_total_hits: Whether (or up to what number) to accurately count the total matching calls,
+        a number lets the newest first listing stop early on an index sorted by start, the total is then capped by it
+        :return: The calls coupled with the total amount of matching calls
+        """
+
         request_body_search = cls.__generate_search_request(filter_)
-        request_body_search['size'] = 0
-        request_body_search['aggs'] = {
-            '*': {
-                'sum': {
-                    'field': field
-                }
-            }
-        }
+        return (cls if batch is None else batch).fetch_matching(request_body_search['query'],
+                                                                sort=request_body_search.get('sort'),
+                                                                max_elements=filter_.max_elements,
+                                                                offset=filter_.offset, fields=fields,
+                                                                exclude=exclude, track_total_hits=track_total_hits)
+
+    @classmethod
+    def sum(cls, field: str, filter_: CallsFilterRequest, batch: ElasticsearchBatch = None) \
+            -> Union[int, ElasticsearchFuture[int]]:
+        aggregation = cls.aggregate(filter_).sum(field, name='*')
+        if batch is not None:
+            return batch.search(aggregation.body(), lambda response: aggregation.parse(response)['*'])
+        return aggregation.execute()['*']
 
-        search_response = ElasticsearchIntegration.client.search(index=cls.__index, body=request_body_search,
-                                                                 track_total_hits=True, size=filter_.max_elements,
-                                                                 from_=filter_.offset)
-        return search_response['aggregations']['*']['value']
+    @classmethod
+    def time_series(cls, field: str, interval: str, query: Union[CallsFilterRequest, Dict[str, any]] = None,
+                    time_zone: str = None, metrics: List[Tuple[str, str]] = None, min_doc_count: int = 0,
+                    extended_bounds: Tuple[any, any] = None, as_numpy: bool = False) -> Dict[str, any]:
+        # a filter also dictates the time zone (gmt_offset is in hours) and the span of the series
+        if isinstance(query, CallsFilterRequest):
+            if time_zone is None and query.gmt_offset is not None:
+                hours, minutes = divmod(abs(query.gmt_offset) * 60, 60)
+                time_zone = f'{"-" if query.gmt_offset < 0 else "+"}{hours:02.0f}:{minutes:02.0f}'
+            if extended_bounds is None and query.start and query.end:
+                extended_bounds = (query.start, query.end)
+            query = cls.__generate_search_request(query)['query']
+
+        return super().time_series(field, interval, query, time_zone, metrics, min_doc_count, extended_bounds,
+                                   as_numpy)
 
     def __init__(self, account_manager_id: int = None, call_score: int = None, callee_phone_number: str = None,
                  callee_phrases: List[str] = None, callee_score: int = None,
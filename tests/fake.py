@@ -0,0 +1,1550 @@
+import copy
+import functools
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from fnmatch import fnmatchcase
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from elastic_pdo.util import _is
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$')
+_NOW = re.compile(r'^now(?:([+-])(\d+)([smhdw]))?(?:/([smhdw]))?$')
+_UNITS = {'s': 1000, 'm': 60 * 1000, 'h': 60 * 60 * 1000, 'd': 24 * 60 * 60 * 1000, 'w': 7 * 24 * 60 * 60 * 1000}
+_FIXED_UNITS = dict(_UNITS, ms=1)
+_CALENDAR_UNITS = {'minute': 'minute', '1m': 'minute', 'hour': 'hour', '1h': 'hour', 'day': 'day', '1d': 'day',
+                   'week': 'week', '1w': 'week', 'month': 'month', '1M': 'month', 'quarter': 'quarter',
+                   '1q': 'quarter', 'year': 'year', '1y': 'year'}
+_DEFAULT_PERCENTS = [1.0, 5.0, 25.0, 50.0, 75.0, 95.0, 99.0]
+# the lucene queries elasticsearch reports in profiles, roughly
+_QUERY_TYPES = {'match_all': 'MatchAllDocsQuery', 'match_none': 'MatchNoDocsQuery', 'bool': 'BooleanQuery',
+                'ids': 'TermInSetQuery', 'exists': 'DocValuesFieldExistsQuery', 'multi_match': 'DisjunctionMaxQuery',
+                'term': 'TermQuery', 'terms': 'TermInSetQuery', 'match': 'TermQuery', 'match_phrase': 'PhraseQuery',
+                'range': 'IndexOrDocValuesQuery', 'prefix': 'PrefixQuery', 'wildcard': 'WildcardQuery'}
+_OCCURS = {'must': '+', 'filter': '#', 'must_not': '-', 'should': ''}
+
+
+def _request_error(error_type: str, reason: str):
+    from elasticsearch import RequestError
+    return RequestError(400, error_type, {'error': {'type': error_type, 'reason': reason}, 'status': 400})
+
+
+def _not_found(error_type: str, reason: str):
+    from elasticsearch import NotFoundError
+    return NotFoundError(404, error_type, {'error': {'type': error_type, 'reason': reason}, 'status': 404})
+
+
+@functools.lru_cache(maxsize=65536)
+def _analyze(value: str) -> Tuple[str, ...]:
+    return tuple(_TOKEN.findall(value.lower()))
+
+
+def _tokens(value: any) -> Tuple[str, ...]:
+    return _analyze(value if isinstance(value, str) else str(value))
+
+
+def _values(source: Dict[str, any], path: List[str]) -> List[any]:
+    # resolve a path the way elasticsearch does, flattening lists along the way
+    values = [source]
+    for part in path:
+        nested = []
+        for value in values:
+            if _is(type(value), dict) and part in value:
+                value = value[part]
+                nested.extend(value if _is(type(value), list) else [value])
+        values = nested
+    return [value for value in values if value is not None]
+
+
+def _to_millis(value: any) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        value = str(value)
+        if value.isdigit():
+            return int(value)
+        now = _NOW.match(value)
+        if now is not None:
+            millis = int(time.time() * 1000)
+            sign, amount, unit, rounding = now.groups()
+            if amount:
+                millis += (1 if sign == '+' else -1) * int(amount) * _UNITS[unit]
+            if rounding:
+                millis -= millis % _UNITS[rounding]
+            return millis
+
+        from dateutil import parser
+        try:
+            parsed = parser.isoparse(value)
+        except ValueError:
+            return None
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def _format_millis(millis: int, tz=timezone.utc) -> str:
+    res = datetime.fromtimestamp(millis / 1000, tz).isoformat(timespec='milliseconds')
+    return res[:-len('+00:00')] + 'Z' if res.endswith('+00:00') else res
+
+
+def _time_zone(time_zone: Optional[str]):
+    if not time_zone:
+        return timezone.utc
+    offset = re.match(r'^([+-])(\d{2}):?(\d{2})$', time_zone)
+    if offset is not None:
+        sign, hours, minutes = offset.groups()
+        return timezone((1 if sign == '+' else -1) * timedelta(hours=int(hours), minutes=int(minutes)))
+    from dateutil import tz
+    res = tz.gettz(time_zone)
+    if res is None:
+        raise _request_error('illegal_argument_exception', f'unknown time zone {time_zone}')
+    return res
+
+
+def _filter_source(source: any, includes: List[str], excludes: List[str], prefix: str = '') -> any:
+    if _is(type(source), list):
+        return [_filter_source(value, includes, excludes, prefix) for value in source]
+    if not _is(type(source), dict):
+        return source
+
+    res = {}
+    for key, value in source.items():
+        path = f'{prefix}{key}'
+        if any(fnmatchcase(path, pattern) or path.startswith(f'{pattern}.') for pattern in excludes):
+            continue
+
+        if not includes or any(fnmatchcase(path, pattern) or path.startswith(f'{pattern}.') for pattern in includes):
+            res[key] = _filter_source(value, [], excludes, f'{path}.')
+        elif isinstance(value, (dict, list)) and \
+                any(pattern.startswith(f'{path}.') or pattern.startswith('*') for pattern in includes):
+            nested = _filter_source(value, includes, excludes, f'{path}.')
+            if nested:
+                res[key] = nested
+    return res
+
+
+def _source_patterns(source: any) -> Optional[Tuple[List[str], List[str]]]:
+    # the includes and excludes of a _source clause, None if no source is wanted at all
+    if source is None or source is True:
+        return [], []
+    if source is False:
+        return None
+    if isinstance(source, str):
+        return [source], []
+    if _is(type(source), list):
+        return list(source), []
+    return list(source.get('includes', source.get('include', []))), \
+        list(source.get('excludes', source.get('exclude', [])))
+
+
+def _percentile(values: List[float], percent: float) -> Optional[float]:
+    if not values:
+        return None
+    position = (len(values) - 1) * percent / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def _describe(query: Dict[str, any]) -> str:
+    # in the manner of lucene's Query.toString
+    kind, clause = next(iter(query.items()))
+    if kind == 'bool':
+        parts = []
+        for occur, prefix in _OCCURS.items():
+            queries = clause.get(occur, [])
+            for sub_query in queries if _is(type(queries), list) else [queries]:
+                description = _describe(sub_query)
+                parts.append(f'{prefix}({description})' if 'bool' in sub_query else f'{prefix}{description}')
+        return ' '.join(parts)
+    if kind == 'match_all':
+        return '*:*'
+    if kind == 'match_none':
+        return 'MatchNoDocsQuery'
+    if kind == 'ids':
+        return f'_id:({" ".join(clause.get("values", []))})'
+    if kind == 'exists':
+        return f'DocValuesFieldExistsQuery [field={clause["field"]}]'
+    if kind == 'multi_match':
+        return f'({" | ".join(clause.get("fields") or ["*"])}):{clause.get("query")}'
+
+    field, value = next((key, value) for key, value in clause.items() if key != 'boost')
+    if _is(type(value), dict) and kind not in ('terms', 'range'):
+        value = value.get('value', value.get('query'))
+    if kind == 'range':
+        return f'{field}:[{value.get("gte", value.get("gt", "*"))} TO {value.get("lte", value.get("lt", "*"))}]'
+    if kind == 'terms':
+        return f'{field}:({" ".join(map(str, value))})'
+    if kind == 'match_phrase':
+        return f'{field}:"{value}"'
+    if kind == 'prefix':
+        return f'{field}:{value}*'
+    return f'{field}:{value}'
+
+
+def _infer_mapping(value: any) -> Optional[Dict[str, any]]:
+    # elasticsearch's dynamic mapping, the first value a field is seen with decides its type
+    if _is(type(value), list):
+        for item in value:
+            res = _infer_mapping(item)
+            if res is not None:
+                return res
+        return None
+    if isinstance(value, bool):
+        return {'type': 'boolean'}
+    if isinstance(value, int):
+        return {'type': 'long'}
+    if isinstance(value, float):
+        return {'type': 'float'}
+    if isinstance(value, str):
+        if _DATE.match(value):
+            return {'type': 'date'}
+        return {'type': 'text', 'fields': {'keyword': {'type': 'keyword', 'ignore_above': 256}}}
+    if _is(type(value), dict):
+        return {'properties': {}}
+    return None
+
+
+def _dynamic_template(templates: List[Dict[str, any]], mapping: Dict[str, any]) -> Dict[str, any]:
+    # only templates matching by the detected type of strings are supported, the first matching one applies
+    detected = {'text': 'string', 'date': 'date'}.get(mapping.get('type'))
+    if detected is None:
+        return mapping
+    for template in templates:
+        for matcher in template.values():
+            if matcher.keys() == {'match_mapping_type', 'mapping'} and \
+                    matcher['match_mapping_type'] in (detected, '*'):
+                return copy.deepcopy(matcher['mapping'])
+    return mapping
+
+
+def _merge_mapping(properties: Dict[str, any], source: Dict[str, any], templates: List[Dict[str, any]] = ()) \
+        -> bool:
+    # whether any field was added
+    changed = False
+    for key, value in source.items():
+        mapping = properties.get(key)
+        if mapping is None:
+            mapping = _infer_mapping(value)
+            if mapping is None:
+                continue
+            properties[key] = mapping = _dynamic_template(templates, mapping)
+            changed = True
+
+        if 'properties' in mapping:
+            for item in value if _is(type(value), list) else [value]:
+                if _is(type(item), dict):
+                    changed = _merge_mapping(mapping['properties'], item, templates) or changed
+    return changed
+
+
+def _merge_properties(properties: Dict[str, any], added: Dict[str, any], prefix: str = ''):
+    for name, mapping in added.items():
+        existing = properties.get(name)
+        if existing is None:
+            properties[name] = copy.deepcopy(mapping)
+            continue
+
+        existing_type = existing.get('type', 'object' if 'properties' in existing else None)
+        added_type = mapping.get('type', 'object' if 'properties' in mapping else None)
+        if existing_type != added_type:
+            raise _request_error('illegal_argument_exception', f'mapper [{prefix}{name}] cannot be changed from type '
+                                                               f'[{existing_type}] to [{added_type}]')
+        if 'properties' in mapping:
+            _merge_properties(existing.setdefault('properties', {}), mapping['properties'], f'{prefix}{name}.')
+        for sub, sub_mapping in mapping.get('fields', {}).items():
+            existing.setdefault('fields', {}).setdefault(sub, copy.deepcopy(sub_mapping))
+
+
+def _index_settings(settings: Dict[str, any]) -> Dict[str, any]:
+    # settings are accepted dotted or nested, with or without the index prefix, and returned nested without it
+    res = {}
+
+    def walk(nested: Dict[str, any], prefix: List[str]):
+        for key, value in nested.items():
+            path = prefix + key.split('.')
+            if isinstance(value, dict):
+                walk(value, path)
+                continue
+            if path[0] == 'index':
+                path = path[1:]
+            target = res
+            for part in path[:-1]:
+                target = target.setdefault(part, {})
+            target[path[-1]] = value
+
+    walk(settings, [])
+    return res
+
+
+def _deep_merge(target: Dict[str, any], doc: Dict[str, any]):
+    for key, value in doc.items():
+        if _is(type(value), dict) and _is(type(target.get(key)), dict):
+            _deep_merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class _Document(NamedTuple):
+    index: str
+    id: str
+    source: Dict[str, any]
+    seq_no: int
+    primary_term: int
+    version: int
+    ordinal: int
+
+
+class _Index:
+    def __init__(self, name: str, mappings: Dict[str, any] = None, settings: Dict[str, any] = None):
+        self.name = name
+        self.documents: Dict[str, _Document] = {}
+        self.mappings = copy.deepcopy(mappings) if mappings else {}
+        self.mappings.setdefault('properties', {})
+        self.settings = copy.deepcopy(settings) if settings else {}
+        self.seq_no = -1
+        self.fields: Dict[str, Tuple[List[str], Optional[str]]] = {}
+
+    def field(self, field: str) -> Tuple[List[str], Optional[str]]:
+        res = self.fields.get(field)
+        if res is None:
+            res = self.fields[field] = self.__resolve(field)
+        return res
+
+    def __resolve(self, field: str) -> Tuple[List[str], Optional[str]]:
+        # the source path of a field coupled with its mapped type, multi fields (e.g. .keyword) share their parent
+        path, properties, mapping = [], self.mappings['properties'], None
+        parts = field.split('.')
+        for i, part in enumerate(parts):
+            if properties is not None and part in properties:
+                mapping = properties[part]
+                path.append(part)
+                properties = mapping.get('properties')
+            elif mapping is not None and part in mapping.get('fields', {}) and i == len(parts) - 1:
+                return path, mapping['fields'][part].get('type')
+            else:
+                return parts, None
+        return path, None if mapping is None else mapping.get('type', 'object' if 'properties' in mapping else None)
+
+
+class _Indices:
+    """ The indices namespace of FakeElasticsearch """
+
+    def __init__(self, client: 'FakeElasticsearch'):
+        self.__client = client
+
+    def create(self, index: str, body: Dict[str, any] = None, **_) -> Dict[str, any]:
+        return self.__client._create_index(index, body or {})
+
+    def delete(self, index: str, **_) -> Dict[str, any]:
+        return self.__client._delete_index(index)
+
+    def delete_index_template(self, name: str, **_) -> Dict[str, any]:
+        def delete():
+            if self.__client._templates.pop(name, None) is None:
+                raise _not_found('resource_not_found_exception', f'index_template [{name}] missing')
+            return {'acknowledged': True}
+        return self.__client._call('indices.delete_index_template', delete)
+
+    def exists(self, index: str, **_) -> bool:
+        return bool(self.__client._resolve(index, strict=False))
+
+    def exists_index_template(self, name: str, **_) -> bool:
+        return name in self.__client._templates
+
+    def get_index_template(self, name: str = None, **_) -> Dict[str, any]:
+        def get():
+            templates = self.__client._templates
+            names = [name] if name is not None else sorted(templates)
+            if name is not None and name not in templates:
+                raise _not_found('resource_not_found_exception', f'index template matching [{name}] not found')
+            return {'index_templates': [{'name': template, 'index_template': copy.deepcopy(templates[template])}
+                                        for template in names]}
+        return self.__client._call('indices.get_index_template', get)
+
+    def get_mapping(self, index: str = None, **_) -> Dict[str, any]:
+        return self.__client._call('indices.get_mapping', lambda: {
+            name: {'mappings': copy.deepcopy(idx.mappings)} for name, idx in self.__client._resolve(index).items()
+        })
+
+    def get_settings(self, index: str = None, **_) -> Dict[str, any]:
+        return self.__client._call('indices.get_settings', lambda: {
+            name: {'settings': {'index': _index_settings(copy.deepcopy(idx.settings))}}
+            for name, idx in self.__client._resolve(index).items()
+        })
+
+    def put_index_template(self, name: str, body: Dict[str, any], **_) -> Dict[str, any]:
+        def put():
+            if not body.get('index_patterns'):
+                raise _request_error('action_request_validation_exception', 'index patterns are missing')
+            self.__client._templates[name] = copy.deepcopy(body)
+            return {'acknowledged': True}
+        return self.__client._call('indices.put_index_template', put)
+
+    def put_mapping(self, body: Dict[str, any], index: str = None, **_) -> Dict[str, any]:
+        def put():
+            indices = self.__client._resolve(index).values()
+            # validate against every index before changing any, types of existing fields can't change
+            for idx in indices:
+                _merge_properties(copy.deepcopy(idx.mappings['properties']), body.get('properties', {}))
+            for idx in indices:
+                _merge_properties(idx.mappings['properties'], body.get('properties', {}))
+                idx.fields.clear()
+            return {'acknowledged': True}
+        return self.__client._call('indices.put_mapping', put)
+
+    def refresh(self, index: str = None, **_) -> Dict[str, any]:
+        # writes are visible immediately
+        return {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+
+class FakeElasticsearch:
+    """
+    FakeElasticsearch is an in-memory stand-in for the elasticsearch client, for offline tests and benchmarks
+
+    It implements the subset of the client the library uses: search (bool, term, terms, match, match_phrase,
+    multi_match, range, exists, ids, prefix, wildcard, source filtering, sort, search_after, aggregations and
+    profiling, every index being a single shard),
+    count, bulk, index, get, update, delete, delete_by_query, mget, msearch, points in time and the indices
+    namespace including index templates. Writes are visible immediately, text is analyzed by lower casing and
+    splitting on non word characters, every hit scores 1 and unsupported requests raise RequestError. Install it with
+    ElasticsearchIntegration.set_client(FakeElasticsearch())
+    """
+
+    def __init__(self, latency: Union[float, Dict[str, float]] = 0, jitter: float = 0, seed: int = None):
+        """
+        :param latency: The amount of seconds every call takes, or a dict of operation (e.g. search, bulk)
+        to seconds with '*' as the default
+        :param jitter: Up to this amount of seconds is randomly added to the latency of every call
+        :param seed: Fixes the random jitter and random_sampler aggregations
+        """
+
+        from elasticsearch.serializer import JSONSerializer
+
+        class _Transport:
+            serializer = JSONSerializer()
+
+        self.latency = latency
+        self.jitter = jitter
+        self.transport = _Transport()
+        self.indices = _Indices(self)
+
+        self.__random = random.Random(seed)
+        self.__lock = threading.RLock()
+        self.__indices: Dict[str, _Index] = {}
+        self._templates: Dict[str, Dict[str, any]] = {}
+        self.__pits: Dict[str, List[_Document]] = {}
+        self.__ordinals = itertools.count()
+        self.__calls = Counter()
+
+    @property
+    def calls(self) -> Dict[str, int]:
+        """The amount of calls made so far per operation"""
+        with self.__lock:
+            return dict(self.__calls)
+
+    def reset_calls(self) -> None:
+        with self.__lock:
+            self.__calls.clear()
+
+    def bulk(self, body: Union[str, bytes, List[any]], index: str = None, **_) -> Dict[str, any]:
+        return self._call('bulk', lambda: self.__bulk(body, index))
+
+    def close(self) -> None:
+        pass
+
+    def close_point_in_time(self, body: Dict[str, any], **_) -> Dict[str, any]:
+        def close():
+            found = self.__pits.pop(body['id'], None) is not None
+            return {'succeeded': True, 'num_freed': int(found)}
+        return self._call('close_point_in_time', close)
+
+    def count(self, body: Dict[str, any] = None, index: str = None, **_) -> Dict[str, any]:
+        def count():
+            matches = self.__compile((body or {}).get('query') or {'match_all': {}})
+            return {'count': sum(1 for document in self.__documents(index) if matches(document)),
+                    '_shards': self.__shards()}
+        return self._call('count', count)
+
+    def create(self, index: str, id: str, body: Dict[str, any], **_) -> Dict[str, any]:
+        return self.index(index, body, id=id, op_type='create')
+
+    def delete(self, index: str, id: str, **_) -> Dict[str, any]:
+        def delete():
+            idx = self.__index(index, create=False)
+            if idx is None or id not in idx.documents:
+                raise _not_found('not_found', f'document {id} is missing')
+            return self.__delete(idx, id)
+        return self._call('delete', delete)
+
+    def delete_by_query(self, index: str, body: Dict[str, any], **_) -> Dict[str, any]:
+        def delete_by_query():
+            start = time.perf_counter()
+            matches = self.__compile(body.get('query') or {'match_all': {}})
+            matching = [document for document in self.__documents(index) if matches(document)]
+            for document in matching:
+                self.__delete(self.__indices[document.index], document.id)
+            return {'took': self.__took(start), 'timed_out': False, 'total': len(matching),
+                    'deleted': len(matching), 'failures': []}
+        return self._call('delete_by_query', delete_by_query)
+
+    def exists(self, index: str, id: str, **_) -> bool:
+        with self.__lock:
+            idx = self.__indices.get(index)
+            return idx is not None and id in idx.documents
+
+    def get(self, index: str, id: str, _source_includes: List[str] = None, _source_excludes: List[str] = None,
+            **_) -> Dict[str, any]:
+        def get():
+            res = self.__get(index, id, _source_includes, _source_excludes)
+            if not res['found']:
+                raise _not_found('not_found', f'document {id} is missing')
+            return res
+        return self._call('get', get)
+
+    def index(self, index: str, body: Dict[str, any], id: str = None, op_type: str = None, **_) -> Dict[str, any]:
+        def index_():
+            status, res = self.__write(op_type or 'index', index, id, self.__normalize(body))
+            if status >= 400:
+                raise _request_error(res['error']['type'], res['error']['reason'])
+            return res
+        return self._call('index', index_)
+
+    def info(self, **_) -> Dict[str, any]:
+        return {'name': 'fake', 'cluster_name': 'fake', 'tagline': 'You Know, for Search',
+                'version': {'number': '7.17.0', 'build_flavor': 'default'}}
+
+    def mget(self, body: Dict[str, any], index: str = None, _source_includes: List[str] = None,
+             _source_excludes: List[str] = None, **_) -> Dict[str, any]:
+        def mget():
+            if 'ids' in body:
+                requests = [(index, meta_id) for meta_id in body['ids']]
+            else:
+                requests = [(doc.get('_index', index), doc['_id']) for doc in body['docs']]
+            return {'docs': [self.__get(doc_index, meta_id, _source_includes, _source_excludes)
+                             for doc_index, meta_id in requests]}
+        return self._call('mget', mget)
+
+    def msearch(self, body: Union[str, List[Dict[str, any]]], index: str = None, **_) -> Dict[str, any]:
+        def msearch():
+            lines = self.__lines(body)
+            responses = []
+            for header, search in zip(lines[::2], lines[1::2]):
+                try:
+                    response = self.__search(search, header.get('index', index))
+                    response['status'] = 200
+                except Exception as e:
+                    status = getattr(e, 'status_code', 500)
+                    info = getattr(e, 'info', None)
+                    error = info.get('error') if isinstance(info, dict) else {'type': type(e).__name__,
+                                                                                'reason': str(e)}
+                    response = {'error': error, 'status': status}
+                responses.append(response)
+            return {'took': 0, 'responses': responses}
+        return self._call('msearch', msearch)
+
+    def open_point_in_time(self, index: str, keep_alive: str = None, **_) -> Dict[str, any]:
+        # points in time don't expire, close them to free their snapshot
+        def open_point_in_time():
+            pit_id = uuid.uuid4().hex
+            self.__pits[pit_id] = list(self.__documents(index))
+            return {'id': pit_id}
+        return self._call('open_point_in_time', open_point_in_time)
+
+    def ping(self, **_) -> bool:
+        return True
+
+    def search(self, body: Dict[str, any] = None, index: str = None, **_) -> Dict[str, any]:
+        return self._call('search', lambda: self.__search(body or {}, index))
+
+    def update(self, index: str, id: str, body: Dict[str, any], **_) -> Dict[str, any]:
+        def update():
+            status, res = self.__update(index, id, self.__normalize(body))
+            if status == 404:
+                raise _not_found(res['error']['type'], res['error']['reason'])
+            if status >= 400:
+                raise _request_error(res['error']['type'], res['error']['reason'])
+            return res
+        return self._call('update', update)
+
+    def _call(self, operation: str, func: Callable[[], any]) -> any:
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(operation, latency.get('*', 0))
+        if self.jitter:
+            latency += self.__random.uniform(0, self.jitter)
+        if latency:
+            time.sleep(latency)
+
+        with self.__lock:
+            self.__calls[operation] += 1
+            return func()
+
+    def _create_index(self, index: str, body: Dict[str, any]) -> Dict[str, any]:
+        def create():
+            if index in self.__indices:
+                raise _request_error('resource_already_exists_exception', f'index [{index}] already exists')
+            self.__indices[index] = self.__new_index(index, body.get('mappings'), body.get('settings'))
+            return {'acknowledged': True, 'shards_acknowledged': True, 'index': index}
+        return self._call('indices.create', create)
+
+    def _delete_index(self, index: str) -> Dict[str, any]:
+        def delete():
+            for name in self._resolve(index):
+                del self.__indices[name]
+            return {'acknowledged': True}
+        return self._call('indices.delete', delete)
+
+    def _resolve(self, index: Optional[str], strict: bool = True) -> Dict[str, _Index]:
+        with self.__lock:
+            if index in (None, '', '_all', '*'):
+                return dict(self.__indices)
+
+            res = {}
+            for pattern in index if _is(type(index), list) else index.split(','):
+                if '*' in pattern:
+                    res.update({name: idx for name, idx in self.__indices.items() if fnmatchcase(name, pattern)})
+                elif pattern in self.__indices:
+                    res[pattern] = self.__indices[pattern]
+                elif strict:
+                    raise _not_found('index_not_found_exception', f'no such index [{pattern}]')
+            return res
+
+    def __bulk(self, body: Union[str, bytes, List[any]], index: Optional[str]) -> Dict[str, any]:
+        start = time.perf_counter()
+        lines = self.__lines(body)
+        items, i = [], 0
+        while i < len(lines):
+            action = lines[i]
+            op_type, meta = next(iter(action.items()))
+            doc_index = meta.get('_index', index)
+            i += 1
+            if op_type == 'delete':
+                idx = self.__index(doc_index, create=False)
+                if idx is None or meta.get('_id') not in idx.documents:
+                    status, res = 404, {'_index': doc_index, '_id': meta.get('_id'), 'result': 'not_found'}
+                else:
+                    status, res = 200, self.__delete(idx, meta['_id'])
+            else:
+                source = lines[i]
+                i += 1
+                if op_type == 'update':
+                    status, res = self.__update(doc_index, meta.get('_id'), source)
+                else:
+                    status, res = self.__write(op_type, doc_index, meta.get('_id'), source)
+            res['status'] = status
+            items.append({op_type: res})
+
+        return {'took': self.__took(start), 'errors': any(item[op]['status'] >= 300
+                                                           for item in items for op in item), 'items': items}
+
+    def __delete(self, idx: _Index, meta_id: str) -> Dict[str, any]:
+        document = idx.documents.pop(meta_id)
+        idx.seq_no += 1
+        return {'_index': idx.name, '_type': '_doc', '_id': meta_id, '_version': document.version + 1,
+                'result': 'deleted', '_seq_no': idx.seq_no, '_primary_term': 1, '_shards': self.__shards()}
+
+    def __documents(self, index: Optional[str]) -> Iterator[_Document]:
+        for idx in self._resolve(index).values():
+            yield from idx.documents.values()
+
+    def __get(self, index: str, meta_id: str, includes: List[str] = None, excludes: List[str] = None) \
+            -> Dict[str, any]:
+        idx = self.__index(index, create=False)
+        document = None if idx is None else idx.documents.get(meta_id)
+        if document is None:
+            return {'_index': index, '_type': '_doc', '_id': meta_id, 'found': False}
+
+        source = copy.deepcopy(document.source)
+        if includes or excludes:
+            source = _filter_source(source, list(includes or []), list(excludes or []))
+        return {'_index': index, '_type': '_doc', '_id': meta_id, '_version': document.version,
+                '_seq_no': document.seq_no, '_primary_term': document.primary_term, 'found': True,
+                '_source': source}
+
+    def __index(self, index: str, create: bool = True) -> Optional[_Index]:
+        idx = self.__indices.get(index)
+        if idx is None and create:
+            idx = self.__indices[index] = self.__new_index(index)
+        return idx
+
+    def __new_index(self, index: str, mappings: Dict[str, any] = None, settings: Dict[str, any] = None) -> _Index:
+        # the highest priority template matching the name applies, what the request supplies takes precedence
+        matching = [template for template in self._templates.values()
+                    if any(fnmatchcase(index, pattern) for pattern in template['index_patterns'])]
+        if matching:
+            template = max(matching, key=lambda t: t.get('priority', 0)).get('template', {})
+            merged_mappings = copy.deepcopy(template.get('mappings', {}))
+            merged_mappings.setdefault('properties', {})
+            if mappings:
+                _merge_properties(merged_mappings['properties'], mappings.get('properties', {}))
+                merged_mappings.update({key: value for key, value in mappings.items() if key != 'properties'})
+            mappings = merged_mappings
+            settings = dict(copy.deepcopy(template.get('settings', {})), **(settings or {}))
+        return _Index(index, mappings, settings)
+
+    def __lines(self, body: Union[str, bytes, List[any]]) -> List[Dict[str, any]]:
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if isinstance(body, str):
+            body = body.splitlines()
+        res = []
+        for line in body:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if isinstance(line, str):
+                if not line.strip():
+                    continue
+                line = json.loads(line)
+            res.append(line)
+        return res
+
+    def __normalize(self, body: Dict[str, any]) -> Dict[str, any]:
+        # whatever the real client would have serialized, e.g. datetimes, reaches us the same way
+        return json.loads(self.transport.serializer.dumps(body))
+
+    def __update(self, index: str, meta_id: str, body: Dict[str, any]) -> Tuple[int, Dict[str, any]]:
+        if 'script' in body:
+            return 400, {'_index': index, '_id': meta_id,
+                         'error': {'type': 'illegal_argument_exception', 'reason': 'scripts are not supported'}}
+
+        idx = self.__index(index, create=False)
+        document = None if idx is None else idx.documents.get(meta_id)
+        if document is None:
+            if body.get('doc_as_upsert'):
+                return self.__write('index', index, meta_id, body.get('doc', {}), 'created')
+            if 'upsert' in body:
+                return self.__write('index', index, meta_id, body['upsert'], 'created')
+            return 404, {'_index': index, '_id': meta_id,
+                         'error': {'type': 'document_missing_exception', 'reason': f'[_doc][{meta_id}]: missing'}}
+
+        source = copy.deepcopy(document.source)
+        _deep_merge(source, body.get('doc', {}))
+        if source == document.source:
+            return 200, {'_index': index, '_type': '_doc', '_id': meta_id, '_version': document.version,
+                         'result': 'noop', '_seq_no': document.seq_no, '_primary_term': document.primary_term,
+                         '_shards': self.__shards()}
+        return self.__write('index', index, meta_id, source, 'updated')
+
+    def __write(self, op_type: str, index: str, meta_id: Optional[str], source: Dict[str, any],
+                result: str = None) -> Tuple[int, Dict[str, any]]:
+        if not _is(type(source), dict):
+            return 400, {'_index': index, '_id': meta_id,
+                         'error': {'type': 'mapper_parsing_exception', 'reason': 'failed to parse'}}
+
+        idx = self.__index(index)
+        meta_id = meta_id or uuid.uuid4().hex[:20]
+        previous = idx.documents.get(meta_id)
+        if previous is not None and op_type == 'create':
+            return 409, {'_index': index, '_id': meta_id,
+                         'error': {'type': 'version_conflict_engine_exception',
+                                   'reason': f'[{meta_id}]: version conflict, document already exists'}}
+
+        if _merge_mapping(idx.mappings['properties'], source, idx.mappings.get('dynamic_templates', ())):
+            idx.fields.clear()
+        idx.seq_no += 1
+        # documents are replaced rather than mutated so points in time keep seeing their snapshot
+        document = _Document(index, meta_id, source, idx.seq_no, 1, 1 if previous is None else previous.version + 1,
+                             next(self.__ordinals) if previous is None else previous.ordinal)
+        idx.documents[meta_id] = document
+        return 201 if previous is None else 200, {
+            '_index': index, '_type': '_doc', '_id': meta_id, '_version': document.version,
+            'result': result or ('created' if previous is None else 'updated'), '_seq_no': document.seq_no,
+            '_primary_term': 1, '_shards': self.__shards()
+        }
+
+    # --- search ---
+
+    def __search(self, body: Dict[str, any], index: Optional[str]) -> Dict[str, any]:
+        start = time.perf_counter()
+        pit = body.get('pit')
+        if pit is not None:
+            documents = self.__pits.get(pit['id'])
+            if documents is None:
+                raise _not_found('search_context_missing_exception', f'No search context found for id [{pit["id"]}]')
+        else:
+            documents = list(self.__documents(index))
+
+        sort = self.__sort_clauses(body.get('sort'))
+        aggs = body.get('aggs', body.get('aggregations'))
+        profile = None
+        if body.get('profile'):
+            matching, profile = self.__profile(body.get('query') or {'match_all': {}}, documents, sort, aggs)
+        else:
+            matches = self.__compile(body.get('query') or {'match_all': {}})
+            matching = [document for document in documents if matches(document)]
+
+        keyed = [(self.__sort_values(document, sort), document) for document in matching]
+        compare = functools.cmp_to_key(lambda a, b: self.__compare(a[0], b[0], sort))
+        keyed.sort(key=compare)
+
+        search_after = body.get('search_after')
+        if search_after is not None:
+            keyed = [(values, document) for values, document in keyed
+                     if self.__compare(values, list(search_after), sort) > 0]
+
+        offset, size = body.get('from', 0), body.get('size', 10)
+        source = _source_patterns(body.get('_source'))
+        hits = []
+        for values, document in keyed[offset:offset + size]:
+            hit = {'_index': document.index, '_type': '_doc', '_id': document.id, '_score': 1.0}
+            if source is not None:
+                includes, excludes = source
+                hit['_source'] = copy.deepcopy(document.source) if not includes and not excludes else \
+                    _filter_source(copy.deepcopy(document.source), includes, excludes)
+            if body.get('seq_no_primary_term'):
+                hit['_seq_no'], hit['_primary_term'] = document.seq_no, document.primary_term
+            if body.get('version'):
+                hit['_version'] = document.version
+            if body.get('sort') is not None or pit is not None:
+                hit['sort'] = values
+            hits.append(hit)
+
+        res_hits = {'max_score': 1.0 if hits else None, 'hits': hits}
+        track_total_hits = body.get('track_total_hits', 10000)
+        if track_total_hits is True:
+            res_hits['total'] = {'value': len(matching), 'relation': 'eq'}
+        elif track_total_hits is not False:
+            res_hits['total'] = {'value': min(len(matching), track_total_hits),
+                                 'relation': 'gte' if len(matching) > track_total_hits else 'eq'}
+
+        res = {'took': 0, 'timed_out': False, '_shards': self.__shards(), 'hits': res_hits}
+        if not aggs and self.__terminates_early(index, body, sort, len(matching), track_total_hits):
+            res['terminated_early'] = True
+        if aggs:
+            res['aggregations'] = self.__aggregate(aggs, matching)
+        if pit is not None:
+            res['pit_id'] = pit['id']
+        if profile is not None:
+            res['profile'] = {'shards': profile}
+        res['took'] = self.__took(start)
+        return res
+
+    def __terminates_early(self, index: Optional[str], body: Dict[str, any], sort: List[Tuple[str, str, any]],
+                           matching: int, track_total_hits: Union[bool, int]) -> bool:
+        # indices sorted the way the search is stop collecting once they have the top hits and the total they track
+        if track_total_hits is True or body.get('sort') is None or body.get('pit') is not None:
+            return False
+        needed = body.get('from', 0) + body.get('size', 10)
+        if track_total_hits is not False:
+            needed = max(needed, track_total_hits)
+        if matching <= needed:
+            return False
+
+        requested = [(field, order) for field, order, _ in sort]
+        indices = self._resolve(index, strict=False).values()
+        for idx in indices:
+            index_sort = _index_settings(idx.settings).get('sort', {})
+            fields, orders = index_sort.get('field', []), index_sort.get('order', [])
+            fields = fields if _is(type(fields), list) else [fields]
+            orders = orders if _is(type(orders), list) else [orders]
+            orders = orders + ['asc'] * (len(fields) - len(orders))
+            if list(zip(fields, orders))[:len(requested)] != requested or len(requested) > len(fields):
+                return False
+        return bool(indices)
+
+    def __field(self, document: _Document, field: str) -> Tuple[List[any], Optional[str]]:
+        path, field_type = self.__indices[document.index].field(field) if document.index in self.__indices \
+            else (field.split('.'), None)
+        return _values(document.source, path), field_type
+
+    def __profile(self, query: Dict[str, any], documents: List[_Document], sort: List[Tuple[str, str, any]],
+                  aggs: Optional[Dict[str, any]]) -> Tuple[List[_Document], List[Dict[str, any]]]:
+        # every index is a single shard, profiled on its own
+        by_index: Dict[str, List[_Document]] = {}
+        for document in documents:
+            by_index.setdefault(document.index, []).append(document)
+
+        matching, shards = [], []
+        for index, group in by_index.items():
+            started = time.perf_counter_ns()
+            tree = []
+            matches = self.__compile(query, tree)
+            rewrite_time = time.perf_counter_ns() - started
+            hits = [document for document in group if matches(document)]
+            matching.extend(hits)
+
+            started = time.perf_counter_ns()
+            compare = functools.cmp_to_key(lambda a, b: self.__compare(a, b, sort))
+            sorted([self.__sort_values(document, sort) for document in hits], key=compare)
+            collector = {'name': 'SimpleTopScoreDocCollector', 'reason': 'search_top_hits',
+                         'time_in_nanos': time.perf_counter_ns() - started}
+
+            aggregations = []
+            for name, agg in (aggs or {}).items():
+                started = time.perf_counter_ns()
+                self.__aggregate({name: agg}, hits)
+                kind = next(kind for kind in agg if kind not in ('aggs', 'aggregations', 'meta'))
+                aggregations.append({'type': ''.join(part.capitalize() for part in kind.split('_')) + 'Aggregator',
+                                     'description': name, 'time_in_nanos': time.perf_counter_ns() - started,
+                                     'breakdown': {}, 'children': []})
+
+            shards.append({'id': f'[fake][{index}][0]',
+                           'searches': [{'query': tree, 'rewrite_time': rewrite_time, 'collector': [collector]}],
+                           'aggregations': aggregations})
+        return matching, shards
+
+    def __compile(self, query: Dict[str, any], profile: List[Dict[str, any]] = None) \
+            -> Callable[[_Document], bool]:
+        if profile is None:
+            return self.__compile_query(query, None)
+
+        # the predicate is timed including its children, as elasticsearch does
+        node = {'type': None, 'description': None, 'time_in_nanos': 0, 'breakdown': {'match': 0, 'match_count': 0},
+                'children': []}
+        profile.append(node)
+        matches = self.__compile_query(query, node['children'])
+        node['type'], node['description'] = _QUERY_TYPES[next(iter(query))], _describe(query)
+        breakdown = node['breakdown']
+
+        def predicate(document: _Document) -> bool:
+            started = time.perf_counter_ns()
+            try:
+                return matches(document)
+            finally:
+                elapsed = time.perf_counter_ns() - started
+                node['time_in_nanos'] += elapsed
+                breakdown['match'] += elapsed
+                breakdown['match_count'] += 1
+        return predicate
+
+    def __compile_query(self, query: Dict[str, any], profile: Optional[List[Dict[str, any]]]) \
+            -> Callable[[_Document], bool]:
+        # queries are turned into predicates once per request rather than interpreted per document
+        if len(query) != 1:
+            raise _request_error('parsing_exception', f'a query must hold a single clause, got {list(query)}')
+
+        kind, clause = next(iter(query.items()))
+        if kind == 'match_all':
+            return lambda document: True
+        if kind == 'match_none':
+            return lambda document: False
+        if kind == 'bool':
+            return self.__compile_bool(clause, profile)
+        if kind == 'ids':
+            ids = set(clause.get('values', []))
+            return lambda document: document.id in ids
+        if kind == 'exists':
+            return lambda document: bool(self.__field(document, clause['field'])[0])
+        if kind == 'multi_match':
+            return lambda document: self.__matches_multi_match(clause, document)
+        if kind not in ('term', 'terms', 'match', 'match_phrase', 'range', 'prefix', 'wildcard'):
+            raise _request_error('parsing_exception', f'unknown query [{kind}] for FakeElasticsearch')
+
+        field, value = next((key, value) for key, value in clause.items() if key != 'boost')
+        options = {}
+        if _is(type(value), dict) and kind not in ('terms', 'range'):
+            options = value
+            value = value.get('value', value.get('query'))
+
+        if kind == 'range':
+            def matches(actual, field_type):
+                return self.__in_range(actual, value, field_type)
+        elif kind == 'terms':
+            def matches(actual, field_type):
+                return any(self.__equals(actual, expected, field_type) for expected in value)
+        elif kind == 'term':
+            def matches(actual, field_type):
+                return self.__equals(actual, value, field_type)
+        elif kind == 'prefix':
+            def matches(actual, _):
+                return isinstance(actual, str) and actual.startswith(value)
+        elif kind == 'wildcard':
+            def matches(actual, _):
+                return isinstance(actual, str) and fnmatchcase(actual, value)
+        else:
+            phrase, operator = kind == 'match_phrase', options.get('operator', 'or')
+
+            def matches(actual, field_type):
+                return self.__matches_text(actual, value, field_type, phrase, operator)
+
+        def predicate(document: _Document) -> bool:
+            values, field_type = self.__field(document, field)
+            return any(matches(actual, field_type) for actual in values)
+        return predicate
+
+    def __compile_bool(self, clause: Dict[str, any], profile: Optional[List[Dict[str, any]]]) \
+            -> Callable[[_Document], bool]:
+        def clauses(occur: str) -> List[Callable[[_Document], bool]]:
+            res = clause.get(occur, [])
+            return [self.__compile(query, profile) for query in (res if _is(type(res), list) else [res])]
+
+        required, excluded, should = clauses('must') + clauses('filter'), clauses('must_not'), clauses('should')
+        minimum = clause.get('minimum_should_match', 0 if required else 1) if should else 0
+        if isinstance(minimum, str):
+            minimum = int(minimum.rstrip('%')) * len(should) // 100 if minimum.endswith('%') else int(minimum)
+
+        def predicate(document: _Document) -> bool:
+            return all(matches(document) for matches in required) and \
+                not any(matches(document) for matches in excluded) and \
+                (not minimum or sum(1 for matches in should if matches(document)) >= minimum)
+        return predicate
+
+    def __matches_multi_match(self, clause: Dict[str, any], document: _Document) -> bool:
+        # without fields every text field is searched, phrases with slop only need all their terms present
+        fields = clause.get('fields') or ['*']
+        phrase = clause.get('type') == 'phrase' and not clause.get('slop')
+        tokens = _tokens(clause['query'])
+
+        def leaves(value: any, prefix: str) -> Iterator[Tuple[str, any]]:
+            if _is(type(value), dict):
+                for key, nested in value.items():
+                    yield from leaves(nested, f'{prefix}{key}.')
+            elif _is(type(value), list):
+                for nested in value:
+                    yield from leaves(nested, prefix)
+            elif isinstance(value, str):
+                yield prefix[:-1], value
+
+        for path, value in leaves(document.source, ''):
+            if any(fnmatchcase(path, pattern.split('^')[0]) for pattern in fields):
+                if phrase and self.__matches_text(value, clause['query'], 'text', True):
+                    return True
+                if not phrase and set(tokens) <= set(_tokens(value)):
+                    return True
+        return False
+
+    @staticmethod
+    def __matches_text(actual: any, value: any, field_type: Optional[str], phrase: bool, operator: str = 'or') \
+            -> bool:
+        if field_type != 'text' or not isinstance(actual, str):
+            return FakeElasticsearch.__equals(actual, value, field_type)
+
+        actual_tokens, tokens = _tokens(actual), _tokens(value)
+        if not tokens:
+            return False
+        if not phrase:
+            matched = [token in actual_tokens for token in tokens]
+            return all(matched) if operator.lower() == 'and' else any(matched)
+        return any(actual_tokens[i:i + len(tokens)] == tokens for i in range(len(actual_tokens) - len(tokens) + 1))
+
+    @staticmethod
+    def __equals(actual: any, expected: any, field_type: Optional[str]) -> bool:
+        if field_type == 'text' and isinstance(actual, str):
+            # term queries aren't analyzed, so they match single lower cased tokens
+            return str(expected) in _tokens(actual)
+        if field_type == 'date':
+            return _to_millis(actual) == _to_millis(expected)
+        if isinstance(actual, bool) or isinstance(expected, bool):
+            return str(actual).lower() == str(expected).lower()
+        if isinstance(actual, (int, float)) and not isinstance(expected, (int, float)):
+            try:
+                return float(actual) == float(expected)
+            except (TypeError, ValueError):
+                return False
+        return actual == expected
+
+    @staticmethod
+    def __in_range(actual: any, bounds: Dict[str, any], field_type: Optional[str]) -> bool:
+        def comparable(value: any) -> any:
+            if field_type == 'date' or isinstance(value, datetime):
+                return _to_millis(value)
+            return value
+
+        actual = comparable(actual)
+        try:
+            for operator, bound in bounds.items():
+                if operator not in ('gt', 'gte', 'lt', 'lte') or bound is None:
+                    continue
+                bound = comparable(bound)
+                if operator == 'gt' and not actual > bound or operator == 'gte' and not actual >= bound or \
+                        operator == 'lt' and not actual < bound or operator == 'lte' and not actual <= bound:
+                    return False
+        except TypeError:
+            return False
+        return True
+
+    # --- sorting ---
+
+    @staticmethod
+    def __sort_clauses(sort: any) -> List[Tuple[str, str, any]]:
+        # (field, order, missing) triplets, hits are always ordered by insertion last to be deterministic
+        if sort is None:
+            return [('_score', 'desc', None), ('_doc', 'asc', None)]
+
+        res = []
+        for clause in sort if _is(type(sort), list) else [sort]:
+            if isinstance(clause, str):
+                res.append((clause, 'desc' if clause == '_score' else 'asc', None))
+                continue
+            for field, options in clause.items():
+                if isinstance(options, str):
+                    res.append((field, options, None))
+                else:
+                    res.append((field, options.get('order', 'desc' if field == '_score' else 'asc'),
+                                options.get('missing')))
+        return res
+
+    def __sort_values(self, document: _Document, sort: List[Tuple[str, str, any]]) -> List[any]:
+        res = []
+        for field, order, missing in sort:
+            if field == '_score':
+                res.append(1.0)
+            elif field in ('_doc', '_shard_doc'):
+                res.append(document.ordinal)
+            elif field == '_id':
+                res.append(document.id)
+            else:
+                values, field_type = self.__field(document, field)
+                if field_type == 'text':
+                    raise _request_error('illegal_argument_exception',
+                                         f'Text fields are not optimised for sorting, use {field}.keyword')
+                if field_type == 'date':
+                    values = [_to_millis(value) for value in values]
+                values = [value for value in values if value is not None]
+                if not values:
+                    res.append(None if missing is None else missing)
+                else:
+                    res.append(min(values) if order == 'asc' else max(values))
+        return res
+
+    @staticmethod
+    def __compare(a: List[any], b: List[any], sort: List[Tuple[str, str, any]]) -> int:
+        for left, right, (_, order, _) in zip(a, b, sort):
+            if left == right:
+                continue
+            # missing values sort last either way
+            if left is None:
+                return 1
+            if right is None:
+                return -1
+            res = -1 if left < right else 1
+            return res if order == 'asc' else -res
+        return 0
+
+    # --- aggregations ---
+
+    def __aggregate(self, aggs: Dict[str, Dict[str, any]], documents: List[_Document]) -> Dict[str, any]:
+        res = {}
+        for name, agg in aggs.items():
+            sub_aggs = agg.get('aggs', agg.get('aggregations'))
+            kinds = [kind for kind in agg if kind not in ('aggs', 'aggregations', 'meta')]
+            if len(kinds) != 1:
+                raise _request_error('parsing_exception', f'aggregation [{name}] must hold a single type')
+
+            kind = kinds[0]
+            handler = getattr(self, f'_FakeElasticsearch__agg_{kind}', None)
+            if handler is None:
+                raise _request_error('parsing_exception', f'unknown aggregation [{kind}] for FakeElasticsearch')
+            res[name] = handler(agg[kind], documents, sub_aggs)
+        return res
+
+    def __bucket(self, key: any, documents: List[_Document], sub_aggs: Optional[Dict[str, any]], **extra) \
+            -> Dict[str, any]:
+        res = {'key': key}
+        res.update(extra)
+        res['doc_count'] = len(documents)
+        if sub_aggs:
+            res.update(self.__aggregate(sub_aggs, documents))
+        return res
+
+    def __numbers(self, options: Dict[str, any], documents: List[_Document]) -> Tuple[List[float], Optional[str]]:
+        res, field_type = [], None
+        for document in documents:
+            values, field_type = self.__field(document, options['field'])
+            if not values and 'missing' in options:
+                values = [options['missing']]
+            for value in values:
+                value = _to_millis(value) if field_type == 'date' else value
+                if isinstance(value, bool):
+                    value = int(value)
+                if isinstance(value, (int, float)):
+                    res.append(value)
+        return res, field_type
+
+    def __agg_avg(self, options, documents, _):
+        values, _ = self.__numbers(options, documents)
+        return {'value': sum(values) / len(values) if values else None}
+
+    def __agg_cardinality(self, options, documents, _):
+        distinct = set()
+        for document in documents:
+            for value in self.__field(document, options['field'])[0]:
+                distinct.add(json.dumps(value, sort_keys=True, default=str))
+        return {'value': len(distinct)}
+
+    def __agg_composite(self, options, documents, sub_aggs):
+        sources = []
+        for source in options['sources']:
+            (name, definition), = source.items()
+            kind, settings = next(iter(definition.items()))
+            if kind != 'terms':
+                raise _request_error('parsing_exception', f'unsupported composite source [{kind}]')
+            sources.append((name, settings['field'], settings.get('order', 'asc')))
+
+        groups: Dict[Tuple, List[_Document]] = {}
+        for document in documents:
+            keys = [self.__field(document, field)[0] for _, field, _ in sources]
+            for combination in itertools.product(*keys):
+                groups.setdefault(tuple(json.dumps(key) for key in combination), []).append(document)
+
+        ordered = sorted(groups, key=lambda combination: [json.loads(key) for key in combination])
+        after = options.get('after')
+        if after is not None:
+            after_key = [after.get(name) for name, _, _ in sources]
+            ordered = [combination for combination in ordered if [json.loads(key) for key in combination] > after_key]
+
+        buckets = [self.__bucket({name: json.loads(key) for (name, _, _), key in zip(sources, combination)},
+                                 groups[combination], sub_aggs) for combination in ordered[:options.get('size', 10)]]
+        res = {'buckets': buckets}
+        if buckets:
+            res['after_key'] = buckets[-1]['key']
+        return res
+
+    def __agg_date_histogram(self, options, documents, sub_aggs):
+        tz = _time_zone(options.get('time_zone'))
+        interval = options.get('calendar_interval') or options.get('fixed_interval') or options.get('interval')
+        calendar = 'fixed_interval' not in options and interval in _CALENDAR_UNITS
+        if calendar:
+            unit = _CALENDAR_UNITS[interval]
+        else:
+            match = re.match(r'^(\d+)(ms|[smhd])$', interval)
+            if match is None:
+                raise _request_error('illegal_argument_exception', f'failed to parse interval [{interval}]')
+            step = int(match.group(1)) * _FIXED_UNITS[match.group(2)]
+
+        def floor(millis: int) -> int:
+            if not calendar:
+                offset = int(datetime.fromtimestamp(millis / 1000, tz).utcoffset().total_seconds() * 1000)
+                return (millis + offset) // step * step - offset
+            local = datetime.fromtimestamp(millis / 1000, tz)
+            if unit == 'minute':
+                local = local.replace(second=0, microsecond=0)
+            elif unit == 'hour':
+                local = local.replace(minute=0, second=0, microsecond=0)
+            else:
+                local = local.replace(hour=0, minute=0, second=0, microsecond=0)
+                if unit == 'week':
+                    local -= timedelta(days=local.weekday())
+                elif unit == 'month':
+                    local = local.replace(day=1)
+                elif unit == 'quarter':
+                    local = local.replace(day=1, month=(local.month - 1) // 3 * 3 + 1)
+                elif unit == 'year':
+                    local = local.replace(day=1, month=1)
+            return int(local.replace(tzinfo=None).replace(tzinfo=tz).timestamp() * 1000)
+
+        def following(key: int) -> int:
+            if not calendar:
+                return key + step
+            local = datetime.fromtimestamp(key / 1000, tz).replace(tzinfo=None)
+            if unit in ('minute', 'hour', 'day', 'week'):
+                local += {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1),
+                          'week': timedelta(weeks=1)}[unit]
+            else:
+                months = {'month': 1, 'quarter': 3, 'year': 12}[unit]
+                month = local.month - 1 + months
+                local = local.replace(year=local.year + month // 12, month=month % 12 + 1)
+            return floor(int(local.replace(tzinfo=tz).timestamp() * 1000))
+
+        buckets: Dict[int, List[_Document]] = {}
+        for document in documents:
+            for value in self.__field(document, options['field'])[0]:
+                millis = _to_millis(value)
+                if millis is not None:
+                    buckets.setdefault(floor(millis), []).append(document)
+
+        min_doc_count = options.get('min_doc_count', 0)
+        keys = sorted(buckets)
+        bounds = options.get('extended_bounds')
+        if min_doc_count == 0 and (keys or bounds):
+            low = [floor(_to_millis(bounds['min']))] if bounds and bounds.get('min') is not None else []
+            high = [floor(_to_millis(bounds['max']))] if bounds and bounds.get('max') is not None else []
+            key, last, keys = min(keys[:1] + low), max(keys[-1:] + high), []
+            while key <= last:
+                keys.append(key)
+                key = following(key)
+
+        return {'buckets': [self.__bucket(key, buckets.get(key, []), sub_aggs,
+                                          key_as_string=_format_millis(key, tz))
+                            for key in keys if len(buckets.get(key, [])) >= min_doc_count]}
+
+    def __agg_filter(self, options, documents, sub_aggs):
+        matches = self.__compile(options)
+        matching = [document for document in documents if matches(document)]
+        res = {'doc_count': len(matching)}
+        if sub_aggs:
+            res.update(self.__aggregate(sub_aggs, matching))
+        return res
+
+    def __agg_max(self, options, documents, _):
+        return self.__extreme(options, documents, max)
+
+    def __agg_min(self, options, documents, _):
+        return self.__extreme(options, documents, min)
+
+    def __agg_percentile_ranks(self, options, documents, _):
+        values, _ = self.__numbers(options, documents)
+        return {'values': {str(float(rank)): (100 * sum(1 for value in values if value <= rank) / len(values)
+                                              if values else None) for rank in options['values']}}
+
+    def __agg_percentiles(self, options, documents, _):
+        values, _ = self.__numbers(options, documents)
+        values.sort()
+        return {'values': {str(float(percent)): _percentile(values, percent)
+                           for percent in options.get('percents', _DEFAULT_PERCENTS)}}
+
+    def __agg_random_sampler(self, options, documents, sub_aggs):
+        probability = options['probability']
+        sampler = random.Random(options['seed']) if 'seed' in options else self.__random
+        sampled = [document for document in documents if probability >= 1 or sampler.random() < probability]
+        return self.__agg_sampler({'shard_size': len(sampled)}, sampled, sub_aggs)
+
+    def __agg_sampler(self, options, documents, sub_aggs):
+        sampled = documents[:options.get('shard_size', 100)]
+        res = {'doc_count': len(sampled)}
+        if sub_aggs:
+            res.update(self.__aggregate(sub_aggs, sampled))
+        return res
+
+    def __agg_stats(self, options, documents, _):
+        values, _ = self.__numbers(options, documents)
+        return {'count': len(values), 'min': min(values) if values else None, 'max': max(values) if values else None,
+                'avg': sum(values) / len(values) if values else None, 'sum': float(sum(values))}
+
+    def __agg_sum(self, options, documents, _):
+        values, _ = self.__numbers(options, documents)
+        return {'value': float(sum(values))}
+
+    def __agg_terms(self, options, documents, sub_aggs):
+        groups: Dict[str, Tuple[any, List[_Document]]] = {}
+        for document in documents:
+            values, field_type = self.__field(document, options['field'])
+            if field_type == 'text':
+                raise _request_error('illegal_argument_exception',
+                                     f'Text fields are not optimised for aggregations, use {options["field"]}.keyword')
+            if not values and 'missing' in options:
+                values = [options['missing']]
+            for value in set(json.dumps(value) for value in values):
+                groups.setdefault(value, (json.loads(value), []))[1].append(document)
+
+        ordered = sorted(groups.values(), key=lambda group: (-len(group[1]), str(group[0])))
+        ordered = [group for group in ordered if len(group[1]) >= options.get('min_doc_count', 1)]
+        size = options.get('size', 10)
+        buckets = []
+        for key, group in ordered[:size]:
+            extra = {}
+            if isinstance(key, bool):
+                key, extra = int(key), {'key_as_string': str(key).lower()}
+            buckets.append(self.__bucket(key, group, sub_aggs, **extra))
+        return {'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(len(group) for _, group in ordered[size:]), 'buckets': buckets}
+
+    def __agg_value_count(self, options, documents, _):
+        return {'value': sum(len(self.__field(document, options['field'])[0]) for document in documents)}
+
+    def __extreme(self, options, documents, func):
+        values, field_type = self.__numbers(options, documents)
+        if not values:
+            return {'value': None}
+        res = {'value': float(func(values))}
+        if field_type == 'date':
+            res['value_as_string'] = _format_millis(int(res['value']))
+        return res
+
+    @staticmethod
+    def __shards() -> Dict[str, int]:
+        return {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}
+
+    @staticmethod
+    def __took(start: float) -> int:
+        return int((time.perf_counter() - start) * 1000)
+
+
+class FakeElasticsearchServer:
+    """
+    FakeElasticsearchServer serves a FakeElasticsearch over HTTP on localhost
+
+    Unlike the in-process fake, requests go through a real client, its connection pool and serialization,
+    which is what load tests need. Point a client at url, e.g. Elasticsearch(hosts=[server.url])
+    """
+
+    def __init__(self, client: FakeElasticsearch = None, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param client: The fake to serve, a new one if not supplied
+        :param host: The interface to listen on
+        :param port: The port to listen on, a free one if 0
+        """
+
+        self.client = client or FakeElasticsearch()
+        self.__address = (host, port)
+        self.__server = None
+        self.__thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'FakeElasticsearchServer':
+        self.start()
+        return self
+
+    def __exit__(self, *_) -> bool:
+        self.stop()
+        return False
+
+    @property
+    def url(self) -> str:
+        """The url to connect to"""
+        host, port = self.__server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> None:
+        from http.server import ThreadingHTTPServer
+
+        if self.__server is not None:
+            raise RuntimeError('This server was already started')
+
+        class Server(ThreadingHTTPServer):
+            # many concurrent clients connect at once
+            daemon_threads = True
+            request_queue_size = 1024
+
+        self.__server = Server(self.__address, self.__handler())
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name='FakeElasticsearchServer',
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        server, self.__server = self.__server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            self.__thread.join()
+
+    def __handler(self):
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import parse_qsl, unquote, urlsplit
+        client = self.client
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_DELETE(self):
+                self.__handle('DELETE')
+
+            def do_GET(self):
+                self.__handle('GET')
+
+            def do_HEAD(self):
+                self.__handle('HEAD')
+
+            def do_POST(self):
+                self.__handle('POST')
+
+            def do_PUT(self):
+                self.__handle('PUT')
+
+            def log_message(self, *_):
+                pass
+
+            def __handle(self, method: str):
+                url = urlsplit(self.path)
+                parts = [unquote(part) for part in url.path.split('/') if part]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length).decode('utf-8') if length else ''
+                try:
+                    status, response = 200, self.__route(method, parts, params, raw)
+                except Exception as e:
+                    status = getattr(e, 'status_code', 500)
+                    status = status if isinstance(status, int) else 500
+                    info = getattr(e, 'info', None)
+                    response = info if isinstance(info, dict) else \
+                        {'error': {'type': type(e).__name__, 'reason': str(e)}, 'status': status}
+
+                payload = b'' if response is None else json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if method != 'HEAD':
+                    self.wfile.write(payload)
+
+            @staticmethod
+            def __route(method: str, parts: List[str], params: Dict[str, str], raw: str) -> any:
+                def body():
+                    return json.loads(raw) if raw.strip() else {}
+
+                def source_params():
+                    return {key: params[key].split(',') for key in ('_source_includes', '_source_excludes')
+                            if key in params}
+
+                if not parts:
+                    return client.info()
+
+                # endpoints are the first part starting with an underscore, e.g. /cdrs/_doc/_bulk
+                endpoint = next((part for part in parts if part.startswith('_')), None)
+                index = parts[0] if not parts[0].startswith('_') else None
+                after = parts[parts.index(endpoint) + 1:] if endpoint is not None else []
+
+                if '_bulk' in parts:
+                    return client.bulk(raw, index=index)
+                if endpoint == '_search':
+                    return client.search(body(), index=index)
+                if endpoint == '_count':
+                    return client.count(body(), index=index)
+                if endpoint == '_msearch':
+                    return client.msearch(raw, index=index)
+                if endpoint == '_mget':
+                    return client.mget(body(), index=index, **source_params())
+                if endpoint == '_delete_by_query':
+                    return client.delete_by_query(index, body())
+                if endpoint == '_update':
+                    return client.update(index, after[0], body())
+                if endpoint == '_pit':
+                    if method == 'DELETE':
+                        return client.close_point_in_time(body())
+                    return client.open_point_in_time(index, params.get('keep_alive'))
+                if endpoint == '_mapping':
+                    if method == 'GET':
+                        return client.indices.get_mapping(index)
+                    return client.indices.put_mapping(body(), index)
+                if endpoint == '_settings':
+                    return client.indices.get_settings(index)
+                if endpoint == '_refresh':
+                    return client.indices.refresh(index)
+                if endpoint == '_index_template':
+                    name = after[0] if after else None
+                    if method == 'GET':
+                        return client.indices.get_index_template(name)
+                    if method == 'DELETE':
+                        return client.indices.delete_index_template(name)
+                    if method == 'HEAD':
+                        if not client.indices.exists_index_template(name):
+                            raise _not_found('resource_not_found_exception', f'index template [{name}] missing')
+                        return None
+                    return client.indices.put_index_template(name, body())
+                if endpoint in ('_doc', '_create'):
+                    meta_id = after[0] if after else None
+                    if method == 'GET':
+                        return client.get(index, meta_id, **source_params())
+                    if method == 'DELETE':
+                        return client.delete(index, meta_id)
+                    op_type = 'create' if endpoint == '_create' else params.get('op_type')
+                    return client.index(index, body(), id=meta_id, op_type=op_type)
+                if endpoint is None and len(parts) == 1:
+                    if method == 'PUT':
+                        return client.indices.create(index, body())
+                    if method == 'DELETE':
+                        return client.indices.delete(index)
+                    if method == 'HEAD':
+                        if not client.indices.exists(index):
+                            raise _not_found('index_not_found_exception', f'no such index [{index}]')
+                        return None
+
+                raise _request_error('illegal_argument_exception', f'unsupported endpoint {method} /{"/".join(parts)}')
+
+        return Handler
@@ -0,0 +1,653 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from elastic_pdo.elasticsearch_integration import ElasticsearchIntegration
+from .fake import FakeElasticsearch
+
+
+class TestFake(unittest.TestCase):
+    def setUp(self):
+        from .cdr import Cdr
+
+        self.client = FakeElasticsearch()
+        ElasticsearchIntegration.set_client(self.client)
+
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.cdrs = [Cdr(session_id=f'session-{i}', cdr_id=i, caller_phone_number='35095' if i % 2 else '12345',
+                         language=['english', 'hebrew', 'arabic'][i % 3], online=i % 4 == 0,
+                         start=start + timedelta(hours=i), end=start + timedelta(hours=i, seconds=10 * i),
+                         metadata={'agent': f'agent {i}'}) for i in range(12)]
+        ElasticsearchIntegration.add(*self.cdrs)
+
+    def tearDown(self):
+        ElasticsearchIntegration.disable_schema_cache()
+        ElasticsearchIntegration.set_client(None)
+
+    def test_crud(self):
+        from .cdr import Cdr
+
+        cdr = Cdr.fetch('session-3')
+        self.assertEqual(cdr.cdr_id, 3)
+        self.assertEqual(cdr.meta_id, self.cdrs[3].meta_id)
+
+        with cdr.transaction():
+            cdr.online = True
+            cdr.states.status = 2
+        fetched = Cdr.fetch('session-3')
+        self.assertTrue(fetched.online)
+        self.assertEqual(fetched.states.status, 2)
+
+        cdr.delete()
+        self.assertIsNone(Cdr.fetch('session-3'))
+        self.assertEqual(Cdr.count(), 11)
+
+    def test_lazy_loading(self):
+        from elastic_pdo.elasticsearch_model import _DEFAULTS
+        from .cdr import Cdr
+
+        models, total = Cdr.fetch_all()
+        self.assertEqual(total, 12)
+        self.assertNotIn('metadata', vars(models[0]))
+
+        # the first access loads the field of the whole result set in a single request
+        self.assertEqual(models[3].metadata['agent'], 'agent 3')
+        self.assertEqual([cdr.metadata['agent'] for cdr in models], [f'agent {i}' for i in range(12)])
+        self.assertEqual(self.client.calls['mget'], 1)
+        self.assertIsNone(models[0].caller_transcription)
+        self.assertEqual(self.client.calls['mget'], 2)
+        self.assertIn(Cdr, _DEFAULTS)
+
+        # lazy fields are fetched along with the rest once asked for, and can be overwritten without loading them
+        cdr = Cdr.fetch_matching({'term': {'cdr_id': 5}}, fields=['cdr_id', 'metadata'])[0][0]
+        self.assertEqual(vars(cdr)['metadata'], {'agent': 'agent 5'})
+        cdr = Cdr.fetch('session-6')
+        cdr.metadata = {'agent': 'someone'}
+        self.assertEqual(self.client.calls['mget'], 2)
+        self.assertEqual(Cdr.fetch('session-6', fields=['metadata']).metadata['agent'], 'someone')
+
+    def test_profiling(self):
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        profile = Cdr.profile(CallsFilterRequest(language_filter=['hebrew'], duration_min=20))
+        self.assertEqual(profile.total, 3)
+        shard, = profile.shards
+        self.assertEqual(shard.index, 'cdrs')
+        query, = shard.queries
+        self.assertEqual(query.type, 'BooleanQuery')
+        self.assertEqual([child.description for child in query.children],
+                         ['language.keyword:(hebrew)', 'duration:[20 TO *]'])
+        self.assertIn('duration:[20 TO *]', str(profile))
+        self.assertEqual(len(profile.slowest(2)), 2)
+
+        with self.assertLogs('elastic_pdo.slow_queries') as logs:
+            ElasticsearchIntegration.enable_slow_query_log(threshold=0)
+            try:
+                Cdr.count({'online': True})
+            finally:
+                ElasticsearchIntegration.disable_slow_query_log()
+        record, = logs.records
+        self.assertIn('{"query": {"term": {"online": true}}}', record.getMessage())
+        self.assertEqual(record.elastic_pdo_event.operation, 'count')
+
+    def test_schema(self):
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        ElasticsearchIntegration.enable_schema_cache()
+        events = []
+        ElasticsearchIntegration.add_listener(events.append)
+        try:
+            cdr = Cdr.fetch('session-2')
+            Cdr.search(CallsFilterRequest(language_filter=['arabic'], online=True))
+            with self.assertRaises(ValueError):
+                Cdr.validate_schema()
+        finally:
+            ElasticsearchIntegration.remove_listener(events.append)
+            ElasticsearchIntegration.disable_schema_cache()
+
+        self.assertEqual(vars(cdr)['start'], datetime(2024, 1, 1, 2, tzinfo=timezone.utc))
+        self.assertEqual([event.operation for event in events], ['indices.get_mapping', 'search', 'search'])
+        self.assertEqual(events[1].body['query']['bool']['must'], [{'term': {'session_id.keyword': 'session-2'}}])
+        self.assertEqual(events[2].body['query']['bool']['filter'],
+                         [{'term': {'online': True}}, {'terms': {'language.keyword': ['arabic']}}])
+
+        # text without a keyword sub-field is matched by phrase, numeric dates are read in their mapped epoch unit
+        self.client.indices.put_mapping({'properties': {'topics': {'type': 'text'},
+                                                        'answered': {'type': 'date', 'format': 'epoch_second'}}},
+                                        index='cdrs')
+        self.cdrs[5].topics = ['Billing issue', 'refund']
+        ElasticsearchIntegration.enable_schema_cache()
+        try:
+            listing, total = Cdr.search(CallsFilterRequest(topics=['billing issue', 'shipping']))
+            self.assertEqual(([cdr.cdr_id for cdr in listing], total), ([5], 1))
+            schema = Cdr.schema()
+            self.assertEqual(schema.decode('answered', 1704067200), datetime(2024, 1, 1, tzinfo=timezone.utc))
+            self.assertEqual(schema.decode('start', 1704067200000), datetime(2024, 1, 1, tzinfo=timezone.utc))
+        finally:
+            ElasticsearchIntegration.disable_schema_cache()
+
+    def test_mapping(self):
+        from elastic_pdo import mapping
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        derived = mapping.model_mapping(Cdr)['properties']
+        self.assertEqual(derived['session_id'], {'type': 'keyword'})
+        self.assertEqual(derived['caller_transcription']['properties']['text'], {'type': 'text'})
+        self.assertEqual(derived['metadata'], {'type': 'object', 'enabled': False})
+        self.assertEqual(derived['states']['properties']['status'], {'type': 'long'})
+        self.assertNotIn('swagger_types', derived['states']['properties'])
+
+        # the index was dynamically mapped by setUp
+        differences = {difference.field: difference for difference in mapping.diff(Cdr)}
+        self.assertEqual(differences['session_id'].actual['type'], 'text')
+        self.assertEqual(differences['session_id.keyword'].expected, None)
+        self.assertEqual(differences['account_manager_id'].actual, None)
+
+        self.client.indices.delete('cdrs')
+        mapping.create(Cdr, template=True)
+        ElasticsearchIntegration.add(*self.cdrs[:2], Cdr(session_id='session-x', metadata={'agent': 'x'}))
+        self.assertEqual(mapping.diff(Cdr), [])
+        self.assertEqual(Cdr.fetch('session-1').cdr_id, 1)
+        # strings have no keyword sub-field, the schema cache create turned on points the queries at them
+        self.assertIsNotNone(ElasticsearchIntegration.schema_cache)
+        listing, _ = Cdr.search(CallsFilterRequest(language_filter=['hebrew']))
+        self.assertEqual([cdr.cdr_id for cdr in listing], [1])
+
+        self.client.indices.put_mapping({'properties': {'extra': {'type': 'keyword'}}}, index='cdrs')
+        self.assertEqual([str(difference) for difference in mapping.diff(Cdr)],
+                         ['unexpected extra: {"type": "keyword"}'])
+        from elasticsearch import RequestError
+        with self.assertRaises(RequestError):
+            self.client.indices.put_mapping({'properties': {'session_id': {'type': 'long'}}}, index='cdrs')
+
+    def test_queries(self):
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        self.assertEqual(Cdr.count({'online': True}), 3)
+        self.assertEqual(Cdr.count({'online': True}, at_least=2), 2)
+        with self.assertWarns(DeprecationWarning):
+            self.assertEqual(ElasticsearchIntegration.count('cdrs', {'online': True}, 1, 0), 3)
+        with self.assertRaises(ValueError):
+            ElasticsearchIntegration.count('cdrs', 'online')
+        listing, total = Cdr.search(CallsFilterRequest(language_filter=['hebrew'], duration_min=20))
+        self.assertEqual(total, 3)
+        self.assertEqual(sorted(cdr.cdr_id for cdr in listing), [4, 7, 10])
+        listing, total = Cdr.search(CallsFilterRequest(text_to_search='7', online=True))
+        self.assertEqual((total, listing), (0, []))
+        listing, _ = Cdr.search(CallsFilterRequest(text_to_search='8', online=True))
+        self.assertEqual([cdr.cdr_id for cdr in listing], [8])
+
+        from elastic_pdo.elasticsearch_model import ElasticsearchQuery
+        self.assertEqual(ElasticsearchQuery.equals('online', True), {'term': {'online': True}})
+        self.assertEqual(ElasticsearchQuery.equals('tags', ['a', 'b']), {'terms': {'tags.keyword': ['a', 'b']}})
+        self.assertEqual(ElasticsearchQuery.equals('session_id', 'session-1', exact=True),
+                         {'term': {'session_id.keyword': 'session-1'}})
+        self.assertEqual(Cdr.fetch_matching(ElasticsearchQuery.equals('session_id', 'session-1', exact=True))[1], 1)
+
+        models, total = Cdr.fetch_matching(ElasticsearchIntegration.matching_body()['query'],
+                                           sort={'cdr_id': 'desc'}, max_elements=3, fields=['cdr_id'])
+        self.assertEqual([cdr.cdr_id for cdr in models], [11, 10, 9])
+        self.assertEqual(total, 12)
+
+        pages = list(ElasticsearchIntegration.scan('cdrs', {'range': {'cdr_id': {'gte': 2}}}, page_size=4))
+        self.assertEqual([len(page) for page in pages], [4, 4, 2])
+        self.assertEqual(self.client.calls['close_point_in_time'], 1)
+
+    def test_batch(self):
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        request = CallsFilterRequest(language_filter=['hebrew', 'arabic'], sort='cdr_id', order='asc', max_elements=3)
+        listing, total = Cdr.search(request)
+        count = Cdr.count(request)
+        seconds = Cdr.sum('duration', request)
+
+        searches = self.client.calls['search']
+        with Cdr.batch() as batch:
+            page = Cdr.search(request, batch=batch)
+            batched_count = Cdr.count(request, batch=batch)
+            batched_seconds = Cdr.sum('duration', request, batch=batch)
+            self.assertFalse(page.done)
+        self.assertEqual((self.client.calls['msearch'], self.client.calls['search']), (1, searches))
+
+        self.assertEqual(([cdr.cdr_id for cdr in page.result()[0]], page.result()[1]),
+                         ([cdr.cdr_id for cdr in listing], total))
+        self.assertEqual((batched_count.result(), batched_seconds.result()), (count, seconds))
+        self.assertEqual((total, count, seconds), (8, 8, 10.0 * sum([1, 2, 4, 5, 7, 8, 10, 11])))
+
+    def test_sort(self):
+        from elastic_pdo import mapping
+        from .cdr import Cdr
+        from .swagger.calls_filter_request import CallsFilterRequest
+
+        listing, total = Cdr.search(CallsFilterRequest(max_elements=3))
+        self.assertEqual(([cdr.cdr_id for cdr in listing], total), ([11, 10, 9], 12))
+        listing, _ = Cdr.search(CallsFilterRequest(language_filter=['hebrew'], sort='cdr_id', order='asc'))
+        self.assertEqual([cdr.cdr_id for cdr in listing], [1, 4, 7, 10])
+        with self.assertRaises(ValueError):
+            Cdr.search(CallsFilterRequest(order='newest'))
+
+        # strings are sorted by their keyword sub-field on a dynamically mapped index, ties by the primary key
+        pages = [Cdr.search(CallsFilterRequest(sort='language', order='asc', max_elements=5, offset=offset))[0]
+                 for offset in (0, 5, 10)]
+        self.assertEqual([cdr.session_id for page in pages for cdr in page],
+                         [f'session-{i}' for i in (11, 2, 5, 8, 0, 3, 6, 9, 1, 10, 4, 7)])
+
+        self.assertEqual(mapping.index_body(Cdr)['settings'],
+                         {'index': {'sort': {'field': ['start', 'session_id'], 'order': ['desc', 'desc']}}})
+        self.assertEqual([str(difference) for difference in mapping.diff(Cdr) if difference.field == 'index.sort'],
+                         ['missing index.sort: {"field": ["start", "session_id"], "order": ["desc", "desc"]}'])
+
+        self.client.indices.delete('cdrs')
+        mapping.create(Cdr)
+        ElasticsearchIntegration.add(*self.cdrs)
+        body = {'query': {'match_all': {}}, 'sort': [{'start': {'order': 'desc'}}], 'size': 3, 'track_total_hits': 5}
+        response = self.client.search(index='cdrs', body=body)
+        self.assertTrue(response['terminated_early'])
+        self.assertEqual(response['hits']['total'], {'value': 5, 'relation': 'gte'})
+        self.assertNotIn('terminated_early', self.client.search(index='cdrs', body=dict(body, track_total_hits=True)))
+        self.assertNotIn('terminated_early',
+                         self.client.search(index='cdrs', body=dict(body, sort=[{'start': {'order': 'asc'}}])))
+
+        listing, total = Cdr.search(CallsFilterRequest(max_elements=3), track_total_hits=5)
+        self.assertEqual(([cdr.cdr_id for cdr in listing], total), ([11, 10, 9], 5))
+        listing, _ = Cdr.search(CallsFilterRequest(max_elements=3, offset=3))
+        self.assertEqual([cdr.cdr_id for cdr in listing], [8, 7, 6])
+        tiebroken = dict(body, sort=[{'start': {'order': 'desc'}}, {'session_id': {'order': 'desc'}}])
+        self.assertTrue(self.client.search(index='cdrs', body=tiebroken)['terminated_early'])
+
+        # calls starting together are paged through in the same order on every page
+        tied = datetime(2024, 2, 1, tzinfo=timezone.utc)
+        ElasticsearchIntegration.add(*[Cdr(session_id=f'tie-{i}', cdr_id=100 + i, start=tied) for i in range(6)])
+        pages = [Cdr.search(CallsFilterRequest(max_elements=3, offset=offset))[0] for offset in (0, 3)]
+        self.assertEqual([cdr.session_id for page in pages for cdr in page], [f'tie-{i}' for i in range(5, -1, -1)])
+
+    def test_identity_map(self):
+        from elastic_pdo.identity_map import IdentityMap
+        from .cdr import Cdr
+
+        with IdentityMap() as identity_map:
+            cdr = Cdr.fetch('session-1')
+            searches = self.client.calls['search']
+            # already seen primary keys don't reach elasticsearch
+            self.assertIs(Cdr.fetch('session-1'), cdr)
+            self.assertEqual(self.client.calls['search'], searches)
+
+            cdr.language = 'changed'
+            listing, _ = Cdr.fetch_all()
+            self.assertIs(listing[1], cdr)
+            self.assertEqual(listing[1].language, 'changed')
+            self.assertEqual(len(identity_map), 12)
+
+            cdr.delete()
+            self.assertNotIn(cdr, identity_map)
+            self.assertIsNone(Cdr.fetch('session-1'))
+        self.assertIsNone(IdentityMap.current())
+        self.assertIsNot(Cdr.fetch('session-2'), Cdr.fetch('session-2'))
+
+    def test_disk_cache(self):
+        import os
+        import tempfile
+        from .cdr import Cdr
+
+        events = []
+        with tempfile.TemporaryDirectory() as directory:
+            ElasticsearchIntegration.enable_disk_cache(os.path.join(directory, 'cache.sqlite'), ['cdrs'])
+            ElasticsearchIntegration.add_listener(events.append)
+            try:
+                self.assertEqual(Cdr.fetch('session-1').cdr_id, 1)
+                # the cached document is revalidated by its version only
+                self.assertEqual(Cdr.fetch('session-1').cdr_id, 1)
+                self.assertEqual([event.body.get('_source') is False for event in events], [False, True])
+
+                # documents changed behind our back are fetched again
+                self.client.update(index='cdrs', id=self.cdrs[1].meta_id, body={'doc': {'language': 'changed'}})
+                self.assertEqual(Cdr.fetch('session-1').language, 'changed')
+                self.assertEqual([event.body.get('_source') is False for event in events[2:]], [True, False])
+                self.client.delete(index='cdrs', id=self.cdrs[1].meta_id)
+                self.assertIsNone(Cdr.fetch('session-1'))
+
+                # writes through the library invalidate, entries younger than max_age aren't revalidated
+                ElasticsearchIntegration.enable_disk_cache(os.path.join(directory, 'cache.sqlite'), ['cdrs'], 60)
+                cdr = Cdr.fetch('session-2')
+                cdr.language = 'changed'
+                self.assertEqual(Cdr.fetch('session-2').language, 'changed')
+                del events[:]
+                self.assertEqual(Cdr.fetch('session-2').language, 'changed')
+                self.assertEqual(events, [])
+            finally:
+                ElasticsearchIntegration.remove_listener(events.append)
+                ElasticsearchIntegration.disable_disk_cache()
+
+    def test_columns(self):
+        import numpy
+        from elastic_pdo.columns import to_numpy
+        from .cdr import Cdr
+
+        columns = Cdr.fetch_columns({'range': {'cdr_id': {'lt': 6}}}, ['cdr_id', 'start', 'online', 'duration'],
+                                    page_size=4)
+        order = numpy.argsort(columns['cdr_id'])
+        self.assertEqual(columns['cdr_id'].dtype, numpy.int64)
+        self.assertEqual(columns['cdr_id'][order].tolist(), list(range(6)))
+        self.assertEqual(columns['start'].dtype, numpy.dtype('datetime64[ms]'))
+        self.assertEqual(columns['start'][order][1], numpy.datetime64('2024-01-01T01:00:00', 'ms'))
+        self.assertEqual(columns['online'][order].tolist(), [True, False, False, False, True, False])
+        self.assertEqual(columns['duration'][order].tolist(), [10.0 * i for i in range(6)])
+
+        table = Cdr.fetch_columns(fields=['cdr_id', 'language'], as_arrow=True)
+        self.assertEqual(table.num_rows, 12)
+        self.assertEqual(sorted(table.column('language').to_pylist()),
+                         ['arabic'] * 4 + ['english'] * 4 + ['hebrew'] * 4)
+
+        self.assertTrue(numpy.isnan(to_numpy([1, None], int)[1]))
+        self.assertTrue(numpy.isnat(to_numpy(['2024-01-01T00:00:00Z', None], datetime)[1]))
+        with self.assertRaises(ValueError):
+            Cdr.fetch_columns()
+
+        # optional dependencies that are missing name what needs them
+        from unittest import mock
+        with mock.patch.dict('sys.modules', {'pyarrow': None}):
+            with self.assertRaisesRegex(ImportError, 'as_arrow requires pyarrow'):
+                Cdr.fetch_columns(fields=['cdr_id'], as_arrow=True)
+
+    def test_query_cache(self):
+        from elastic_pdo.query_cache import QueryCache
+        from .cdr import Cdr
+
+        ElasticsearchIntegration.enable_query_cache(max_size=2)
+        try:
+            cache = ElasticsearchIntegration.query_cache
+            self.assertEqual((Cdr.count(), Cdr.count()), (12, 12))
+            self.assertEqual(self.client.calls['count'], 1)
+
+            # the least recently used count is evicted
+            Cdr.count({'online': True})
+            Cdr.count()
+            Cdr.count({'language': 'hebrew'})
+            self.assertEqual(Cdr.count(), 12)
+            self.assertEqual(self.client.calls['count'], 3)
+            self.assertEqual(Cdr.count({'online': True}), 3)
+            self.assertEqual(self.client.calls['count'], 4)
+            self.assertEqual(cache.stats['evictions'], 2)
+
+            # writes invalidate their index
+            ElasticsearchIntegration.add(Cdr(session_id='session-12', cdr_id=12, online=True))
+            self.assertEqual(Cdr.count({'online': True}), 4)
+            self.assertEqual(cache.stats['invalidations'], 1)
+
+            # a response that raced a write isn't cached
+            def write(event):
+                if event.operation == 'count':
+                    ElasticsearchIntegration.remove_listener(write)
+                    self.cdrs[0].delete()
+            ElasticsearchIntegration.add_listener(write)
+            self.assertEqual(Cdr.count(), 13)
+            self.assertEqual(Cdr.count(), 12)
+        finally:
+            ElasticsearchIntegration.disable_query_cache()
+        self.assertEqual(len(cache), 0)
+
+        cache = QueryCache(ttl=0)
+        cache.put('key', 'cdrs', {'count': 1})
+        self.assertIsNone(cache.get('key'))
+        cache = QueryCache()
+        generation = cache.generation('cdrs')
+        cache.invalidate()
+        cache.put('key', 'cdrs', {'count': 1}, generation)
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', 'cdrs', {'count': 1}, cache.generation('cdrs'))
+        self.assertEqual(cache.get('key'), {'count': 1})
+
+    def test_mirror(self):
+        from unittest import mock
+        from elastic_pdo.mirror import ModelMirror, _field_values
+        from .cdr import Cdr
+
+        mirror = ModelMirror(Cdr, high_water_field='cdr_id', indexed_fields=['language.keyword'], page_size=5)
+        self.assertEqual(len(mirror.fetch_all()[0]), 12)
+        self.assertEqual(mirror.high_water, 11)
+
+        events = []
+        ElasticsearchIntegration.add_listener(events.append)
+        try:
+            self.assertEqual(mirror.fetch('session-4').cdr_id, 4)
+            self.assertIsNone(mirror.fetch('session-x'))
+            # indexed fields are looked up without scanning the documents
+            with mock.patch('elastic_pdo.mirror._field_values', wraps=_field_values) as field_values:
+                self.assertEqual(mirror.fetch_matching({'terms': {'language.keyword': ['hebrew']}})[1], 4)
+            field_values.assert_not_called()
+            models, total = mirror.fetch_matching({'bool': {'filter': [{'terms': {'language.keyword': ['hebrew']}},
+                                                                       {'term': {'online': True}}]}})
+            self.assertEqual(([cdr.cdr_id for cdr in models], total), ([4], 1))
+            self.assertEqual(events, [])
+
+            # text is analyzed by elasticsearch, the mirror leaves matching it to the cluster
+            models, total = mirror.fetch_matching({'match_phrase': {'language': 'Hebrew'}})
+            self.assertEqual(total, 4)
+            self.assertEqual(mirror.fetch_matching({'term': {'language.keyword': 'Hebrew'}})[1], 0)
+            self.assertEqual(len(events), 1)
+        finally:
+            ElasticsearchIntegration.remove_listener(events.append)
+
+        # models handed out don't share state with the mirror
+        mirror.fetch('session-4').language = 'changed'
+        self.assertEqual(mirror.fetch('session-4').language, 'hebrew')
+
+        ElasticsearchIntegration.add(Cdr(session_id='session-12', cdr_id=12, language='hebrew'))
+        self.cdrs[0].delete()
+        mirror.sync()
+        self.assertEqual((len(mirror), mirror.high_water), (13, 12))
+        self.assertEqual(mirror.fetch_matching({'term': {'language.keyword': 'hebrew'}})[1], 5)
+        mirror.refresh()
+        self.assertIsNone(mirror.fetch('session-0'))
+
+    def test_export(self):
+        import json
+        import os
+        import tempfile
+        from elastic_pdo.export import ModelExporter, _prefetch
+        from .cdr import Cdr
+
+        with tempfile.TemporaryDirectory() as directory:
+            files = ModelExporter(Cdr, directory, page_size=2, max_file_bytes=1, query={'term': {'online': True}},
+                                  include_meta_id=True).run()
+            self.assertEqual([os.path.basename(path) for path in files], ['cdrs-00000.ndjson', 'cdrs-00001.ndjson'])
+            documents = [json.loads(line) for path in files for line in open(path)]
+            self.assertEqual(sorted(document['cdr_id'] for document in documents), [0, 4, 8])
+            self.assertEqual(documents[0][ElasticsearchIntegration.META_ID_FIELD], self.cdrs[0].meta_id)
+            self.assertEqual(self.client.calls['close_point_in_time'], 1)
+
+            from pyarrow import parquet
+            path, = ModelExporter(Cdr, directory, file_format='parquet', fields=['cdr_id', 'start']).run()
+            table = parquet.read_table(path)
+            self.assertEqual(sorted(table.column('cdr_id').to_pylist()), list(range(12)))
+            self.assertEqual(str(table.schema.field('start').type), 'timestamp[ms, tz=UTC]')
+
+            # duration defaults to 0 but is mapped as a double, integer columns refuse fractions
+            self.cdrs[1].duration = 10.5
+            path, = ModelExporter(Cdr, directory, file_format='parquet', fields=['duration'],
+                                  query={'term': {'cdr_id': 1}}).run()
+            self.assertEqual(str(parquet.read_table(path).schema.field('duration').type), 'double')
+            self.assertEqual(parquet.read_table(path).column('duration').to_pylist(), [10.5])
+            import pyarrow
+            with self.assertRaises(ValueError):
+                ModelExporter(Cdr, directory, file_format='parquet', fields=['duration'],
+                              schema=pyarrow.schema([pyarrow.field('duration', pyarrow.int64())])).run()
+
+        # a consumer leaving early while the producer waits on a full queue
+        pages = _prefetch(iter(range(10)), 2)
+        self.assertEqual(next(pages), 0)
+        pages.close()
+
+    def test_import(self):
+        import json
+        import os
+        import tempfile
+        from elastic_pdo.importer import ModelImporter
+        from .cdr import Cdr
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cdrs.ndjson')
+            with open(path, 'w') as file:
+                for cdr in self.cdrs[:3]:
+                    document = json.loads(json.dumps(cdr.to_elastic_document(), default=str))
+                    document[ElasticsearchIntegration.META_ID_FIELD] = cdr.meta_id
+                    file.write(json.dumps(document) + '\n')
+                file.write(json.dumps({'session_id': 'session-x', 'unknown': 1}) + '\n')
+                file.write('\n')
+
+            self.client.indices.delete('cdrs')
+            result = ModelImporter(Cdr, chunk_size=2, through_models=True, keep_meta_ids=True, validate=True,
+                                   transform=lambda document: document if document.get('cdr_id') != 2 else None) \
+                .run(path)
+            self.assertEqual(result[:3], (2, 1, 1))
+            error, = result.errors
+            self.assertIn('unknown', error['index']['error']['reason'])
+
+            self.assertEqual(Cdr.count(), 2)
+            cdr = Cdr.fetch('session-1')
+            self.assertEqual(cdr.meta_id, self.cdrs[1].meta_id)
+            self.assertEqual((cdr.cdr_id, vars(cdr)['start']), (1, str(vars(self.cdrs[1])['start'])))
+
+            result = ModelImporter(Cdr).run(path)
+            self.assertEqual(result[:3], (4, 0, 0))
+
+    def test_aggregations(self):
+        from .cdr import Cdr
+
+        self.assertEqual(dict(Cdr.distinct('language.keyword')), {'english': 4, 'hebrew': 4, 'arabic': 4})
+        self.assertEqual(sorted(value for value, _ in Cdr.iter_distinct('cdr_id', page_size=5)), list(range(12)))
+
+        results = Cdr.aggregate({'term': {'online': True}}).sum('duration').max('start') \
+            .cardinality('language.keyword').execute()
+        self.assertEqual(results['sum_duration'], 0 + 40 + 80.0)
+        self.assertEqual(results['max_start'], datetime(2024, 1, 1, 8, tzinfo=timezone.utc))
+        self.assertEqual(results['cardinality_language.keyword'], 3)
+
+        series = Cdr.time_series('start', '4h', metrics=[('sum', 'duration')])
+        self.assertEqual(series['doc_count'], [4, 4, 4])
+        self.assertEqual(series['sum_duration'], [60.0, 220.0, 380.0])
+        start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.assertEqual(series['key'], [start, start + timedelta(hours=4), start + timedelta(hours=8)])
+        series = Cdr.time_series('start', '1d', time_zone='+03:00')
+        self.assertEqual((series['key'], series['doc_count']), ([start - timedelta(hours=3)], [12]))
+
+        # fields mapped with a custom format don't format their keys as ISO dates
+        from elastic_pdo.aggregation import _time_series
+        buckets = [{'key': 1704067200000, 'key_as_string': '01/01/2024 00:00', 'doc_count': 1}]
+        self.assertEqual(_time_series({'buckets': buckets}, [], False)['key'], [start])
+
+    def test_approximate_aggregations(self):
+        from .cdr import Cdr
+
+        # durations are 0, 10, ..., 110
+        aggregation = Cdr.aggregate().percentiles('duration', [50, 95]).percentile_ranks('duration', [50, 100])
+        self.assertEqual(aggregation.body()['aggs'],
+                         {'percentiles_duration': {'percentiles': {'field': 'duration', 'percents': [50, 95]}},
+                          'percentile_ranks_duration': {'percentile_ranks': {'field': 'duration',
+                                                                             'values': [50, 100]}}})
+        results = aggregation.execute()
+        self.assertEqual(results['percentiles_duration'], {50.0: 55.0, 95.0: 104.5})
+        self.assertEqual(results['percentile_ranks_duration'][50.0], 50.0)
+        self.assertEqual(list(Cdr.percentiles('duration')), [1.0, 5.0, 25.0, 50.0, 75.0, 95.0, 99.0])
+        self.assertEqual(Cdr.percentile_ranks('duration', [100], {'term': {'online': True}}), {100.0: 100.0})
+        self.assertEqual(Cdr.cardinality('language.keyword', precision_threshold=100), 3)
+
+        # sampling wraps every aggregation and unwraps the results
+        aggregation = Cdr.aggregate({'term': {'online': True}}).sum('duration').sample(10)
+        self.assertEqual(aggregation.body()['aggs'],
+                         {'_sample': {'sampler': {'shard_size': 10},
+                                      'aggs': {'sum_duration': {'sum': {'field': 'duration'}}}}})
+        self.assertEqual(aggregation.execute(), {'sum_duration': 120.0})
+        aggregation = Cdr.aggregate().max('cdr_id').random_sample(0.25, seed=7)
+        self.assertEqual(aggregation.body()['aggs']['_sample']['random_sampler'], {'probability': 0.25, 'seed': 7})
+        self.assertEqual(list(aggregation.execute()), ['max_cdr_id'])
+        with self.assertRaises(RuntimeError):
+            aggregation.sample()
+
+    def test_instrumentation(self):
+        from elastic_pdo.instrumentation import RequestCollector
+        from .cdr import Cdr
+
+        events = []
+        ElasticsearchIntegration.add_listener(events.append)
+        try:
+            with RequestCollector() as collector:
+                Cdr.fetch('session-1')
+                Cdr.fetch_matching(sort={'cdr_id': 'asc'}, max_elements=5)
+                with self.assertRaises(Exception):
+                    ElasticsearchIntegration.remove_by_meta_id('cdrs', 'missing')
+        finally:
+            ElasticsearchIntegration.remove_listener(events.append)
+
+        self.assertEqual([(event.operation, event.model, event.hits) for event in events],
+                         [('search', Cdr, 1), ('search', Cdr, 5), ('delete', Cdr, None)])
+        self.assertGreater(events[1].response_bytes, events[0].response_bytes)
+        self.assertIsNotNone(events[2].error)
+
+        search, = [series for series in collector.dump() if series['operation'] == 'search']
+        self.assertEqual((search['requests'], search['hits'], search['wall_time']['count']), (2, 6, 2))
+        exposition = collector.prometheus()
+        self.assertIn('elastic_pdo_requests_total{operation="search",index="cdrs",model="Cdr"} 2', exposition)
+        self.assertIn('elastic_pdo_request_errors_total{operation="delete",index="cdrs",model="Cdr"} 1', exposition)
+        self.assertIn('elastic_pdo_request_duration_seconds_count{operation="search",index="cdrs",model="Cdr"} 2',
+                      exposition)
+
+        # listeners that don't read the sizes don't pay for serializing the bodies
+        from unittest import mock
+        from elastic_pdo import instrumentation
+        with mock.patch.object(instrumentation, '_size', wraps=instrumentation._size) as size:
+            ElasticsearchIntegration.enable_slow_query_log(threshold=10.0)
+            try:
+                Cdr.fetch_matching(max_elements=5)
+            finally:
+                ElasticsearchIntegration.disable_slow_query_log()
+            size.assert_not_called()
+
+    def test_request_scope(self):
+        from elastic_pdo.request_scope import RequestScope
+        from .cdr import Cdr
+
+        with RequestScope(max_fetches=3, max_updates=1, on_repeat='record') as scope:
+            cdrs = [Cdr.fetch(f'session-{i}') for i in range(4)]
+            Cdr.fetch_matching({'range': {'cdr_id': {'lt': 4}}})
+            # listings matching a single model aren't fetches
+            for i in range(5):
+                Cdr.fetch_matching({'term': {'cdr_id': i}})
+            Cdr.count()
+            with cdrs[0].transaction():
+                cdrs[0].online = True
+                cdrs[0].language = 'hebrew'
+        self.assertEqual((scope.count('fetch', 'cdrs'), scope.count('update', 'cdrs')), (4, 1))
+        self.assertEqual([(repeat.kind, repeat.count) for repeat in scope.repeats], [('fetch', 4)])
+        self.assertEqual(scope.repeats[0].call_site[-1].filename, __file__)
+        self.assertEqual((len(scope.events), scope.requests), (12, 12))
+        with RequestScope(max_events=2) as scope:
+            Cdr.fetch_all()
+            Cdr.count()
+            Cdr.fetch('session-1')
+        self.assertEqual(([event.operation for event in scope.events], scope.requests), (['count', 'search'], 3))
+        self.assertIsNone(RequestScope.current())
+
+        ElasticsearchIntegration.enable_query_cache()
+        try:
+            self.assertEqual(Cdr.count({'online': True}), 3)
+            with self.assertRaises(RuntimeError):
+                with RequestScope(max_updates=1, on_repeat='raise'):
+                    cdrs[1].online = True
+                    cdrs[2].online = True
+            # the update crossing the limit went through and was followed by the invalidation
+            self.assertEqual(Cdr.count({'online': True}), 5)
+        finally:
+            ElasticsearchIntegration.disable_query_cache()
+        with self.assertWarns(RuntimeWarning):
+            with RequestScope(max_fetches=1):
+                Cdr.fetch('session-1')
+                Cdr.fetch('session-2')
+
+
+if __name__ == '__main__':
+    unittest.main()